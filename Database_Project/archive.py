@@ -0,0 +1,78 @@
+import database
+import jobs
+
+# Moves old closed checkouts from Checkouts into CheckoutsArchive
+# Open loans never move, so everything that looks at return_date IS NULL keeps a small table,
+# while CheckoutHistory still shows every loan for reports
+
+# Closed checkouts returned more than this many days ago are archived
+archive_after_days = 365
+
+# Rows moved per transaction
+archive_batch_size = 5000
+
+# Seconds between automatic archive runs
+archive_interval = 24 * 3600
+
+# Last cust_id of the next batch, or NULL when nothing is left to move
+NEXT_BATCH_QUERY = """
+    SELECT MAX(cust_id) FROM (
+        SELECT cust_id FROM Checkouts
+        WHERE cust_id > ? AND return_date IS NOT NULL AND return_date < date('now', 'localtime', ?)
+        ORDER BY cust_id
+        LIMIT ?
+    )
+    """
+
+ARCHIVE_BATCH_QUERY = """
+    INSERT INTO CheckoutsArchive (cust_id, user_id, book_id, checkout_date, return_date, fine)
+    SELECT cust_id, user_id, book_id, checkout_date, return_date, fine
+    FROM Checkouts
+    WHERE cust_id > ? AND cust_id <= ? AND return_date IS NOT NULL AND return_date < date('now', 'localtime', ?)
+    """
+
+DELETE_BATCH_QUERY = """
+    DELETE FROM Checkouts
+    WHERE cust_id > ? AND cust_id <= ? AND return_date IS NOT NULL AND return_date < date('now', 'localtime', ?)
+    """
+
+# Moves one batch after cust_id after_id in one short transaction
+# Returns (rows moved, last cust_id looked at), the id is None when there was nothing to move
+def archive_batch(after_id, days = None, batch_size = None):
+    cutoff = f"-{archive_after_days if days is None else days} days"
+    batch_size = archive_batch_size if batch_size is None else batch_size
+
+    def work(conn):
+        last_id = conn.execute(NEXT_BATCH_QUERY, (after_id, cutoff, batch_size)).fetchone()[0]
+        if last_id is None:
+            return 0, None
+        moved = conn.execute(ARCHIVE_BATCH_QUERY, (after_id, last_id, cutoff)).rowcount
+        conn.execute(DELETE_BATCH_QUERY, (after_id, last_id, cutoff))
+        return moved, last_id
+
+    # Only returned loans move, so sessions caching open loans are left alone
+    return database.run_transaction(work, ("Checkouts", "CheckoutsArchive", "CheckoutHistory"), ("CheckoutsArchive",))
+
+# Archives every eligible checkout, a batch at a time, and returns the number moved
+def archive_checkouts(days = None, batch_size = None, progress = None):
+    return jobs.run_batches(lambda after_id: archive_batch(after_id, days, batch_size), 0, progress)
+
+
+# Background thread that archives on a fixed interval
+class Archiver(jobs.PeriodicJob):
+
+    def __init__(self, interval = None):
+        super().__init__(archive_checkouts, archive_interval if interval is None else interval, "archiving checkouts")
+
+
+def main(argv = None):
+    parser = jobs.batch_parser("Move old returned checkouts into the archive table", archive_batch_size)
+    parser.add_argument("--days", type = int, default = archive_after_days, help = "archive loans returned this many days ago")
+    args = parser.parse_args(argv)
+
+    moved = jobs.run_batch_command(args, lambda progress: archive_checkouts(args.days, args.batch_size, progress), "archived")
+    print(f"Archived {moved} checkouts")
+
+
+if __name__ == "__main__":
+    main()
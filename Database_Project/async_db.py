@@ -0,0 +1,80 @@
+import concurrent.futures
+import threading
+import database
+import jobs
+
+# Worker threads that run database calls, each keeps its own pooled connection
+worker_count = 4
+
+# Milliseconds between checks for finished tasks on the Tk thread
+poll_interval = 15
+
+workers = jobs.LazyExecutor(
+    lambda: concurrent.futures.ThreadPoolExecutor(max_workers = worker_count, thread_name_prefix = "db")
+)
+
+def get_executor():
+    return workers.get()
+
+def shutdown():
+    workers.shutdown()
+
+
+# Handle for one database call running in the background
+# Cancelling drops the result and interrupts the query if it is already running
+class Task:
+
+    def __init__(self):
+        self.future = None
+        self.cancelled = False
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def run(self, fn, args):
+        with self.lock:
+            if self.cancelled:
+                raise concurrent.futures.CancelledError()
+            self.conn = database.connect_db()
+        try:
+            return fn(*args)
+        finally:
+            with self.lock:
+                self.conn = None
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            if self.conn is not None:
+                self.conn.interrupt()
+        self.future.cancel()
+
+    def done(self):
+        return self.future.done()
+
+
+# Runs fn(*args) on a worker thread and returns a Task
+# on_done(result) or on_error(exception) is called later on the Tk thread through widget.after,
+# unless the task was cancelled first, and on_finally() is called after them either way
+def run_async(widget, fn, *args, on_done = None, on_error = None, on_finally = None):
+    task = Task()
+    task.future = get_executor().submit(task.run, fn, args)
+
+    def poll():
+        if not task.done():
+            widget.after(poll_interval, poll)
+            return
+        try:
+            if task.cancelled:
+                return
+            error = task.future.exception()
+            if error is None:
+                if on_done:
+                    on_done(task.future.result())
+            elif on_error:
+                on_error(error)
+        finally:
+            if on_finally:
+                on_finally()
+
+    widget.after(poll_interval, poll)
+    return task
@@ -0,0 +1,63 @@
+import argparse
+import database
+
+# Number of open checkouts for the book in the current row of Books
+OPEN_LOANS = """
+    (SELECT COUNT(*) FROM Checkouts
+     WHERE Checkouts.book_id = Books.book_id AND Checkouts.return_date IS NULL)
+    """
+
+# Copies set aside for holds waiting to be picked up
+READY_HOLDS = """
+    (SELECT COUNT(*) FROM Holds
+     WHERE Holds.book_id = Books.book_id AND Holds.ready_until IS NOT NULL)
+    """
+
+EXPECTED_AVAILABLE = f"MAX(Books.copies - {OPEN_LOANS} - {READY_HOLDS}, 0)"
+
+# Books whose available counter disagrees with their open checkouts and ready holds
+MISMATCH_QUERY = f"""
+    SELECT Books.book_id, Books.available, {EXPECTED_AVAILABLE} AS expected
+    FROM Books
+    WHERE Books.available IS NOT {EXPECTED_AVAILABLE}
+    """
+
+REPAIR_QUERY = f"""
+    UPDATE Books
+    SET available = {EXPECTED_AVAILABLE}
+    WHERE Books.available IS NOT {EXPECTED_AVAILABLE}
+    """
+
+# Returns (book_id, available, expected) for every book whose counter is wrong
+def check_availability():
+    return database.fetch_query(MISMATCH_QUERY, cache = False)
+
+# Recomputes every wrong counter from Checkouts and Holds in one pass
+# Returns the number of books that were fixed
+def repair_availability():
+    return database.run_transaction(
+        lambda conn: conn.execute(REPAIR_QUERY).rowcount,
+        ("Books",)
+    )
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Check Books.available against open checkouts and ready holds")
+    parser.add_argument("--db", default = database.db_name)
+    parser.add_argument("--repair", action = "store_true", help = "fix the counters that are wrong")
+    args = parser.parse_args(argv)
+
+    database.db_name = args.db
+    database.initialize_db()
+
+    mismatches = check_availability()
+    for book_id, available, expected in mismatches:
+        print(f"Book {book_id}: available {available}, expected {expected}")
+    if args.repair and mismatches:
+        print(f"Repaired {repair_availability()} books")
+    elif not mismatches:
+        print("All availability counters are consistent")
+
+
+if __name__ == "__main__":
+    main()
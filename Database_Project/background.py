@@ -0,0 +1,37 @@
+import archive
+import backup
+import branches
+import database
+import fines
+import holds
+import popularity
+
+# The periodic jobs every process serving the library runs, shared by main.py and server.py
+# Each branch keeps its own database file, so each gets its own set of jobs
+
+
+# Starts the jobs for the current branch and returns them
+# Snapshots are taken and pruned in one process only, so every other one passes snapshots = False
+def start_branch_jobs(snapshots = True):
+    jobs = [
+        fines.FineSweeper(),
+        archive.Archiver(),
+        holds.HoldSweeper(),
+        popularity.PopularityUpdater(),
+    ]
+    if snapshots:
+        jobs.append(backup.Snapshotter())
+    for job in jobs:
+        job.start()
+    return jobs
+
+# Starts the jobs once for each branch in branch_ids, every branch by default
+def start_background_jobs(branch_ids = None, snapshots = True):
+    jobs = []
+    for branch_id in branches.branch_ids() if branch_ids is None else branch_ids:
+        jobs.extend(database.in_branch(branch_id, start_branch_jobs, snapshots))
+    return jobs
+
+def stop_background_jobs(jobs):
+    for job in jobs:
+        job.stop()
@@ -0,0 +1,194 @@
+import argparse
+import datetime
+import logging
+import os
+import sqlite3
+import sys
+import time
+import urllib.parse
+import database
+import fines
+import jobs
+
+# Online backups and read-only snapshots of the live database, taken with sqlite3's backup API
+# The copy runs backup_pages pages per step with a pause in between, so the app keeps working,
+# and in WAL mode writers are never blocked by it
+# A write from another connection makes SQLite start the copy over, so once that has happened
+# max_restarts times the rest is copied in one step, which reads one consistent view of the file
+# Reports and exports in any process read the newest verified snapshot in database.snapshot_dir
+
+log = logging.getLogger("library.backup")
+
+# Pages copied per step and seconds between steps
+backup_pages = 1024
+step_pause = 0.005
+
+max_restarts = 3
+
+# Snapshots kept, older ones are deleted after each new one
+snapshot_keep = 24
+
+# Seconds between automatic snapshots
+snapshot_interval = 3600
+
+# Snapshots this process owns and may prune, the ones it took and any the Snapshotter found at startup
+# Run the Snapshotter in one process only, the server, see background.py
+owned = set()
+
+
+class BackupError(Exception):
+    pass
+
+
+class CopyRestarted(Exception):
+    pass
+
+# Copies every page of source into target, a step at a time
+def copy_database(source, target, pages = None):
+    restarts = 0
+    last_remaining = None
+
+    def progress(status, remaining, total):
+        nonlocal restarts, last_remaining
+        # Pages left going up means SQLite started over
+        if last_remaining is not None and remaining > last_remaining:
+            restarts += 1
+            if restarts > max_restarts:
+                raise CopyRestarted()
+        last_remaining = remaining
+        time.sleep(step_pause)
+
+    try:
+        source.backup(target, pages = backup_pages if pages is None else pages, progress = progress)
+    except CopyRestarted:
+        source.backup(target)
+
+def open_read_only(path):
+    return sqlite3.connect(f"file:{urllib.parse.quote(path)}?mode=ro", uri = True)
+
+def schema_matches(conn):
+    return database.get_schema_version(conn) == database.schema_version
+
+# Raises BackupError unless the file passes PRAGMA integrity_check and has the current schema
+# quick = True runs quick_check, which skips comparing indexes with their tables
+def verify(path, quick = False):
+    conn = open_read_only(path)
+    try:
+        check = "quick_check" if quick else "integrity_check"
+        try:
+            problems = [row[0] for row in conn.execute(f"PRAGMA {check}")]
+        except sqlite3.DatabaseError as e:
+            raise BackupError(f"{path} failed {check}: {e}")
+        if problems != ["ok"]:
+            raise BackupError(f"{path} failed {check}: {'; '.join(problems[:10])}")
+        if not schema_matches(conn):
+            raise BackupError(f"{path} has schema version {database.get_schema_version(conn)}, expected {database.schema_version}")
+    finally:
+        conn.close()
+
+# Writes a verified copy of the current branch's live database to path
+# The copy is made next to it and only renamed into place once it checks out
+def backup_to(path, pages = None, quick = False):
+    partial = path + ".partial"
+    if os.path.exists(partial):
+        os.remove(partial)
+    target = sqlite3.connect(partial)
+    try:
+        copy_database(database.connect_db(), target, pages)
+        # A snapshot is opened read-only, which it cannot be in WAL mode without its -shm file
+        target.execute("PRAGMA journal_mode = DELETE")
+    finally:
+        target.close()
+    try:
+        verify(partial, quick)
+    except BackupError:
+        os.remove(partial)
+        raise
+    os.replace(partial, path)
+
+# Makes path the snapshot reports and exports read from for the current branch
+def publish(path):
+    database.snapshot_names[database.branch_db_name()] = path
+
+# Deletes all but the newest snapshot_keep snapshots, only ever ones this process owns
+# and never the one it has published
+def prune():
+    published = database.snapshot_names.get(database.branch_db_name())
+    for path in database.list_snapshots()[:-snapshot_keep]:
+        if path not in owned or path == published:
+            continue
+        try:
+            os.chmod(path, 0o644)
+            os.remove(path)
+            owned.discard(path)
+        except OSError as e:
+            log.warning("Error removing snapshot %s: %s", path, e)
+
+# Takes a point-in-time read-only snapshot, publishes it and returns its path
+# Stored fines are refreshed first, so fine reports read from it are correct as of that moment
+def take_snapshot(pages = None, quick = False):
+    fines.refresh_fines()
+    os.makedirs(database.snapshot_dir, exist_ok = True)
+    stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+    path = os.path.join(database.snapshot_dir, f"{database.snapshot_prefix()}{stamp}.db")
+    backup_to(path, pages, quick)
+    os.chmod(path, 0o444)
+    owned.add(path)
+    publish(path)
+    prune()
+    return path
+
+
+# Background thread that takes a snapshot on a fixed interval
+# A snapshot left by an earlier run on the current schema is published straight away,
+# it was verified when it was taken, and the first new one waits until that one is an interval old
+# Snapshots left by earlier runs become this process's to prune
+class Snapshotter(jobs.PeriodicJob):
+
+    def __init__(self, interval = None):
+        super().__init__(take_snapshot, snapshot_interval if interval is None else interval, "taking snapshot")
+
+    def first_wait(self):
+        snapshots = database.list_snapshots()
+        owned.update(snapshots)
+        if not snapshots or not database.snapshot_usable(snapshots[-1]):
+            return 0
+        publish(snapshots[-1])
+        age = time.time() - os.path.getmtime(snapshots[-1])
+        return max(self.interval - age, 0)
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Back up the library database while it is in use")
+    parser.add_argument("--db", default = database.db_name)
+    parser.add_argument("--out", help = "write a backup to this file instead of taking a snapshot")
+    parser.add_argument("--verify", metavar = "PATH", help = "only check an existing backup or snapshot")
+    parser.add_argument("--quick", action = "store_true", help = "use quick_check instead of integrity_check")
+    parser.add_argument("--pages", type = int, default = backup_pages, help = "pages copied per step")
+    parser.add_argument("--prune", action = "store_true",
+                        help = "also prune snapshots left by earlier runs, when no Snapshotter is running")
+    args = parser.parse_args(argv)
+
+    database.db_name = args.db
+    try:
+        if args.verify:
+            verify(args.verify, args.quick)
+            print(f"{args.verify} is ok")
+            return
+        database.initialize_db()
+        started = time.perf_counter()
+        if args.out:
+            backup_to(args.out, args.pages, args.quick)
+            path = args.out
+        else:
+            if args.prune:
+                owned.update(database.list_snapshots())
+            path = take_snapshot(args.pages, args.quick)
+    except BackupError as e:
+        print(e, file = sys.stderr)
+        sys.exit(1)
+    print(f"Wrote {path} in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
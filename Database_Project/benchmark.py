@@ -0,0 +1,269 @@
+import argparse
+import datetime
+import json
+import os
+import random
+import subprocess
+import threading
+import sqlite3
+import sys
+import time
+import database
+import fines
+import passwords
+import reports
+import search
+import service
+
+# Rows inserted per transaction while generating data
+generate_batch_size = 100000
+
+WORDS = (
+    "river", "night", "garden", "shadow", "winter", "house", "secret", "ocean", "silver", "storm",
+    "kingdom", "glass", "forest", "letter", "empire", "summer", "stone", "journey", "island", "fire",
+    "memory", "crown", "tower", "harbor", "wolf", "lantern", "orchard", "mirror", "valley", "echo",
+)
+
+SURNAMES = (
+    "Smith", "Garcia", "Okafor", "Tanaka", "Novak", "Silva", "Kowalski", "Haddad", "Larsen", "Moreau",
+    "Ivanova", "Chen", "Murphy", "Rossi", "Nguyen", "Schmidt", "Kaur", "Popescu", "Adeyemi", "Lindqvist",
+)
+
+# Share of generated checkouts that are still open
+open_loan_ratio = 0.05
+
+
+def chunks(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def insert_rows(conn, query, rows):
+    for chunk in chunks(rows, generate_batch_size):
+        conn.execute("BEGIN")
+        conn.executemany(query, chunk)
+        conn.commit()
+
+# Every generated user has the same password, hashed once with the current passwords settings
+# Logins still verify a real hash, and hashing millions of users one by one would take hours
+benchmark_password = "benchmark password"
+
+def user_password(user_id):
+    return benchmark_password
+
+def generate_users(count):
+    password = passwords.hash_password(benchmark_password)
+    for user_id in range(1, count + 1):
+        yield (user_id, f"user{user_id}", f"user{user_id}@example.com", password, int(user_id == 1))
+
+def generate_books(count, rng):
+    for book_id in range(1, count + 1):
+        title = " ".join(rng.choice(WORDS).capitalize() for _ in range(rng.randint(1, 4)))
+        author = f"{rng.choice(WORDS).capitalize()} {rng.choice(SURNAMES)}"
+        copies = rng.randint(1, 5)
+        yield (book_id, title, author, f"{9780000000000 + book_id}", copies, copies)
+
+def generate_checkouts(count, users, books, rng):
+    today = datetime.date.today()
+    for _ in range(count):
+        checkout_date = today - datetime.timedelta(days = rng.randint(0, 730))
+        if rng.random() < open_loan_ratio:
+            return_date = None
+        else:
+            return_date = min(today, checkout_date + datetime.timedelta(days = rng.randint(1, 30))).isoformat()
+        yield (rng.randint(1, users), rng.randint(1, books), checkout_date.isoformat(), return_date)
+
+# Fills the current database with synthetic users, books and checkouts
+# Durability is relaxed while loading and the search index is rebuilt once at the end
+def generate(users, books, checkouts, seed = 0, progress = None):
+    rng = random.Random(seed)
+    conn = database.connect_db()
+    conn.execute("PRAGMA synchronous = OFF")
+    search_index = database.has_book_search(conn)
+    if search_index:
+        database.drop_book_search_triggers(conn)
+        conn.commit()
+
+    insert_rows(conn, "INSERT INTO Users (user_id, username, email, password, is_admin) VALUES (?, ?, ?, ?, ?)",
+                generate_users(users))
+    if progress:
+        progress(f"{users} users")
+    insert_rows(conn, "INSERT INTO Books (book_id, title, author, isbn, copies, available) VALUES (?, ?, ?, ?, ?, ?)",
+                generate_books(books, rng))
+    if progress:
+        progress(f"{books} books")
+    insert_rows(conn, "INSERT INTO Checkouts (user_id, book_id, checkout_date, return_date) VALUES (?, ?, ?, ?)",
+                generate_checkouts(checkouts, users, books, rng))
+    if progress:
+        progress(f"{checkouts} checkouts")
+
+    # Open loans take copies off the shelf, never more than a book has
+    conn.execute("""
+    UPDATE Books SET available = MAX(copies - (
+        SELECT COUNT(*) FROM Checkouts
+        WHERE Checkouts.book_id = Books.book_id AND Checkouts.return_date IS NULL
+    ), 0)
+    """)
+    if search_index:
+        database.create_book_search_triggers(conn)
+        database.rebuild_book_search(conn)
+    conn.commit()
+    conn.execute(f"PRAGMA synchronous = {database.pragmas['synchronous']}")
+    conn.execute("ANALYZE")
+    database.query_cache.clear()
+
+
+# Times fn over several iterations and returns latency percentiles in milliseconds
+def measure(fn, iterations):
+    timings = []
+    started = time.perf_counter()
+    for iteration in range(iterations):
+        start = time.perf_counter()
+        fn(iteration)
+        timings.append((time.perf_counter() - start) * 1000)
+    elapsed = time.perf_counter() - started
+    timings.sort()
+
+    def percentile(p):
+        return timings[min(len(timings) - 1, int(p / 100 * len(timings)))]
+
+    return {
+        "iterations": iterations,
+        "p50_ms": percentile(50),
+        "p95_ms": percentile(95),
+        "p99_ms": percentile(99),
+        "max_ms": timings[-1],
+        "throughput_per_s": iterations / elapsed if elapsed else 0.0,
+    }
+
+def table_count(table):
+    return database.fetch_query(f"SELECT COUNT(*) FROM {table}", cache = False)[0][0]
+
+# Runs each data-layer path the app uses and returns the timings by name
+def run_benchmarks(iterations, seed = 0, writers = 8, writes_per_thread = 25):
+    rng = random.Random(seed)
+    users = table_count("Users")
+    max_book = database.fetch_query("SELECT MAX(book_id) FROM Books", cache = False)[0][0]
+    loans = []
+
+    def login(iteration):
+        user_id = rng.randint(1, users)
+        service.authenticate(f"user{user_id}", user_password(user_id))
+
+    def title_search(iteration):
+        search.search_books(" ".join(rng.choice(WORDS)[:rng.randint(2, 6)] for _ in range(rng.randint(1, 2))))
+
+    def checkout(iteration):
+        user_id, book_id = rng.randint(1, users), rng.randint(1, max_book)
+        if database.checkout(user_id, book_id):
+            loans.append((user_id, book_id))
+
+    def return_book(iteration):
+        if loans:
+            database.return_book(*loans.pop())
+
+    # Checkouts and returns from several threads at once, timing each thread's whole run
+    def concurrent_writes(iteration):
+        def write(thread_rng):
+            for _ in range(writes_per_thread):
+                user_id, book_id = thread_rng.randint(1, users), thread_rng.randint(1, max_book)
+                if database.checkout(user_id, book_id):
+                    database.return_book(user_id, book_id)
+        threads = [threading.Thread(target = write, args = (random.Random(rng.random()),)) for _ in range(writers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def fine_refresh(iteration):
+        fines.refresh_fines()
+
+    def overdue_report(iteration):
+        for row in reports.iter_report("overdue"):
+            pass
+
+    operations = {
+        "login": (login, iterations),
+        "title_search": (title_search, iterations),
+        "checkout": (checkout, iterations),
+        "return": (return_book, iterations),
+        "concurrent_writes": (concurrent_writes, max(1, iterations // 50)),
+        "fine_refresh": (fine_refresh, max(1, iterations // 20)),
+        "overdue_report": (overdue_report, max(1, iterations // 20)),
+    }
+    results = {name: measure(fn, count) for name, (fn, count) in operations.items()}
+    stats = results["concurrent_writes"]
+    stats["checkouts_per_s"] = stats["throughput_per_s"] * writers * writes_per_thread
+    return results
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output = True, text = True,
+            cwd = os.path.dirname(os.path.abspath(__file__)), check = True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Benchmark the library data layer without a display")
+    parser.add_argument("--db", default = "benchmark.db")
+    parser.add_argument("--users", type = int, default = 1000)
+    parser.add_argument("--books", type = int, default = 10000)
+    parser.add_argument("--checkouts", type = int, default = 50000)
+    parser.add_argument("--iterations", type = int, default = 500)
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--no-cache", action = "store_true", help = "disable the query cache")
+    parser.add_argument("--group-commit", action = "store_true", help = "queue writes for group commit")
+    parser.add_argument("--writers", type = int, default = 8, help = "threads in the concurrent_writes run")
+    parser.add_argument("--output", help = "write results as JSON to this file")
+    parser.add_argument("--profile", action = "store_true", help = "print per-statement timings at the end")
+    parser.add_argument("--password-cost", type = int, default = 10,
+                        help = "scrypt cost (log2 n) for generated users and logins, see passwords.py for tuning")
+    args = parser.parse_args(argv)
+
+    database.db_name = args.db
+    database.cache_enabled = not args.no_cache
+    database.group_commit_enabled = args.group_commit
+    database.profiling_enabled = args.profile
+    passwords.scrypt_cost = args.password_cost
+    database.initialize_db()
+
+    if table_count("Books") == 0:
+        started = time.perf_counter()
+        generate(args.users, args.books, args.checkouts, args.seed,
+                 progress = lambda message: print(f"Generated {message}", file = sys.stderr))
+        print(f"Generated data in {time.perf_counter() - started:.1f}s", file = sys.stderr)
+
+    results = {
+        "commit": git_commit(),
+        "timestamp": datetime.datetime.now().isoformat(timespec = "seconds"),
+        "sqlite_version": sqlite3.sqlite_version,
+        "cache_enabled": database.cache_enabled,
+        "group_commit": database.group_commit_enabled,
+        "password_hash": f"{passwords.scheme} cost {passwords.default_cost(passwords.scheme)}",
+        "scale": {table.lower(): table_count(table) for table in ("Users", "Books", "Checkouts")},
+        "operations": run_benchmarks(args.iterations, args.seed, args.writers),
+    }
+
+    for name, stats in results["operations"].items():
+        print(f"{name:15} p50 {stats['p50_ms']:8.3f}ms  p95 {stats['p95_ms']:8.3f}ms  "
+              f"p99 {stats['p99_ms']:8.3f}ms  {stats['throughput_per_s']:10.1f}/s")
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent = 2)
+
+    if args.profile:
+        database.dump_query_stats(sys.stderr)
+    passwords.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+import argparse
+import concurrent.futures
+import heapq
+import itertools
+import json
+import database
+import jobs
+import models
+import search
+
+# Branches that each keep their own database file, see "Branches" in database.py
+# A user belongs to one branch, so their loans, holds and session never leave its file,
+# while the catalog can be searched across every branch at once
+# The search fans out on a thread pool, one pooled connection per branch file rather than
+# ATTACH on one connection, so the branches are read in parallel, and the per-branch
+# results, each already best first, are merged by rank
+
+# JSON object mapping branch ids to database files
+config_file = "branches.json"
+
+# Threads searching branches at the same time
+search_workers = 8
+
+workers = jobs.LazyExecutor(
+    lambda: concurrent.futures.ThreadPoolExecutor(max_workers = search_workers, thread_name_prefix = "branch-search")
+)
+
+def get_executor():
+    return workers.get()
+
+def shutdown():
+    workers.shutdown()
+
+# Sets up the branches in files, {branch_id: database file}
+# default is the branch used outside database.use_branch
+def configure(files, default = None):
+    if default is not None and default not in files:
+        raise ValueError(f"Unknown branch: {default}")
+    database.branch_files = dict(files)
+    database.default_branch = default
+
+# Reads the branch files from a JSON config file
+def load(path = None, default = None):
+    with open(path or config_file, encoding = "utf-8") as file:
+        files = json.load(file)
+    if not isinstance(files, dict):
+        raise ValueError(f"{path or config_file} must map branch ids to database files")
+    configure(files, default)
+
+# Every branch id, or just None with no branches set up
+def branch_ids():
+    return list(database.branch_files) or [None]
+
+# Searches the catalog of every branch in parallel, best matches first, as models.BranchBook records
+def search_all(text, limit = None):
+    limit = search.result_limit if limit is None else limit
+    ids = branch_ids()
+    futures = [get_executor().submit(database.in_branch, branch_id, search.ranked_search, text, limit) for branch_id in ids]
+    ranked = [
+        [(rank, position, branch_id, book) for position, (rank, book) in enumerate(future.result())]
+        for branch_id, future in zip(ids, futures)
+    ]
+    merged = heapq.merge(*ranked, key = lambda row: row[:2])
+    return [models.BranchBook(branch_id, *book) for rank, position, branch_id, book in itertools.islice(merged, limit)]
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Search the catalog of every branch")
+    parser.add_argument("text")
+    parser.add_argument("--config", default = config_file)
+    parser.add_argument("--limit", type = int, default = 20)
+    args = parser.parse_args(argv)
+
+    load(args.config)
+    try:
+        for book in search_all(args.text, args.limit):
+            print(f"{book.branch_id}  {book.book_id:8d}  {book.title} by {book.author}")
+    finally:
+        shutdown()
+
+
+if __name__ == "__main__":
+    main()
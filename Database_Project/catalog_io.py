@@ -0,0 +1,185 @@
+import argparse
+import csv
+import itertools
+import json
+import os
+import sys
+import database
+
+# Rows written per transaction
+batch_size = 50000
+
+FIELDS = ("title", "author", "isbn", "copies")
+
+# Changing the number of copies owned moves the available count by the same amount
+UPDATE_BY_ISBN_QUERY = """
+    UPDATE Books
+    SET title = ?, author = ?, available = MAX(available + ? - copies, 0), copies = ?
+    WHERE isbn = ?
+    """
+
+INSERT_NEW_ISBN_QUERY = """
+    INSERT INTO Books (title, author, isbn, copies, available)
+    SELECT ?, ?, ?, ?, ?
+    WHERE NOT EXISTS (SELECT 1 FROM Books WHERE isbn = ?)
+    """
+
+
+class ImportResult:
+
+    def __init__(self):
+        self.read = 0
+        self.loaded = 0
+        self.rejected = 0
+        self.errors = []
+
+    def reject(self, line, message):
+        self.rejected += 1
+        if len(self.errors) < 100:
+            self.errors.append(f"line {line}: {message}")
+
+
+def detect_format(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension in (".jsonl", ".ndjson", ".json"):
+        return "jsonl"
+    return "csv"
+
+# Yields (line number, record dict) pairs without loading the whole file
+def read_records(file, file_format):
+    if file_format == "jsonl":
+        for line_number, line in enumerate(file, start = 1):
+            line = line.strip()
+            if line:
+                try:
+                    yield line_number, json.loads(line)
+                except ValueError as e:
+                    yield line_number, e
+    else:
+        for line_number, record in enumerate(csv.DictReader(file), start = 2):
+            yield line_number, record
+
+# Returns a (title, author, isbn, copies) tuple or raises ValueError
+def validate(record):
+    if not isinstance(record, dict):
+        raise ValueError(f"not a record: {record}")
+    title = str(record.get("title") or "").strip()
+    author = str(record.get("author") or "").strip()
+    isbn = str(record.get("isbn") or "").strip()
+    if not title or not author or not isbn:
+        raise ValueError("title, author and isbn are required")
+    copies = record.get("copies")
+    copies = 1 if copies in (None, "") else int(copies)
+    if copies <= 0:
+        raise ValueError("copies must be a positive integer")
+    return title, author, isbn, copies
+
+# Updates books whose isbn already exists and inserts the rest, in one transaction
+# Committed without syncing, an interrupted import can simply be run again
+def upsert_batch(rows):
+    def work(conn):
+        conn.executemany(UPDATE_BY_ISBN_QUERY, ((title, author, copies, copies, isbn) for title, author, isbn, copies in rows))
+        conn.executemany(INSERT_NEW_ISBN_QUERY, ((title, author, isbn, copies, copies, isbn) for title, author, isbn, copies in rows))
+    database.run_transaction(work, ("Books", "BooksSearch"), durable = False)
+
+# Streams a CSV or JSON Lines file into Books, upserting by isbn
+# The full-text triggers are dropped during the load and the index is rebuilt once at the end
+# idx_books_isbn stays live, every upsert looks its isbn up in it, and Books has no other secondary index
+# If the process is killed before then, database.initialize_db puts them back on the next start
+def import_books(path, file_format = None, defer_search_index = True, progress = None):
+    file_format = file_format or detect_format(path)
+    result = ImportResult()
+    conn = database.connect_db()
+    defer = defer_search_index and database.has_book_search(conn)
+
+    if defer:
+        database.run_transaction(database.drop_book_search_triggers)
+    try:
+        with open(path, newline = "", encoding = "utf-8") as file:
+            records = read_records(file, file_format)
+            while True:
+                chunk = list(itertools.islice(records, batch_size))
+                if not chunk:
+                    break
+                rows = {}
+                for line_number, record in chunk:
+                    result.read += 1
+                    try:
+                        if isinstance(record, Exception):
+                            raise ValueError(record)
+                        row = validate(record)
+                        # A later row for the same isbn replaces an earlier one
+                        rows[row[2]] = row
+                    except (TypeError, ValueError) as e:
+                        result.reject(line_number, e)
+                if rows:
+                    upsert_batch(list(rows.values()))
+                result.loaded += len(rows)
+                if progress:
+                    progress(result)
+    finally:
+        if defer:
+            def restore(conn):
+                database.create_book_search_triggers(conn)
+                database.rebuild_book_search(conn)
+            database.run_transaction(restore, ("BooksSearch",))
+    return result
+
+# Streams every book to a CSV or JSON Lines file in book_id order
+# Reads the latest snapshot when one has been published
+def export_books(path, file_format = None, progress = None):
+    file_format = file_format or detect_format(path)
+    conn = database.connect_snapshot()
+    cursor = conn.execute("SELECT title, author, isbn, copies FROM Books ORDER BY book_id")
+    exported = 0
+    with open(path, "w", newline = "", encoding = "utf-8") as file:
+        if file_format == "csv":
+            writer = csv.writer(file)
+            writer.writerow(FIELDS)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            if file_format == "csv":
+                writer.writerows(rows)
+            else:
+                file.writelines(json.dumps(dict(zip(FIELDS, row))) + "\n" for row in rows)
+            exported += len(rows)
+            if progress:
+                progress(exported)
+    return exported
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Bulk import or export the book catalog")
+    parser.add_argument("command", choices = ("import", "export"))
+    parser.add_argument("path")
+    parser.add_argument("--format", choices = ("csv", "jsonl"))
+    parser.add_argument("--db", default = database.db_name)
+    parser.add_argument("--no-defer", action = "store_true", help = "keep full-text triggers active during import")
+    parser.add_argument("--snapshot", help = "export from this snapshot instead of the database, see backup.py")
+    args = parser.parse_args(argv)
+
+    database.db_name = args.db
+    if args.snapshot:
+        database.snapshot_names[args.db] = args.snapshot
+    database.initialize_db()
+
+    if args.command == "import":
+        result = import_books(
+            args.path, args.format, not args.no_defer,
+            progress = lambda result: print(f"{result.loaded} loaded, {result.rejected} rejected", file = sys.stderr)
+        )
+        for error in result.errors:
+            print(error, file = sys.stderr)
+        print(f"Imported {result.loaded} books ({result.rejected} rejected)")
+    else:
+        count = export_books(
+            args.path, args.format,
+            progress = lambda count: print(f"{count} exported", file = sys.stderr)
+        )
+        print(f"Exported {count} books")
+
+
+if __name__ == "__main__":
+    main()
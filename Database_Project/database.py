@@ -1,13 +1,516 @@
+import collections
+import concurrent.futures
+import contextlib
+import logging
+import os
+import random
+import re
 import sqlite3
+import sys
+import threading
+import time
+import urllib.parse
+import weakref
 
 db_name = "library.db"
 
+log = logging.getLogger("library.database")
+
+# PRAGMAs applied to every pooled connection when it is opened
+# journal_mode WAL lets readers run alongside a writer
+pragmas = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -16000,
+    "mmap_size": 268435456,
+}
+
+# Number of prepared statements sqlite3 keeps cached per connection
+statement_cache_size = 256
+
+
+# One thread's connections, by database file, and the file each role currently uses
+class ThreadConnections:
+    __slots__ = ("conns", "current", "__weakref__")
+
+    def __init__(self):
+        self.conns = {}
+        self.current = {}
+
+
+# Keeps one long-lived connection per thread and database file
+# sqlite3 connections cannot be shared across threads by default,
+# so each thread gets its own and reuses it on every call
+# A thread's connections are closed when the thread ends and its thread-local state goes away
+class ConnectionPool:
+
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # Connections of every live thread, keyed by id of the thread's ThreadConnections
+        self.threads = {}
+
+    def thread_connections(self):
+        held = getattr(self.local, "held", None)
+        if held is None:
+            held = self.local.held = ThreadConnections()
+            with self.lock:
+                self.threads[id(held)] = held.conns
+            weakref.finalize(held, self.release, id(held), held.conns)
+        return held
+
+    def release(self, key, conns):
+        with self.lock:
+            self.threads.pop(key, None)
+        for conn in list(conns.values()):
+            close_quietly(conn)
+
+    def get(self, name):
+        conns = self.thread_connections().conns
+        conn = conns.get(name)
+        if conn is None:
+            conn = self.open(name)
+            conns[name] = conn
+        return conn
+
+    # Number of open connections across all threads
+    def size(self):
+        with self.lock:
+            return sum(len(conns) for conns in self.threads.values())
+
+    # name may be a file: URI, such as a read-only snapshot opened with mode=ro
+    def open(self, name):
+        uri = name.startswith("file:")
+        read_only = uri and "mode=ro" in name
+        conn = sqlite3.connect(name, cached_statements = statement_cache_size, check_same_thread = False, uri = uri)
+        for pragma, value in pragmas.items():
+            # A read-only file keeps the journal mode it was written with
+            if read_only and pragma == "journal_mode":
+                continue
+            conn.execute(f"PRAGMA {pragma} = {value}")
+        return conn
+
+    # Like get, for a role whose file changes over time, such as the latest snapshot
+    # The thread's connection to the file the role used before is closed
+    def get_current(self, role, name):
+        held = self.thread_connections()
+        previous = held.current.get(role)
+        if previous is not None and previous != name:
+            conn = held.conns.pop(previous, None)
+            if conn is not None:
+                close_quietly(conn)
+        held.current[role] = name
+        return self.get(name)
+
+    # Closes every connection opened by any thread
+    def close_all(self):
+        with self.lock:
+            threads = list(self.threads.values())
+            self.threads = {}
+        for conns in threads:
+            for conn in list(conns.values()):
+                close_quietly(conn)
+            conns.clear()
+        self.local = threading.local()
+
+
+def close_quietly(conn):
+    try:
+        conn.close()
+    except sqlite3.ProgrammingError:
+        pass
+
+
+pool = ConnectionPool()
+
+# Branches
+# Each branch can keep its catalog, users and loans in a file of its own, so branches
+# do not queue behind one write lock; branch_files maps branch ids to those files
+# A thread works in one branch at a time, chosen with use_branch, and everything in this
+# module reads and writes that branch's file; outside use_branch it is default_branch,
+# and with no branches set up it is always db_name
+branch_files = {}
+default_branch = None
+branch_context = threading.local()
+
+def current_branch():
+    branch_id = getattr(branch_context, "branch_id", None)
+    return default_branch if branch_id is None else branch_id
+
+# File for a branch, the current one when branch_id is None
+# Raises ValueError for a branch that is not set up
+def branch_db_name(branch_id = None):
+    branch_id = current_branch() if branch_id is None else branch_id
+    if branch_id is None:
+        return db_name
+    try:
+        return branch_files[branch_id]
+    except KeyError:
+        raise ValueError(f"Unknown branch: {branch_id}")
+
+# None is the default branch
+@contextlib.contextmanager
+def use_branch(branch_id):
+    previous = getattr(branch_context, "branch_id", None)
+    branch_context.branch_id = branch_id
+    try:
+        yield
+    finally:
+        branch_context.branch_id = previous
+
+# Calls fn(*args) in a branch, for handing work to thread pools
+def in_branch(branch_id, fn, *args):
+    with use_branch(branch_id):
+        return fn(*args)
+
+# The schema is checked the first time each database file is used
+def open_db(name):
+    if name not in initialized:
+        initialize_db(name)
+    return pool.get(name)
+
 def connect_db():
-    conn = sqlite3.connect(db_name)
-    return conn
+    return open_db(branch_db_name())
 
-def initialize_db():
-    conn = connect_db()
+def close_db():
+    stop_writers()
+    pool.close_all()
+
+# Read-only snapshots that reports and exports read instead of the live files, see backup.py
+# Whichever process takes them, they are found in snapshot_dir by name, <file>-<YYYYmmdd-HHMMSS>.db,
+# and a file only gets that name once backup.take_snapshot has verified it
+# snapshot_names pins a file to one snapshot instead, keyed by the file it was taken from
+# A pinned snapshot that has since been deleted is skipped, and with none on disk the live file is read
+snapshot_dir = "snapshots"
+snapshot_names = {}
+
+# Snapshot files already checked for the current schema, and whether they have it
+usable_snapshots = {}
+
+def snapshot_prefix(name = None):
+    return os.path.splitext(os.path.basename(branch_db_name() if name is None else name))[0] + "-"
+
+# Snapshot files of the current branch, oldest first
+def list_snapshots():
+    if not os.path.isdir(snapshot_dir):
+        return []
+    pattern = re.compile(re.escape(snapshot_prefix()) + r"\d{8}-\d{6}\.db")
+    names = sorted(name for name in os.listdir(snapshot_dir) if pattern.fullmatch(name))
+    return [os.path.join(snapshot_dir, name) for name in names]
+
+# A snapshot from before a migration would be missing columns the queries need
+def snapshot_usable(path):
+    usable = usable_snapshots.get(path)
+    if usable is None:
+        try:
+            conn = sqlite3.connect(f"file:{urllib.parse.quote(path)}?mode=ro", uri = True)
+            try:
+                usable = get_schema_version(conn) == schema_version
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            return False
+        usable_snapshots[path] = usable
+    return usable
+
+def current_snapshot():
+    name = snapshot_names.get(branch_db_name())
+    if name is not None and os.path.exists(name):
+        return name
+    for path in reversed(list_snapshots()):
+        if os.path.exists(path) and snapshot_usable(path):
+            return path
+    return None
+
+def connect_snapshot():
+    name = current_snapshot()
+    if name is None:
+        return connect_db()
+    return pool.get_current(("snapshot", branch_db_name()), f"file:{urllib.parse.quote(name)}?mode=ro")
+
+# Checks whether this SQLite build was compiled with FTS5
+def fts5_available(conn):
+    try:
+        conn.execute("CREATE VIRTUAL TABLE temp.fts5_probe USING fts5(x)")
+        conn.execute("DROP TABLE temp.fts5_probe")
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+BOOK_SEARCH_TRIGGERS = {
+    "books_search_insert": """
+    CREATE TRIGGER IF NOT EXISTS books_search_insert AFTER INSERT ON Books BEGIN
+        INSERT INTO BooksSearch (rowid, title, author, isbn)
+        VALUES (new.book_id, new.title, new.author, new.isbn);
+    END
+    """,
+    "books_search_delete": """
+    CREATE TRIGGER IF NOT EXISTS books_search_delete AFTER DELETE ON Books BEGIN
+        INSERT INTO BooksSearch (BooksSearch, rowid, title, author, isbn)
+        VALUES ('delete', old.book_id, old.title, old.author, old.isbn);
+    END
+    """,
+    "books_search_update": """
+    CREATE TRIGGER IF NOT EXISTS books_search_update AFTER UPDATE OF title, author, isbn ON Books BEGIN
+        INSERT INTO BooksSearch (BooksSearch, rowid, title, author, isbn)
+        VALUES ('delete', old.book_id, old.title, old.author, old.isbn);
+        INSERT INTO BooksSearch (rowid, title, author, isbn)
+        VALUES (new.book_id, new.title, new.author, new.isbn);
+    END
+    """,
+}
+
+def has_book_search(conn):
+    row = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'BooksSearch'"
+    ).fetchone()
+    return row is not None
+
+def create_book_search_triggers(conn):
+    for trigger in BOOK_SEARCH_TRIGGERS.values():
+        conn.execute(trigger)
+
+# Bulk loads drop the triggers and rebuild the index once at the end
+def drop_book_search_triggers(conn):
+    for name in BOOK_SEARCH_TRIGGERS:
+        conn.execute(f"DROP TRIGGER IF EXISTS {name}")
+
+def rebuild_book_search(conn):
+    conn.execute("INSERT INTO BooksSearch (BooksSearch) VALUES ('rebuild')")
+
+def missing_book_search_triggers(conn):
+    if not has_book_search(conn):
+        return []
+    present = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'")}
+    return [name for name in BOOK_SEARCH_TRIGGERS if name not in present]
+
+# An import killed part way through leaves the triggers dropped and the index stale
+# Puts the triggers back and rebuilds the index, under the write lock so only one process does it
+def repair_book_search(conn):
+    if not missing_book_search_triggers(conn):
+        return False
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if not missing_book_search_triggers(conn):
+            conn.rollback()
+            return False
+        create_book_search_triggers(conn)
+        rebuild_book_search(conn)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    log.warning("Restored the book search triggers left behind by an interrupted import")
+    return True
+
+# Full-text index over Books kept in sync by triggers
+# Skipped on builds without FTS5, search.py then falls back to LIKE
+def create_book_search(conn):
+    if not fts5_available(conn):
+        return
+    conn.execute("""
+    CREATE VIRTUAL TABLE IF NOT EXISTS BooksSearch USING fts5(
+                   title, author, isbn,
+                   content = 'Books', content_rowid = 'book_id',
+                   prefix = '2 3'
+                   )
+                   """)
+    create_book_search_triggers(conn)
+    rebuild_book_search(conn)
+
+# Splits Books.copies into total copies owned and an available counter
+# Until now copies was decremented on checkout, so it held the shelf count
+# The backfill only runs when the column is added here, it would count open loans twice otherwise
+def add_available_counter(conn):
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(Books)")]
+    if "available" not in columns:
+        conn.execute("ALTER TABLE Books ADD COLUMN available INTEGER")
+        conn.execute("""
+        UPDATE Books
+        SET available = copies,
+            copies = copies + (
+                SELECT COUNT(*) FROM Checkouts
+                WHERE Checkouts.book_id = Books.book_id AND Checkouts.return_date IS NULL
+            )
+        """)
+    # Books inserted without an available count start with every copy on the shelf
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS books_available_default AFTER INSERT ON Books
+    WHEN new.available IS NULL BEGIN
+        UPDATE Books SET available = new.copies WHERE book_id = new.book_id;
+    END
+    """)
+
+# Schema migrations, applied in order on top of the base tables
+# Each entry is a list of SQL statements or a function taking the connection
+# The position in the list (starting at 1) is the schema version,
+# tracked in the database file with PRAGMA user_version
+migrations = [
+    # 1: indexes for the login, open-loan and overdue report lookups
+    [
+        """
+        CREATE INDEX IF NOT EXISTS idx_users_login
+        ON Users (username, password, user_id, is_admin)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_checkouts_open_user
+        ON Checkouts (user_id, book_id) WHERE return_date IS NULL
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_checkouts_open_book
+        ON Checkouts (book_id, user_id) WHERE return_date IS NULL
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_checkouts_open_fine
+        ON Checkouts (fine) WHERE return_date IS NULL
+        """,
+    ],
+    # 2: full-text search over title, author and isbn
+    create_book_search,
+    # 3: isbn lookups for catalog imports
+    [
+        "CREATE INDEX IF NOT EXISTS idx_books_isbn ON Books (isbn)",
+    ],
+    # 4: available copies counter
+    add_available_counter,
+    # 5: indexes for the aggregate reports
+    [
+        "CREATE INDEX IF NOT EXISTS idx_checkouts_book ON Checkouts (book_id)",
+        """
+        CREATE INDEX IF NOT EXISTS idx_checkouts_open_date
+        ON Checkouts (checkout_date, fine) WHERE return_date IS NULL
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_checkouts_fined_user
+        ON Checkouts (user_id, fine) WHERE return_date IS NULL AND fine > 0
+        """,
+    ],
+    # 6: archive for old closed checkouts, see archive.py, and a view over both tables
+    [
+        """
+        CREATE TABLE IF NOT EXISTS CheckoutsArchive (
+            cust_id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            book_id INTEGER NOT NULL,
+            checkout_date DATE,
+            return_date DATE NOT NULL,
+            fine REAL DEFAULT 0
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_archive_user ON CheckoutsArchive (user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_archive_book ON CheckoutsArchive (book_id)",
+        """
+        CREATE VIEW IF NOT EXISTS CheckoutHistory AS
+        SELECT cust_id, user_id, book_id, checkout_date, return_date, fine FROM Checkouts
+        UNION ALL
+        SELECT cust_id, user_id, book_id, checkout_date, return_date, fine FROM CheckoutsArchive
+        """,
+    ],
+    # 7: popularity and "also borrowed" tables kept up to date by popularity.py
+    [
+        """
+        CREATE TABLE IF NOT EXISTS BookBorrowsDaily (
+            book_id INTEGER NOT NULL,
+            day DATE NOT NULL,
+            borrows INTEGER NOT NULL,
+            PRIMARY KEY (book_id, day)
+        ) WITHOUT ROWID
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_borrows_day ON BookBorrowsDaily (day, book_id)",
+        """
+        CREATE TABLE IF NOT EXISTS BookPopularity (
+            book_id INTEGER PRIMARY KEY,
+            score INTEGER NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_popularity_score ON BookPopularity (score DESC, book_id)",
+        """
+        CREATE TABLE IF NOT EXISTS AlsoBorrowed (
+            book_id INTEGER NOT NULL,
+            other_id INTEGER NOT NULL,
+            together INTEGER NOT NULL,
+            PRIMARY KEY (book_id, other_id)
+        ) WITHOUT ROWID
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_also_borrowed_rank ON AlsoBorrowed (book_id, together DESC, other_id)",
+        """
+        CREATE TABLE IF NOT EXISTS PopularityState (
+            name TEXT PRIMARY KEY,
+            value
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_checkouts_user ON Checkouts (user_id, cust_id, book_id)",
+        "CREATE INDEX IF NOT EXISTS idx_archive_user_history ON CheckoutsArchive (user_id, cust_id, book_id)",
+        "DROP INDEX IF EXISTS idx_archive_user",
+    ],
+    # 8: hold queues, one per book in order of position
+    # ready_until is set once a returned copy has been set aside for the hold
+    [
+        """
+        CREATE TABLE IF NOT EXISTS Holds (
+            hold_id INTEGER PRIMARY KEY,
+            book_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            placed_date DATE DEFAULT CURRENT_DATE,
+            ready_until DATE
+        )
+        """,
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_holds_queue ON Holds (book_id, position)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_holds_user ON Holds (user_id, book_id)",
+        "CREATE INDEX IF NOT EXISTS idx_holds_ready ON Holds (ready_until) WHERE ready_until IS NOT NULL",
+    ],
+]
+
+schema_version = len(migrations)
+
+def get_schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+# Applies every migration newer than the file's user_version
+# Each migration runs in its own transaction together with the version bump
+# The write lock is taken before the version is read, so when several processes start at once
+# a migration another one has just applied is skipped instead of run twice
+def migrate(conn):
+    for version, statements in enumerate(migrations, start = 1):
+        if version <= get_schema_version(conn):
+            continue
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if version <= get_schema_version(conn):
+                conn.rollback()
+                continue
+            if callable(statements):
+                statements(conn)
+            else:
+                for statement in statements:
+                    conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return get_schema_version(conn)
+
+# Database files whose schema is known to be current in this process
+initialized = set()
+initialize_lock = threading.Lock()
+
+# Creates the tables and applies migrations, once per file and process
+# A file whose user_version is already current costs one PRAGMA read, a trigger check and no DDL
+# name defaults to the current branch's file
+def initialize_db(name = None):
+    name = branch_db_name() if name is None else name
+    with initialize_lock:
+        if name in initialized:
+            return
+        conn = pool.get(name)
+        if get_schema_version(conn) < schema_version:
+            create_tables(conn)
+        repair_book_search(conn)
+        initialized.add(name)
+
+def create_tables(conn):
     cursor = conn.cursor()
 
     cursor.execute("""
@@ -43,18 +546,93 @@ def initialize_db():
                    );
                    """)
     
-
     conn.commit()
-    conn.close()
+    migrate(conn)
+
+# Query instrumentation, off by default
+# When off, the only cost per statement is checking profiling_enabled
+profiling_enabled = False
+slow_query_threshold = 0.1
+explain_slow_queries = False
+slow_query_log = logging.getLogger("library.slow_queries")
+
+# Functions called as hook(query, elapsed_seconds, row_count) after each timed statement
+# Parameter values are never passed on so passwords stay out of logs
+query_hooks = []
+
+query_stats_lock = threading.Lock()
+statement_stats = {}
+
+def record_query(query, elapsed, rows, conn = None):
+    text = " ".join(query.split())
+    with query_stats_lock:
+        stats = statement_stats.get(text)
+        if stats is None:
+            stats = statement_stats[text] = {"count": 0, "total_s": 0.0, "max_s": 0.0, "rows": 0, "slow": 0}
+        stats["count"] += 1
+        stats["total_s"] += elapsed
+        stats["max_s"] = max(stats["max_s"], elapsed)
+        stats["rows"] += max(rows, 0)
+        if elapsed >= slow_query_threshold:
+            stats["slow"] += 1
+
+    for hook in query_hooks:
+        hook(text, elapsed, rows)
+
+    if elapsed >= slow_query_threshold:
+        message = f"Slow query ({elapsed * 1000:.1f} ms, {rows} rows): {text}"
+        if explain_slow_queries and conn is not None and text.upper().startswith(("SELECT", "WITH", "UPDATE", "DELETE", "INSERT")):
+            try:
+                message += "\n  plan: " + "; ".join(explain_query(query, conn))
+            except sqlite3.Error:
+                pass
+        slow_query_log.warning(message)
+
+# Runs one statement and returns its rows, timing it when profiling is on
+# row_factory, such as models.book_row, builds each row instead of a plain tuple
+def run_statement(conn, query, parameters = (), row_factory = None):
+    start = time.perf_counter() if profiling_enabled else 0
+    cursor = conn.execute(query, parameters)
+    if row_factory is not None:
+        cursor.row_factory = row_factory
+    rows = cursor.fetchall()
+    if profiling_enabled:
+        record_query(query, time.perf_counter() - start, len(rows), conn)
+    return rows
+
+# Per-statement totals since the last reset, slowest total first
+def query_stats():
+    with query_stats_lock:
+        items = [(text, dict(stats)) for text, stats in statement_stats.items()]
+    for text, stats in items:
+        stats["avg_s"] = stats["total_s"] / stats["count"]
+    return dict(sorted(items, key = lambda item: item[1]["total_s"], reverse = True))
+
+def reset_query_stats():
+    with query_stats_lock:
+        statement_stats.clear()
+
+def dump_query_stats(file = None):
+    file = file or sys.stdout
+    for text, stats in query_stats().items():
+        print(f"{stats['count']:8d} calls  {stats['total_s'] * 1000:10.1f} ms total  "
+              f"{stats['avg_s'] * 1000:8.3f} ms avg  {stats['max_s'] * 1000:8.3f} ms max  "
+              f"{stats['rows']:8d} rows  {stats['slow']:4d} slow  {text[:120]}", file = file)
 
 def execute_query(query, parameters = ()):
     try:
-        print(f"Executing Query: {query} with Parameters: {parameters}")
+        if group_commit_enabled:
+            run_transaction(lambda conn: run_statement(conn, query, parameters), written_tables(query))
+            return
         conn = connect_db()
-        cursor = conn.cursor()
-        cursor.execute(query, parameters)
-        conn.commit()
-        conn.close()
+        start = time.perf_counter() if profiling_enabled else 0
+        with conn:
+            cursor = conn.execute(query, parameters)
+        if profiling_enabled:
+            record_query(query, time.perf_counter() - start, cursor.rowcount, conn)
+        tables = written_tables(query)
+        query_cache.invalidate(tables)
+        bump_versions(tables)
     except sqlite3.IntegrityError as e:
         print(f"Database Integrity Error: {e}")  # Handle unique constraints for username and email
         raise
@@ -63,12 +641,604 @@ def execute_query(query, parameters = ()):
         raise
     
 
-def fetch_query(query, parameters = ()):
+# Reads go through the query cache unless cache is False
+# Pass cache = False for queries whose parameters should not be kept in memory, such as passwords
+# snapshot = True reads the current snapshot, if there is one, and is never cached
+def fetch_query(query, parameters = (), cache = True, row_factory = None, snapshot = False):
+    conn = connect_snapshot() if snapshot else connect_db()
+    if not cache or not cache_enabled or snapshot:
+        return run_statement(conn, query, parameters, row_factory)
+    return query_cache.fetch(conn, query, tuple(parameters), row_factory, branch_db_name())
+
+# Yields rows a batch at a time so large results never sit in memory at once
+# Streams straight from the cursor and bypasses the cache
+# When profiling, the time recorded covers fetching but not the caller's work between batches
+def iter_query(query, parameters = (), batch_size = 1000, snapshot = False):
+    conn = connect_snapshot() if snapshot else connect_db()
+    elapsed = 0.0
+    count = 0
+    start = time.perf_counter() if profiling_enabled else 0
+    cursor = conn.execute(query, parameters)
+    try:
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if profiling_enabled:
+                elapsed += time.perf_counter() - start
+                count += len(rows)
+            if not rows:
+                return
+            yield from rows
+            start = time.perf_counter() if profiling_enabled else 0
+    finally:
+        cursor.close()
+        if profiling_enabled:
+            record_query(query, elapsed, count, conn)
+
+
+# Query cache settings
+cache_enabled = True
+cache_size = 512
+cache_ttl = 60
+
+# Writes to a table also change the tables listed here, through triggers or a view
+table_dependencies = {
+    "Books": {"BooksSearch"},
+    "Checkouts": {"CheckoutHistory"},
+    "CheckoutsArchive": {"CheckoutHistory"},
+}
+
+READ_TABLES_PATTERN = re.compile(r"\b(?:FROM|JOIN)\s+([A-Za-z_][A-Za-z0-9_]*)", re.IGNORECASE)
+WRITE_TABLES_PATTERN = re.compile(r"\b(?:INSERT\s+(?:OR\s+\w+\s+)?INTO|REPLACE\s+INTO|UPDATE(?:\s+OR\s+\w+)?|DELETE\s+FROM)\s+([A-Za-z_][A-Za-z0-9_]*)", re.IGNORECASE)
+
+def read_tables(query):
+    return frozenset(READ_TABLES_PATTERN.findall(query))
+
+# The tables along with every table that changes when they are written
+def with_dependencies(tables):
+    tables = set(tables)
+    for table in list(tables):
+        tables |= table_dependencies.get(table, set())
+    return tables
+
+def written_tables(query):
+    return with_dependencies(WRITE_TABLES_PATTERN.findall(query))
+
+
+# LRU cache of query results keyed by query text and parameters
+# Entries expire after ttl seconds and are dropped as soon as a table they read is written
+class QueryCache:
+
+    def __init__(self, size = None, ttl = None):
+        self.size = cache_size if size is None else size
+        self.ttl = cache_ttl if ttl is None else ttl
+        self.entries = collections.OrderedDict()
+        self.by_table = collections.defaultdict(set)
+        self.generations = collections.defaultdict(int)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    # Entries are kept per database file, name, while table generations are shared,
+    # so a write in one branch also drops that table's entries for the others
+    def fetch(self, conn, query, parameters, row_factory = None, name = None):
+        key = (name, query, parameters, row_factory)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return list(entry[2])
+            self.misses += 1
+            tables = entry[1] if entry is not None else read_tables(query)
+            generations = [self.generations[table] for table in tables]
+
+        rows = run_statement(conn, query, parameters, row_factory)
+
+        with self.lock:
+            # Skip storing if a write landed while the query was running
+            if generations == [self.generations[table] for table in tables]:
+                self.store(key, tables, rows, now + self.ttl)
+        return rows
+
+    def store(self, key, tables, rows, expires):
+        self.discard(key)
+        self.entries[key] = (expires, tables, tuple(rows))
+        for table in tables:
+            self.by_table[table].add(key)
+        while len(self.entries) > self.size:
+            self.discard(next(iter(self.entries)))
+            self.evictions += 1
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            for table in entry[1]:
+                self.by_table[table].discard(key)
+
+    # Drops every entry that reads one of the tables or a table depending on them,
+    # or everything when tables is None
+    def invalidate(self, tables = None):
+        with self.lock:
+            if tables is None:
+                self.invalidations += len(self.entries)
+                for table in list(self.generations):
+                    self.generations[table] += 1
+                self.entries.clear()
+                self.by_table.clear()
+                return
+            for table in with_dependencies(tables):
+                self.generations[table] += 1
+                for key in list(self.by_table.pop(table, ())):
+                    self.discard(key)
+                    self.invalidations += 1
+
+    def clear(self):
+        self.invalidate()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "entries": len(self.entries),
+            }
+
+
+query_cache = QueryCache()
+
+def cache_stats():
+    return query_cache.stats()
+
+
+# Version stamps for data kept outside the query cache, such as sessions
+# Writes through this module bump the stamp of every table they touch,
+# unless they name narrower keys, like checkout bumping ("loans", user_id)
+# The None key is bumped by writes to unknown tables and is part of every stamp
+versions = collections.defaultdict(int)
+versions_lock = threading.Lock()
+
+def bump_versions(keys = None):
+    with versions_lock:
+        for key in (None,) if keys is None else keys:
+            versions[key] += 1
+
+# Read the stamp before the data it covers, so a write in between leaves it stale
+def version_stamp(*keys):
+    with versions_lock:
+        return (versions[None],) + tuple(versions[key] for key in keys)
+
+# Queries issued by the application that must be served by an index
+# check_query_plans runs EXPLAIN QUERY PLAN over these
+# The stored password hash comes back so it can be checked outside SQL
+LOGIN_QUERY = "SELECT user_id, is_admin, password FROM Users WHERE username = ?"
+
+# Fine owed on an open checkout as of today
+# $10 once a book is past its two week due date, then $1 for every additional day late
+FINE_EXPRESSION = """
+    CASE
+        WHEN Checkouts.checkout_date IS NULL THEN 0
+        WHEN julianday(date('now', 'localtime')) - julianday(Checkouts.checkout_date) <= 14 THEN 0
+        ELSE julianday(date('now', 'localtime')) - julianday(Checkouts.checkout_date) - 5
+    END
+    """
+
+# Pinned to the open-loan index, without ANALYZE stats the planner prefers idx_checkouts_user,
+# which walks the user's whole loan history
+CHECKED_OUT_QUERY = f"""
+    SELECT Books.book_id, Books.title, Books.author, Checkouts.checkout_date, {FINE_EXPRESSION} AS fine
+    FROM Checkouts INDEXED BY idx_checkouts_open_user
+    JOIN Books ON Checkouts.book_id = Books.book_id
+    WHERE Checkouts.user_id = ? AND Checkouts.return_date IS NULL
+    """
+
+# Brings the stored fine of every open checkout up to date in one statement
+# Only rows whose fine actually changed are written
+REFRESH_FINES_QUERY = f"""
+    UPDATE Checkouts
+    SET fine = {FINE_EXPRESSION}
+    WHERE return_date IS NULL AND fine IS NOT {FINE_EXPRESSION}
+    """
+
+# Books.copies is the number of copies the library owns
+# Books.available is how many of them are on the shelf, kept up to date by checkout and return
+AVAILABILITY_QUERY = "SELECT available FROM Books WHERE book_id = ?"
+
+TAKE_COPY_QUERY = "UPDATE Books SET available = available - 1 WHERE book_id = ? AND available > 0"
+
+INSERT_CHECKOUT_QUERY = "INSERT INTO Checkouts (user_id, book_id) VALUES (?, ?)"
+
+RETURN_QUERY = """
+    UPDATE Checkouts
+    SET return_date = CURRENT_DATE
+    WHERE cust_id = (
+        SELECT cust_id FROM Checkouts
+        WHERE book_id = ? AND user_id = ? AND return_date IS NULL
+        LIMIT 1
+    )
+    """
+
+RESTORE_COPY_QUERY = "UPDATE Books SET available = available + 1 WHERE book_id = ? AND available < copies"
+
+# Holds queue users for books with no copy on the shelf
+# A returned copy goes to the first hold still waiting instead of back on the shelf,
+# and stays set aside for hold_pickup_days, so Books.available does not count it
+hold_pickup_days = 3
+
+# Joins the back of the queue, a user holds a book at most once
+PLACE_HOLD_QUERY = """
+    INSERT INTO Holds (book_id, user_id, position)
+    SELECT ?, ?, COALESCE(MAX(position), 0) + 1 FROM Holds WHERE book_id = ?
+    ON CONFLICT (user_id, book_id) DO NOTHING
+    """
+
+# 1 for the hold at the front of the queue, NULL when the user holds nothing for the book
+HOLD_PLACE_QUERY = """
+    SELECT COUNT(*) FROM Holds
+    WHERE book_id = ? AND position <= (SELECT position FROM Holds WHERE user_id = ? AND book_id = ?)
+    HAVING COUNT(*) > 0
+    """
+
+HOLD_QUERY = "SELECT hold_id, ready_until FROM Holds WHERE user_id = ? AND book_id = ?"
+
+DELETE_HOLD_QUERY = "DELETE FROM Holds WHERE hold_id = ?"
+
+NEXT_HOLD_QUERY = """
+    SELECT hold_id FROM Holds
+    WHERE book_id = ? AND ready_until IS NULL
+    ORDER BY position
+    LIMIT 1
+    """
+
+READY_HOLD_QUERY = "UPDATE Holds SET ready_until = date('now', 'localtime', ?) WHERE hold_id = ?"
+
+USER_HOLDS_QUERY = """
+    SELECT Books.book_id, Books.title, Books.author,
+        (SELECT COUNT(*) FROM Holds AS ahead
+         WHERE ahead.book_id = Holds.book_id AND ahead.position <= Holds.position) AS place,
+        Holds.ready_until
+    FROM Holds
+    JOIN Books ON Holds.book_id = Books.book_id
+    WHERE Holds.user_id = ?
+    ORDER BY Holds.hold_id
+    """
+
+# Largest fines first, cust_id breaks ties, the order of idx_checkouts_open_fine walked backwards
+# The last two columns are the sort key reports.py pages on
+OVERDUE_QUERY = """
+    SELECT Users.username, Books.title, Checkouts.fine, Checkouts.fine AS sort_fine, Checkouts.cust_id AS sort_id
+    FROM Checkouts
+    JOIN Users ON Checkouts.user_id = Users.user_id
+    JOIN Books ON Checkouts.book_id = Books.book_id
+    WHERE Checkouts.return_date IS NULL AND Checkouts.fine > 0
+    """
+
+# Hot queries and the index each must be planned with, INTEGER PRIMARY KEY for a rowid lookup
+indexed_queries = {
+    "login": (LOGIN_QUERY, "sqlite_autoindex_Users_1"),
+    "checked_out": (CHECKED_OUT_QUERY, "idx_checkouts_open_user"),
+    "availability": (AVAILABILITY_QUERY, "INTEGER PRIMARY KEY"),
+    "take_copy": (TAKE_COPY_QUERY, "INTEGER PRIMARY KEY"),
+    "return": (RETURN_QUERY, "idx_checkouts_open_book"),
+    "restore_copy": (RESTORE_COPY_QUERY, "INTEGER PRIMARY KEY"),
+    "hold": (HOLD_QUERY, "idx_holds_user"),
+    "hold_place": (HOLD_PLACE_QUERY, "idx_holds_queue"),
+    "next_hold": (NEXT_HOLD_QUERY, "idx_holds_queue"),
+    "user_holds": (USER_HOLDS_QUERY, "idx_holds_user"),
+    "overdue": (OVERDUE_QUERY, "idx_checkouts_open_fine"),
+}
+
+
+class QueryPlanError(Exception):
+    pass
+
+# Returns the EXPLAIN QUERY PLAN detail lines for a query
+# Parameters are bound to NULL since only the plan is needed
+def explain_query(query, conn = None):
+    conn = conn or connect_db()
+    parameters = (None,) * query.count("?")
+    return [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + query, parameters)]
+
+# Raises QueryPlanError if any query falls back to a full table scan or is not planned with its index
+# queries maps names to (query, index) pairs like indexed_queries
+def check_query_plans(queries = None, conn = None):
+    queries = indexed_queries if queries is None else queries
+    failures = {}
+    for name, (query, index) in queries.items():
+        plan = explain_query(query, conn)
+        problems = [detail for detail in plan if detail.startswith("SCAN ")]
+        uses = re.compile(rf"USING (COVERING )?(INDEX )?{re.escape(index)}\b")
+        if not any(uses.search(detail) for detail in plan):
+            problems.append(f"does not use {index}")
+        if problems:
+            failures[name] = problems
+    if failures:
+        details = "; ".join(f"{name}: {', '.join(problems)}" for name, problems in failures.items())
+        raise QueryPlanError(f"Bad query plans for {details}")
+
+
+# Retry settings for transactions that hit a locked database
+busy_retries = 5
+busy_backoff = 0.05
+
+def is_busy_error(error):
+    return getattr(error, "sqlite_errorname", "") in ("SQLITE_BUSY", "SQLITE_LOCKED") or "locked" in str(error)
+
+def backoff(attempt):
+    time.sleep(busy_backoff * (2 ** attempt) * (1 + random.random()))
+
+# Runs work(conn) inside one BEGIN IMMEDIATE transaction and returns its result
+# The write lock is taken up front so reads inside work cannot go stale,
+# and a busy database is retried with exponential backoff
+# Cached reads of the given tables (all tables when None) are invalidated on commit
+# and the version stamps of the tables, or of the given stamps instead, are bumped
+# durable = False commits without syncing, for bulk jobs that can be rerun after a crash
+# With group commit on, the work joins the next group of the current file's writer thread instead
+def run_transaction(work, tables = None, stamps = None, durable = True):
+    if group_commit_enabled:
+        writer = get_writer()
+        if threading.current_thread() is not writer.thread:
+            return writer.submit(work, tables, stamps, durable).result()
     conn = connect_db()
-    cursor = conn.cursor()
-    cursor.execute(query, parameters)
-    results = cursor.fetchall()
-    conn.close()
-    return results
+    if not durable:
+        conn.execute(f"PRAGMA synchronous = {relaxed_synchronous}")
+    try:
+        return run_direct_transaction(conn, work, tables, stamps)
+    finally:
+        if not durable:
+            conn.execute(f"PRAGMA synchronous = {pragmas['synchronous']}")
+
+# Like run_transaction but returns a Future, which resolves once the work is committed
+def submit_transaction(work, tables = None, stamps = None, durable = True):
+    if group_commit_enabled:
+        return get_writer().submit(work, tables, stamps, durable)
+    future = concurrent.futures.Future()
+    try:
+        future.set_result(run_transaction(work, tables, stamps, durable))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+def run_direct_transaction(conn, work, tables, stamps):
+    for attempt in range(busy_retries + 1):
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+        except sqlite3.OperationalError as e:
+            if not is_busy_error(e) or attempt == busy_retries:
+                raise
+            backoff(attempt)
+            continue
+        try:
+            start = time.perf_counter() if profiling_enabled else 0
+            result = work(conn)
+            conn.commit()
+            if profiling_enabled:
+                record_query(f"transaction {work.__qualname__}", time.perf_counter() - start, -1)
+            query_cache.invalidate(tables)
+            bump_versions(tables if stamps is None else stamps)
+            return result
+        except sqlite3.OperationalError as e:
+            conn.rollback()
+            if not is_busy_error(e) or attempt == busy_retries:
+                raise
+            backoff(attempt)
+        except Exception:
+            conn.rollback()
+            raise
+
+# Group commit
+# When enabled, every run_transaction (and execute_query) is queued for one writer thread per file
+# It runs everything queued in one transaction, each caller's work in its own savepoint,
+# and commits once, so concurrent writers share one sync instead of paying for one each
+# A failing work rolls back its own savepoint and only its caller sees the error
+group_commit_enabled = False
+
+# Seconds the writer waits for more writes before starting a group
+# 0 groups whatever queued up while the last commit was syncing, which was fastest when measured
+group_commit_window = 0
+group_commit_max = 500
+
+# synchronous setting for groups committed by the writer thread
+# Durable groups are synced to disk before their callers hear back,
+# relaxed ones (durable = False) are left for the OS to write out
+durable_synchronous = "FULL"
+relaxed_synchronous = "OFF"
+
+
+class WriteRequest:
+    __slots__ = ("work", "tables", "stamps", "durable", "future")
+
+    def __init__(self, work, tables, stamps, durable):
+        self.work = work
+        self.tables = tables
+        self.stamps = stamps
+        self.durable = durable
+        self.future = concurrent.futures.Future()
+
+
+class WriteCoordinator:
+
+    # Writes go to branch_id's file, and the writer thread runs in that branch
+    def __init__(self, branch_id = None, window = None, max_batch = None):
+        self.branch_id = branch_id
+        self.window = group_commit_window if window is None else window
+        self.max_batch = group_commit_max if max_batch is None else max_batch
+        self.queue = collections.deque()
+        self.condition = threading.Condition()
+        self.thread = None
+        self.stopping = False
+        self.groups = 0
+        self.writes = 0
+
+    def submit(self, work, tables = None, stamps = None, durable = True):
+        request = WriteRequest(work, tables, stamps, durable)
+        with self.condition:
+            if self.thread is None:
+                self.stopping = False
+                self.thread = threading.Thread(target = self.run, name = "db-writer", daemon = True)
+                self.thread.start()
+            self.queue.append(request)
+            self.condition.notify()
+        return request.future
+
+    # Commits what is queued, then ends the writer thread
+    def stop(self):
+        with self.condition:
+            thread = self.thread
+            if thread is None:
+                return
+            self.stopping = True
+            self.condition.notify()
+        thread.join()
+
+    def run(self):
+        branch_context.branch_id = self.branch_id
+        conn = connect_db()
+        while True:
+            with self.condition:
+                while not self.queue and not self.stopping:
+                    self.condition.wait()
+                if not self.queue:
+                    self.thread = None
+                    return
+                self.condition.wait_for(lambda: len(self.queue) >= self.max_batch or self.stopping, self.window)
+                # A group only holds writes of one durability, taken in arrival order
+                durable = self.queue[0].durable
+                group = []
+                while self.queue and len(group) < self.max_batch and self.queue[0].durable == durable:
+                    group.append(self.queue.popleft())
+            group = [request for request in group if request.future.set_running_or_notify_cancel()]
+            if group:
+                self.commit(conn, group, durable)
+
+    def commit(self, conn, group, durable):
+        conn.execute(f"PRAGMA synchronous = {durable_synchronous if durable else relaxed_synchronous}")
+        start = time.perf_counter() if profiling_enabled else 0
+        for attempt in range(busy_retries + 1):
+            outcomes = []
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                for request in group:
+                    conn.execute("SAVEPOINT grouped_write")
+                    try:
+                        outcomes.append((request.work(conn), None))
+                        conn.execute("RELEASE grouped_write")
+                    except Exception as e:
+                        if isinstance(e, sqlite3.OperationalError) and is_busy_error(e):
+                            raise
+                        conn.execute("ROLLBACK TO grouped_write")
+                        conn.execute("RELEASE grouped_write")
+                        outcomes.append((None, e))
+                conn.commit()
+                break
+            except sqlite3.OperationalError as e:
+                if conn.in_transaction:
+                    conn.rollback()
+                if not is_busy_error(e) or attempt == busy_retries:
+                    for request in group:
+                        request.future.set_exception(e)
+                    return
+                backoff(attempt)
+        if profiling_enabled:
+            record_query(f"group commit ({'durable' if durable else 'relaxed'})", time.perf_counter() - start, len(group))
+
+        self.groups += 1
+        self.writes += len(group)
+        for request, (result, error) in zip(group, outcomes):
+            if error is None:
+                query_cache.invalidate(request.tables)
+                bump_versions(request.tables if request.stamps is None else request.stamps)
+        for request, (result, error) in zip(group, outcomes):
+            if error is None:
+                request.future.set_result(result)
+            else:
+                request.future.set_exception(error)
+
+
+writers = {}
+writers_lock = threading.Lock()
+
+# Writer for the current branch's file
+def get_writer():
+    name = branch_db_name()
+    with writers_lock:
+        writer = writers.get(name)
+        if writer is None:
+            writer = writers[name] = WriteCoordinator(current_branch())
+        return writer
+
+def stop_writers():
+    with writers_lock:
+        running = list(writers.values())
+    for writer in running:
+        writer.stop()
+
+
+# Checks out one copy of a book for a user
+# A copy set aside for the user's hold is taken first, otherwise one from the shelf,
+# and a hold the user was still waiting on is dropped
+# Returns False when no copies are left on the shelf
+def checkout(user_id, book_id):
+    def work(conn):
+        hold = conn.execute(HOLD_QUERY, (user_id, book_id)).fetchone()
+        if hold is None or hold[1] is None:
+            if conn.execute(TAKE_COPY_QUERY, (book_id,)).rowcount == 0:
+                return False
+        if hold is not None:
+            conn.execute(DELETE_HOLD_QUERY, (hold[0],))
+        conn.execute(INSERT_CHECKOUT_QUERY, (user_id, book_id))
+        return True
+    return run_transaction(work, ("Books", "Checkouts", "Holds"), (("loans", user_id),))
+
+# Sets a copy of the book aside for the next waiting hold, or puts it back on the shelf
+# Runs inside the caller's transaction
+def pass_copy_on(conn, book_id):
+    hold = conn.execute(NEXT_HOLD_QUERY, (book_id,)).fetchone()
+    if hold is None:
+        conn.execute(RESTORE_COPY_QUERY, (book_id,))
+    else:
+        conn.execute(READY_HOLD_QUERY, (f"+{hold_pickup_days} days", hold[0]))
+
+# Closes one open checkout of a book for a user and passes the copy on
+# Returns False when the user has no open checkout for the book
+def return_book(user_id, book_id):
+    def work(conn):
+        if conn.execute(RETURN_QUERY, (book_id, user_id)).rowcount == 0:
+            return False
+        pass_copy_on(conn, book_id)
+        return True
+    return run_transaction(work, ("Books", "Checkouts", "Holds"), (("loans", user_id),))
+
+# Queues the user for a book and returns their place in the queue, 1 being next in line
+# Placing a hold twice keeps the first one
+# Returns None when a copy is on the shelf, there is nothing to wait for
+# Raises ValueError for a book that does not exist
+def place_hold(user_id, book_id):
+    def work(conn):
+        available = conn.execute(AVAILABILITY_QUERY, (book_id,)).fetchone()
+        if available is None:
+            raise ValueError("No such book")
+        if available[0] > 0:
+            return None
+        conn.execute(PLACE_HOLD_QUERY, (book_id, user_id, book_id))
+        return conn.execute(HOLD_PLACE_QUERY, (book_id, user_id, book_id)).fetchone()[0]
+    return run_transaction(work, ("Holds",), ())
 
-initialize_db()
+# Drops the user's hold on a book, a copy set aside for it goes to the next hold
+# Returns False when the user holds nothing for the book
+def cancel_hold(user_id, book_id):
+    def work(conn):
+        hold = conn.execute(HOLD_QUERY, (user_id, book_id)).fetchone()
+        if hold is None:
+            return False
+        conn.execute(DELETE_HOLD_QUERY, (hold[0],))
+        if hold[1] is not None:
+            pass_copy_on(conn, book_id)
+        return True
+    return run_transaction(work, ("Books", "Holds"), ())
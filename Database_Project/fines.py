@@ -0,0 +1,22 @@
+import database
+import jobs
+
+# Seconds between automatic fine sweeps
+sweep_interval = 3600
+
+# Recomputes the stored fine of every open checkout in one transaction
+# Returns the number of checkouts whose fine changed
+# Sessions work fines out from the checkout date, so their stamps are left alone
+def refresh_fines():
+    return database.run_transaction(
+        lambda conn: conn.execute(database.REFRESH_FINES_QUERY).rowcount,
+        ("Checkouts",), ()
+    )
+
+
+# Background thread that refreshes fines for all users on a fixed interval
+# The first sweep runs as soon as the thread starts
+class FineSweeper(jobs.PeriodicJob):
+
+    def __init__(self, interval = None):
+        super().__init__(refresh_fines, sweep_interval if interval is None else interval, "refreshing fines")
@@ -1,7 +1,19 @@
 import tkinter as tk
-from tkinter import ttk, messagebox
-import database
-from datetime import datetime, timedelta
+from tkinter import ttk, messagebox, filedialog
+import service
+import async_db
+from models import RowStore
+from virtual_list import VirtualList, BookPager, ListPager
+
+# Rows shown per page in the report window
+report_page_size = 50
+
+# Milliseconds of no typing before a search goes to the database
+search_delay_ms = 150
+
+# Task keys the Cancel button stops, these only read
+# Checkouts, returns and other writes are always left to finish
+read_task_keys = ("search", "search_page", "books_page", "report", "report_export", "holds", "checked_out")
 
 class LibraryApp:
 
@@ -15,14 +27,78 @@ class LibraryApp:
 
         self.root.withdraw()
 
+        self.session = None
         self.user_id = None
         self.is_admin = False
         self.tab_control = None
         self.user_tab = None
         self.admin_tab = None
+        self.tasks = {}
+        self.checked_out_books = RowStore()
+        self.search_after = None
+        self.shown_query = None
+
+        # Status bar shown while database calls run in the background
+        self.status_frame = tk.Frame(self.root)
+        self.status_frame.pack(side = tk.BOTTOM, fill = tk.X)
+        self.status_label = tk.Label(self.status_frame, text = "")
+        self.status_label.pack(side = tk.LEFT, padx = 5)
+        self.cancel_button = tk.Button(self.status_frame, text = "Cancel", command = self.cancel_tasks)
 
         self.login_window()
 
+    # Runs a database call on a worker thread so the window never blocks
+    # on_done receives the result back on the Tk thread
+    # Starting a task with the same key cancels the one before it
+    def run_db(self, fn, *args, on_done = None, on_finally = None, key = None, error_message = "An unexpected error occured"):
+        key = key or object()
+        if key in self.tasks:
+            self.tasks.pop(key).cancel()
+
+        def on_error(e):
+            print(f"{error_message}: {e}")
+            messagebox.showerror("Error", error_message)
+
+        def on_finished():
+            if self.tasks.get(key) is task:
+                del self.tasks[key]
+            self.update_status()
+            if on_finally:
+                on_finally()
+
+        task = async_db.run_async(self.root, fn, *args, on_done = on_done, on_error = on_error, on_finally = on_finished)
+        self.tasks[key] = task
+        self.update_status()
+        return task
+
+    # Lets a VirtualList load its pages through run_db, a newer page for the same list replaces the one loading
+    def page_runner(self, key):
+        def run(fn, on_done, on_finally):
+            self.run_db(fn, on_done = on_done, on_finally = on_finally, key = key,
+                        error_message = "An unexpected error occured while fetching the book list")
+        return run
+
+    # Shows the loading state while any task is pending, and the cancel button while a read is
+    def update_status(self):
+        self.status_label.config(text = "Loading..." if self.tasks else "")
+        if any(key in self.tasks for key in read_task_keys):
+            if not self.cancel_button.winfo_ismapped():
+                self.cancel_button.pack(side = tk.LEFT)
+        else:
+            self.cancel_button.pack_forget()
+
+    def cancel_task(self, key):
+        if key in self.tasks:
+            self.tasks.pop(key).cancel()
+            self.update_status()
+
+    # Cancels pending reads, writes keep running so they are never dropped halfway
+    def cancel_tasks(self):
+        for key in read_task_keys:
+            if key in self.tasks:
+                self.tasks[key].cancel()
+        self.status_label.config(text = "Cancelled")
+
     # Differentiates user and admin tabs
     # If login is user only user tab is displayed
     # Else both user and admin tabs are displayed
@@ -42,7 +118,12 @@ class LibraryApp:
         self.tab_control.pack(expand = 1, fill = "both")
 
         self.setup_user_tab()
+        # The admin panel is built the first time its tab is opened
         if self.is_admin:
+            self.tab_control.bind("<<NotebookTabChanged>>", self.on_tab_changed)
+
+    def on_tab_changed(self, event):
+        if self.tab_control.select() == str(self.admin_tab) and not self.admin_tab.winfo_children():
             self.setup_admin_tab()
 
         
@@ -60,6 +141,7 @@ class LibraryApp:
         search_label.pack()
         self.search_entry = tk.Entry(self.user_tab, width = 30)
         self.search_entry.pack(pady=5)
+        self.search_entry.bind("<KeyRelease>", self.on_search_typed)
 
         search_button = tk.Button(self.user_tab, text = "Search", command = self.search_books)
         search_button.pack()
@@ -68,7 +150,8 @@ class LibraryApp:
         self.favorites_label.pack(pady=10)
 
 
-        self.search_results = tk.Listbox(self.user_tab, width = 50, height = 10)
+        self.search_results = VirtualList(self.user_tab, lambda book: f"{book.title} by {book.author}", width = 50, height = 10,
+                                          run = self.page_runner("search_page"))
         self.search_results.pack(pady=10)
         
 
@@ -81,14 +164,17 @@ class LibraryApp:
         self.my_books_listbox = tk.Listbox(self.user_tab, width = 50, height = 10)
         self.my_books_listbox.pack(pady=5)
 
-        self.search_results.bind('<<ListboxSelect>>', self.enable_checkout_button)
+        self.search_results.listbox.bind('<<ListboxSelect>>', self.enable_checkout_button)
 
         self.return_button = tk.Button(self.user_tab, text = "Return Book", command = self.return_book, state = tk.DISABLED)
         self.return_button.pack(pady=5)
 
         self.my_books_listbox.bind('<<ListboxSelect>>', self.enable_return_button)
 
-        self.display_all_books()
+        holds_button = tk.Button(self.user_tab, text = "My Holds", command = self.holds_window)
+        holds_button.pack(pady=5)
+
+        self.display_favorites()
     
 
 
@@ -117,13 +203,9 @@ class LibraryApp:
         books_frame = tk.Frame(self.books_window)
         books_frame.pack(fill=tk.BOTH, expand = True)
 
-        self.books_listbox = tk.Listbox(books_frame, width=50, height=20, selectmode=tk.SINGLE)
-        self.books_listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand = True)
-
-        books_scrollbar = tk.Scrollbar(books_frame)
-        books_scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
-        self.books_listbox.config(yscrollcommand=books_scrollbar.set)
-        books_scrollbar.config(command=self.books_listbox.yview)
+        self.books_listbox = VirtualList(books_frame, lambda book: f"{book.book_id}: {book.title} by  {book.author}", width=50, height=20, selectmode=tk.SINGLE,
+                                         run = self.page_runner("books_page"))
+        self.books_listbox.pack(fill=tk.BOTH, expand = True)
 
         self.fetch_books()
 
@@ -131,54 +213,73 @@ class LibraryApp:
         delete_button.pack(pady=5)
 
 
-    # Queries Books table to return all books available
+    # Pages through the Books table as the list is scrolled
     def fetch_books(self):
-        try:
-            books = database.fetch_query("SELECT book_id, title, author FROM Books")
-            self.books_listbox.delete(0,tk.END)
-            for book_id, title, author in books:
-                self.books_listbox.insert(tk.END, f"{book_id}: {title} by  {author}")
-        except Exception as e:
-            print(f"Error fetching books: {e}")
-            messagebox.showerror("Error", "An unexpected error occured while fetching the book list")
+        self.books_listbox.set_pager(BookPager())
 
 
     # Method to delete selected books in view books window
     # Only available in the admin tab
     def delete_selected_book(self):
-        try:
-            selection = self.books_listbox.curselection()
-            if not selection:
-                messagebox.showerror("Error", "Please select a book to delete")
-                return
-            selected_book = self.books_listbox.get(selection[0])
-            book_id = selected_book.split(":")[0]
+        selected_book = self.books_listbox.selected()
+        if not selected_book:
+            messagebox.showerror("Error", "Please select a book to delete")
+            return
+        book_id = selected_book.book_id
 
-            database.execute_query("DELETE FROM Books WHERE book_id =?", (book_id,))
+        def on_deleted(result):
             messagebox.showinfo("Success", "Book deleted successfully")
-
             self.fetch_books()
-        except Exception as e:
-            print(f"Error deleting book: {e}")
-            messagebox.showerror("Error", "An unexpected error occured while deleting the book.")
 
+        self.run_db(service.delete_book, book_id,
+                    on_done = on_deleted, error_message = "An unexpected error occured while deleting the book.")
+
+
+    # Runs on every key press in the search box
+    # Results that are remembered, or can be narrowed from remembered ones, show at once
+    # Anything else waits until typing pauses so only the last query reaches the database
+    def on_search_typed(self, event = None):
+        if self.search_after is not None:
+            self.root.after_cancel(self.search_after)
+            self.search_after = None
+
+        query = self.search_entry.get().strip()
+        if query == self.shown_query:
+            return
+        if not query:
+            self.cancel_task("search")
+            self.display_favorites()
+            return
+
+        results = service.cached_search(query)
+        if results is not None:
+            self.cancel_task("search")
+            self.show_search_results(query, results)
+        else:
+            self.search_after = self.root.after(search_delay_ms, self.search_books)
 
     # Selects searched books that are like a book in Books table
     # Displays searched book
     def search_books(self):
-        if self.favorites_label.winfo_ismapped():
-            self.favorites_label.pack_forget()
-
+        if self.search_after is not None:
+            self.root.after_cancel(self.search_after)
+            self.search_after = None
 
         query = self.search_entry.get().strip()
-        results = database.fetch_query("SELECT book_id, title, author FROM Books WHERE title LIKE ?", ('%' + query + '%',))
-        self.books = results
-        self.search_results.delete(0,tk.END)
-
+        if not query:
+            self.display_favorites()
+            return
 
+        # A newer search cancels one that is still running
+        self.run_db(service.live_search, query,
+                    on_done = lambda results: self.show_search_results(query, results),
+                    key = "search", error_message = "An unexpected error occured while searching")
 
-        for book_id, title, author in results:
-            self.search_results.insert(tk.END, f"{title} by {author}")
+    def show_search_results(self, query, results):
+        if self.favorites_label.winfo_ismapped():
+            self.favorites_label.pack_forget()
+        self.shown_query = query
+        self.search_results.set_pager(ListPager(results))
 
 
     # Initializes login window
@@ -204,24 +305,32 @@ class LibraryApp:
             username= username_entry.get().strip()
             password = password_entry.get().strip()
 
-            user = database.fetch_query(
-                "SELECT user_id, is_admin FROM Users WHERE username = ? AND password = ?",
-                (username, password)
-            )
-
-            if user:
-                user_id, is_admin = user[0]
-                self.user_id = user_id
-                self.is_admin = is_admin
-                login_win.destroy()
-                self.root.state("zoomed")
-                self.root.deiconify()
-                self.setup_tabs()
-                self.fetch_checked_out_books()
-                
-            else:
-                messagebox.showerror("Error", "Invalid username or password")
-        tk.Button(login_win, text = "Login", command = authenticate_user).pack(pady=10)
+            login_button.config(state = tk.DISABLED, text = "Logging in...")
+
+            def on_login(session):
+                if session:
+                    self.session = session
+                    self.user_id = session.user_id
+                    self.is_admin = session.is_admin
+                    login_win.destroy()
+                    self.root.state("zoomed")
+                    self.root.deiconify()
+                    self.setup_tabs()
+                    self.fetch_checked_out_books()
+                    
+                else:
+                    messagebox.showerror("Error", "Invalid username or password")
+
+            # The login button comes back if the call fails or is cancelled
+            def on_finished():
+                if login_button.winfo_exists():
+                    login_button.config(state = tk.NORMAL, text = "Login")
+
+            self.run_db(service.login, username, password,
+                        on_done = on_login, on_finally = on_finished, key = "login",
+                        error_message = "An unexpected error occured while logging in")
+        login_button = tk.Button(login_win, text = "Login", command = authenticate_user)
+        login_button.pack(pady=10)
         tk.Button(login_win, text="Register", command=self.register_window).pack(pady=5)
 
     # Helper method to hide admin tab from regular users
@@ -231,16 +340,26 @@ class LibraryApp:
         else:
             self.tab_control.forget(self.admin_tab)
 
-    # Displays books on user page
-    # Queries Books table
-    def display_all_books(self):
+    # Shows the most borrowed books of the last month under "Our Favorites"
+    # Until anything has been borrowed the whole catalog is shown instead
+    def display_favorites(self):
+        def on_favorites(books):
+            if not books:
+                self.display_all_books()
+                return
+            if not self.favorites_label.winfo_ismapped():
+                self.favorites_label.pack(pady = 10, before = self.search_results)
+            self.shown_query = None
+            self.search_results.set_pager(ListPager(books))
 
-        books = database.fetch_query("SELECT book_id, title, author FROM Books")
-        self.search_results.delete(0,tk.END)
-        self.books= books
+        self.run_db(service.favorites, on_done = on_favorites, key = "search",
+                    error_message = "An unexpected error occured while loading favorites")
 
-        for book_id, title, author in books:
-            self.search_results.insert(tk.END, f"{title} by {author}" )
+    # Displays books on user page
+    # Pages through the Books table as the list is scrolled
+    def display_all_books(self):
+        self.shown_query = None
+        self.search_results.set_pager(BookPager())
 
 
     # Intializes window to add a book in the admin tab
@@ -284,48 +403,99 @@ class LibraryApp:
                 copies = int(copies)
                 if copies <= 0:
                     raise ValueError("Copies must be a postive integer.")
-                
-                database.execute_query(
-                    "INSERT INTO Books (title, author, isbn, copies) VALUES (?,?,?,?)", 
-                    (title, author, isbn, copies)
-                )
-                messagebox.showinfo("Success", "Book added successfully!")
-                self.window.destroy()
             except ValueError as ve:
                 messagebox.showerror("Error", f"Invalid inpur: {ve}")
-            except Exception as e:
-                messagebox.showerror("Error", f"An unexpected error occured: {e}")
+                return
+
+            def on_saved(result):
+                messagebox.showinfo("Success", "Book added successfully!")
+                self.window.destroy()
+
+            self.run_db(service.add_book, title, author, isbn, copies,
+                        on_done = on_saved, error_message = "An unexpected error occured while adding the book")
         
         submit_button = tk.Button(self.window, text = "Submit", command = save_book)
         submit_button.pack(pady = 10)
     
     # Generates report for admin
-    # Checks Checkouts table to see if any overdue books
+    # Reports are shown a page at a time and can be exported to CSV
     def generate_report(self):
-        try: 
-
-            overdue_books = database.fetch_query("""
-            SELECT Users.username, Books.title, Checkouts.fine
-            FROM Checkouts
-            JOIN Users ON Checkouts.user_id = Users.user_id
-            Join Books ON Checkouts.book_id = Books.book_id
-            Where Checkouts.return_date IS NULL AND Checkouts.fine > 0 
-            """)
-
-            if overdue_books:
-                report = "\n".join([f"{user} - {book} - {fine:.2f}" 
-                                    for user, book, fine in overdue_books])
+        self.report_win = tk.Toplevel(self.root)
+        self.report_win.title("Reports")
+        self.report_win.geometry("600x450")
+
+        self.report_names = service.report_names()
+        self.report_choice = ttk.Combobox(self.report_win, state = "readonly",
+                                          values = [service.report_definition(name).title for name in self.report_names])
+        self.report_choice.current(0)
+        self.report_choice.pack(pady=5)
+        self.report_choice.bind("<<ComboboxSelected>>", lambda event: self.show_report_page(0, reset = True))
+
+        self.report_table = ttk.Treeview(self.report_win, show = "headings", height = 15)
+        self.report_table.pack(fill=tk.BOTH, expand = True, padx = 5)
+
+        nav_frame = tk.Frame(self.report_win)
+        nav_frame.pack(pady=5)
+        self.prev_page_button = tk.Button(nav_frame, text = "Previous", command = lambda: self.show_report_page(self.report_page - 1))
+        self.prev_page_button.pack(side=tk.LEFT)
+        self.report_page_label = tk.Label(nav_frame, text = "")
+        self.report_page_label.pack(side=tk.LEFT, padx = 10)
+        self.next_page_button = tk.Button(nav_frame, text = "Next", command = lambda: self.show_report_page(self.report_page + 1))
+        self.next_page_button.pack(side=tk.LEFT)
+
+        export_button = tk.Button(self.report_win, text = "Export CSV", command = self.export_report)
+        export_button.pack(pady=5)
+
+        self.report_page = 0
+        self.show_report_page(0, reset = True)
+
+    def selected_report(self):
+        return self.report_names[self.report_choice.current()]
+
+    # Loads one page of the selected report into the table
+    # Pages are read by key, report_keys[page] is the key the page starts after
+    def show_report_page(self, page, reset = False):
+        if reset:
+            self.report_keys = [None]
+        name = self.selected_report()
+        report = service.report_definition(name)
+
+        def on_page(result):
+            rows, next_key = result
+            self.report_page = page
+            del self.report_keys[page + 1:]
+            self.report_keys.append(next_key)
+            self.report_table.config(columns = report.columns)
+            for column in report.columns:
+                self.report_table.heading(column, text = column)
+            self.report_table.delete(*self.report_table.get_children())
+            for row in rows:
+                self.report_table.insert("", tk.END, values = [f"{value:.2f}" if isinstance(value, float) else value for value in row])
+
+            self.prev_page_button.config(state = tk.NORMAL if page > 0 else tk.DISABLED)
+            self.next_page_button.config(state = tk.NORMAL if next_key is not None else tk.DISABLED)
+            if rows:
+                self.report_page_label.config(text = f"Page {page + 1}")
             else:
-                report = "No overdue books!"
+                self.report_page_label.config(text = "No overdue books!" if name == "overdue" else "No results")
 
-            messagebox.showinfo("Overdue Report", report)
-        except Exception as e:
-            print(f"Error generating report: {e}")
-            messagebox.showerror("Error", "An unexpected error occured while generating the report")
+        self.run_db(service.report_page, name, self.report_keys[page], report_page_size, on_done = on_page, key = "report",
+                    error_message = "An unexpected error occured while generating the report")
+
+    # Streams the whole selected report to a CSV file
+    def export_report(self):
+        name = self.selected_report()
+        path = filedialog.asksaveasfilename(parent = self.report_win, defaultextension = ".csv",
+                                            filetypes = [("CSV files", "*.csv")])
+        if not path:
+            return
+        self.run_db(service.export_report, name, path,
+                    on_done = lambda count: messagebox.showinfo("Export", f"Exported {count} rows to {path}"),
+                    key = "report_export", error_message = "An unexpected error occured while exporting the report")
 
     # Enables checkout button when a selection is made in the Book list box
     def enable_checkout_button(self,event):
-        selection = self.search_results.curselection()
+        selection = self.search_results.selected()
         if selection:
             self.checkout_button.config(state = tk.NORMAL)
         else:
@@ -336,102 +506,93 @@ class LibraryApp:
     # If copies available SQL method to insert user_id and book_id into Checkouts table
     # Displays checked out books in bottom list box
     def checkout_book(self):
-        selection = self.search_results.curselection()
-        if not selection:
+        selected_book = self.search_results.selected()
+        if not selected_book:
             messagebox.showerror("Error", "Please select a book to checkout")
             return
-        selected_index = selection[0]
-        selected_book = self.books[selected_index]
-        book_id = selected_book[0]
-
-        try:
-
-            available_copies = database.fetch_query(
-                 """
-                SELECT Books.copies - COUNT(Checkouts.book_id)
-                FROM Books
-                LEFT JOIN Checkouts
-                ON Books.book_id = Checkouts.book_id
-                AND Checkouts.return_date IS NULL
-                WHERE Books.book_id = ?
-                GROUP BY Books.book_id
-                """,
-                (book_id,)
-            )
-
-            if available_copies and available_copies[0][0] <= 0:
-                messagebox.showerror("Unavailable", "No more copies of this book are available for checkout.")
-                return
-
-            database.execute_query(
-                "INSERT INTO Checkouts (user_id, book_id) VALUES (?, ?)",
-                (self.user_id, book_id)
-            )
+        book_id = selected_book.book_id
 
-            database.execute_query(
-                "UPDATE Books SET copies = copies - 1 WHERE book_id = ?", 
-                (book_id,)
-            )
+        def on_checkout(checked_out):
+            if not checked_out:
+                if messagebox.askyesno("Unavailable", "No more copies of this book are available for checkout.\n"
+                                       "Place a hold and get the next copy returned?"):
+                    self.place_hold(book_id)
+                return
 
             messagebox.showinfo("Success", "Book checked out successfully")
             self.checkout_button.config(state=tk.DISABLED)
             self.fetch_checked_out_books()
-        except Exception as e:
-            print(f"Error during checkout: {e}")
-            messagebox.showerror("Error", "An unexpected error occured")
 
+        self.run_db(service.checkout, self.user_id, book_id, on_done = on_checkout)
 
-    # Calls Checkouts table to view checked out books by user
-    # Initializes the checkout_date
-    def fetch_checked_out_books(self):
-        try:
-            results = database.fetch_query(
-                 """
-            SELECT Books.book_id, Books.title, Books.author, Checkouts.checkout_date, Checkouts.fine
-            FROM Checkouts
-            JOIN Books ON Checkouts.book_id = Books.book_id
-            WHERE Checkouts.user_id = ? AND Checkouts.return_date IS NULL
-            """,
-            (self.user_id,)
-            )
 
+    # Queues the user for a book with no copies left
+    def place_hold(self, book_id):
+        def on_placed(place):
+            if place is None:
+                messagebox.showinfo("Available", "A copy was just returned, you can check it out now.")
+            else:
+                messagebox.showinfo("Hold placed", f"You are number {place} in line for this book.")
 
-            self.my_books_listbox.delete(0,tk.END)
-            self.checked_out_books = []
+        self.run_db(service.place_hold, self.user_id, book_id, on_done = on_placed,
+                    error_message = "An unexpected error occured while placing the hold")
 
-            print(f"Fetched results: {results}")
 
-            for book_id, title, author, checkout_date, current_fine in results:
-                if checkout_date:
-                    checkout_date_obj = datetime.strptime(checkout_date, "%Y-%m-%d").date()
+    # Lists the user's holds, ready ones show until when the copy is kept for them
+    def holds_window(self):
+        self.holds_win = tk.Toplevel(self.root)
+        self.holds_win.title("My Holds")
+        self.holds_win.geometry("400x300")
 
-                    new_fine = self.calculate_fine(checkout_date_obj)
-                else:
-                    checkout_date_obj = None
-                    new_fine = 0
-
-                if new_fine != current_fine:
-                    database.execute_query(
-                        """
-                    UPDATE Checkouts
-                    SET fine = ?
-                    WHERE book_id = ? AND user_id = ? AND return_date IS NULL
-                    """,
-                    (new_fine, book_id, self.user_id)
-                    )
-
-                self.checked_out_books.append((book_id, title, author, checkout_date))
-                fine_display = f"(${new_fine:.2f} fine)" if new_fine > 0 else ""
-                self.my_books_listbox.insert(tk.END, f"{title} by {author} (Checked out on {checkout_date} {fine_display})")
-                
-        except Exception as e:
-            print(f"Error fetching checked out books: {e}")
-            messagebox.showerror("Error", "An unexpected error occured while fetching books")
+        self.holds = RowStore()
+        self.holds_listbox = tk.Listbox(self.holds_win, width = 50, height = 12)
+        self.holds_listbox.pack(fill = tk.BOTH, expand = True)
+
+        tk.Button(self.holds_win, text = "Cancel Hold", command = self.cancel_selected_hold).pack(pady=5)
+
+        self.fetch_holds()
+
+    def fetch_holds(self):
+        self.run_db(service.holds, self.user_id, on_done = self.show_holds, key = "holds",
+                    error_message = "An unexpected error occured while fetching holds")
+
+    def show_holds(self, results):
+        self.holds.set(results)
+        self.holds_listbox.delete(0, tk.END)
+        for hold in results:
+            status = f"ready, kept until {hold.ready_until}" if hold.ready_until else f"number {hold.place} in line"
+            self.holds_listbox.insert(tk.END, f"{hold.title} by {hold.author} ({status})")
+
+    def cancel_selected_hold(self):
+        selection = self.holds_listbox.curselection()
+        if not selection:
+            messagebox.showerror("Error", "Please select a hold to cancel")
+            return
+
+        self.run_db(service.cancel_hold, self.user_id, self.holds.id_at(selection[0]),
+                    on_done = lambda result: self.fetch_holds(),
+                    error_message = "An unexpected error occured while cancelling the hold")
+
+
+    # Calls Checkouts table to view checked out books by user
+    # Fines are computed from the checkout date, nothing is written here
+    # The session only queries again after this user's loans or the catalog change
+    def fetch_checked_out_books(self):
+        self.run_db(service.loans, self.session,
+                    on_done = self.show_checked_out_books, key = "checked_out",
+                    error_message = "An unexpected error occured while fetching books")
+
+    def show_checked_out_books(self, results):
+        self.my_books_listbox.delete(0,tk.END)
+        self.checked_out_books.set(results)
+
+        for loan in results:
+            fine_display = f"(${loan.fine:.2f} fine)" if loan.fine > 0 else ""
+            self.my_books_listbox.insert(tk.END, f"{loan.title} by {loan.author} (Checked out on {loan.checkout_date} {fine_display})")
 
     # Enables return button when selection is made in the Checked out books listbox
     def enable_return_button(self, event):
         selection = self.my_books_listbox.curselection()
-        print(f"Selection: {selection}")
         if selection:
             self.return_button.config(state=tk.NORMAL)
         else:
@@ -445,30 +606,16 @@ class LibraryApp:
         if not selection:
             messagebox.showerror("Error", "Please select a book to return")
             return
-        selected_index = selection[0]
-        selected_book = self.checked_out_books[selected_index]
-        book_id = selected_book[0]
-
-        try:
-            database.execute_query(
-                "UPDATE Checkouts SET return_date = CURRENT_DATE WHERE book_id = ? AND user_id = ? AND return_date IS NULL",
-                (book_id, self.user_id)
-            )
-
-            database.execute_query(
-                "UPDATE Books SET copies = copies + 1 WHERE book_id = ?",
-                (book_id,)
-            )
+        book_id = self.checked_out_books.id_at(selection[0])
 
+        def on_returned(result):
             messagebox.showinfo("Success", "Book returned successfully")
             self.return_button.config(state=tk.DISABLED)
             self.fetch_checked_out_books()
-            self.display_all_books()
+            self.display_favorites()
 
-
-        except Exception as e:
-            print(f"Error during return: {e}")
-            messagebox.showerror("Error", "An unexpected error occured while returning")
+        self.run_db(service.return_book, self.user_id, book_id, on_done = on_returned,
+                    error_message = "An unexpected error occured while returning")
 
 
     # Initializes user register window
@@ -512,38 +659,13 @@ class LibraryApp:
                 messagebox.showerror("Error", "Passwords do not match.")
                 return
             
-            try:
-                database.execute_query(
-                    "INSERT INTO Users (username, email, password) VALUES (?, ?, ?)",
-                    (username, email, password)
-                )
+            def on_registered(result):
                 messagebox.showinfo("Success", "Account created successfully!")
                 register_win.destroy()
-            except Exception as e:
-                print(f"Error during registration: {e}")
-                messagebox.showerror("Error", "An error occured while creating account.")
-        tk.Button(register_win, text="Register", command = register_user).pack(pady=10)
-
-
-    # Method to calculate fines on overdue books
-    # $10 after 2 weeks then $1 for every additional day late
-    def calculate_fine(self, checkout_date, return_date = None):
-        due_date = checkout_date + timedelta(weeks = 2)
-        current_date = datetime.now().date()
-
-        if return_date:
-            effective_date = return_date
-        else:
-            effective_date = current_date
-
-        if effective_date <= due_date:
-            return 0
-        
-        overdue_days = (effective_date - due_date).days
-        fine = 10 + (overdue_days - 1) * 1
-        return max(fine, 0)
-
 
+            self.run_db(service.register, username, email, password,
+                        on_done = on_registered, error_message = "An error occured while creating account.")
+        tk.Button(register_win, text="Register", command = register_user).pack(pady=10)
 
 
 if __name__ == "__main__":
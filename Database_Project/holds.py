@@ -0,0 +1,56 @@
+import database
+import jobs
+
+# Expires holds whose set-aside copy was never picked up
+# Each expired hold passes its copy on to the next hold in the queue, or back to the shelf,
+# in the same transaction that drops it
+
+# Expired holds handled per transaction
+expire_batch_size = 500
+
+# Seconds between automatic sweeps
+sweep_interval = 3600
+
+EXPIRED_HOLDS_QUERY = """
+    SELECT hold_id, book_id FROM Holds
+    WHERE ready_until < date('now', 'localtime')
+    ORDER BY ready_until
+    LIMIT ?
+    """
+
+# Expires one batch in one short transaction and returns how many holds it dropped
+def expire_batch(batch_size = None):
+    batch_size = expire_batch_size if batch_size is None else batch_size
+
+    def work(conn):
+        expired = conn.execute(EXPIRED_HOLDS_QUERY, (batch_size,)).fetchall()
+        for hold_id, book_id in expired:
+            conn.execute(database.DELETE_HOLD_QUERY, (hold_id,))
+            database.pass_copy_on(conn, book_id)
+        return len(expired)
+
+    return database.run_transaction(work, ("Books", "Holds"), ())
+
+# Expires every overdue hold, a batch at a time, and returns the number dropped
+# The oldest holds are always first in line, so no cursor is needed
+def expire_holds(batch_size = None, progress = None):
+    return jobs.run_batches(lambda cursor: (expire_batch(batch_size), None), progress = progress)
+
+
+# Background thread that expires holds on a fixed interval
+class HoldSweeper(jobs.PeriodicJob):
+
+    def __init__(self, interval = None):
+        super().__init__(expire_holds, sweep_interval if interval is None else interval, "expiring holds")
+
+
+def main(argv = None):
+    parser = jobs.batch_parser("Expire holds whose copies were not picked up in time", expire_batch_size)
+    args = parser.parse_args(argv)
+
+    expired = jobs.run_batch_command(args, lambda progress: expire_holds(args.batch_size, progress), "expired")
+    print(f"Expired {expired} holds")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+import argparse
+import logging
+import sys
+import threading
+import time
+import database
+
+# Background work shared by the feature modules
+# PeriodicJob is the thread behind the fine, hold, archive, popularity and snapshot jobs,
+# run_batches is the loop behind the jobs that work through a table a transaction at a time,
+# and LazyExecutor holds the worker pools that are only started when first needed
+
+log = logging.getLogger("library.jobs")
+
+# Seconds between batches, so other writers get a turn at the write lock
+batch_pause = 0.05
+
+
+# Background thread that calls fn() on a fixed interval until stopped
+# The first call runs as soon as the thread starts, a subclass can delay it by overriding first_wait
+# An error is logged with its traceback and the job carries on at the next interval
+# The job works in the branch that was current when it was made, see database.use_branch
+class PeriodicJob(threading.Thread):
+
+    def __init__(self, fn, interval, action):
+        super().__init__(daemon = True)
+        self.branch_id = database.current_branch()
+        self.fn = fn
+        self.interval = interval
+        self.action = action
+        self.stopped = threading.Event()
+
+    # Seconds to wait before the first call
+    def first_wait(self):
+        return 0
+
+    def run(self):
+        with database.use_branch(self.branch_id):
+            wait = self.first_wait()
+            while not self.stopped.wait(wait):
+                try:
+                    self.fn()
+                except Exception:
+                    log.exception("Error %s", self.action)
+                wait = self.interval
+
+    def stop(self):
+        self.stopped.set()
+
+
+# Calls batch(cursor) until it handles nothing, each call being one short transaction
+# batch returns (rows handled, cursor for the next call), and progress(total) is called after each batch
+# Returns the total handled
+def run_batches(batch, cursor = None, progress = None, pause = None):
+    total = 0
+    while True:
+        count, cursor = batch(cursor)
+        if not count:
+            return total
+        total += count
+        if progress:
+            progress(total)
+        time.sleep(batch_pause if pause is None else pause)
+
+# Command line for a batch job, --db and --batch-size, the caller adds its own options
+def batch_parser(description, batch_size):
+    parser = argparse.ArgumentParser(description = description)
+    parser.add_argument("--db", default = database.db_name)
+    parser.add_argument("--batch-size", type = int, default = batch_size)
+    return parser
+
+# Runs run(progress) against the database named by --db, printing the running total as "<total> <done>"
+def run_batch_command(args, run, done):
+    database.db_name = args.db
+    database.initialize_db()
+    return run(lambda total: print(f"{total} {done}", file = sys.stderr))
+
+
+# An executor made by make() on first use and shut down without waiting
+# After shutdown the next get() makes a new one
+class LazyExecutor:
+
+    def __init__(self, make):
+        self.make = make
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = self.make()
+            return self.executor
+
+    def shutdown(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait = False, cancel_futures = True)
+                self.executor = None
@@ -0,0 +1,116 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+import benchmark
+
+# Simulated clients for server.py
+# Each client logs in as one of the users made by benchmark.py, then loops over
+# search, checkout, loan list and return on a keep-alive connection
+
+
+class Client:
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+        self.token = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+    async def request(self, method, path, payload = None):
+        body = json.dumps(payload).encode() if payload is not None else b""
+        headers = f"{method} {path} HTTP/1.1\r\nHost: {self.host}\r\nContent-Length: {len(body)}\r\n"
+        if self.token:
+            headers += f"Authorization: Bearer {self.token}\r\n"
+        self.writer.write(headers.encode() + b"\r\n" + body)
+        await self.writer.drain()
+
+        status = int((await self.reader.readline()).split()[1])
+        length = 0
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b""):
+                break
+            name, _, value = line.decode().partition(":")
+            if name.lower() == "content-length":
+                length = int(value)
+        data = json.loads(await self.reader.readexactly(length)) if length else {}
+        return status, data
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+
+
+async def run_client(client_id, args, timings, errors, deadline):
+    rng = random.Random(client_id)
+    client = Client(args.host, args.port)
+    await client.connect()
+    user_id = rng.randint(1, args.users)
+
+    async def timed(name, method, path, payload = None, ok = (200,)):
+        start = time.perf_counter()
+        status, data = await client.request(method, path, payload)
+        timings.setdefault(name, []).append((time.perf_counter() - start) * 1000)
+        if status not in ok:
+            errors[status] = errors.get(status, 0) + 1
+        return status, data
+
+    try:
+        status, data = await timed("login", "POST", "/login",
+                                   {"username": f"user{user_id}", "password": benchmark.user_password(user_id)})
+        if status != 200:
+            return
+        client.token = data["token"]
+        while time.perf_counter() < deadline:
+            word = rng.choice(benchmark.WORDS)[:rng.randint(2, 6)]
+            await timed("search", "GET", f"/search?q={word}&limit=20")
+            book_id = rng.randint(1, args.books)
+            status, data = await timed("checkout", "POST", "/checkout", {"book_id": book_id}, ok = (200, 409))
+            await timed("loans", "GET", "/loans")
+            if status == 200:
+                await timed("return", "POST", "/return", {"book_id": book_id})
+    finally:
+        client.close()
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+async def load_test(args):
+    timings = {}
+    errors = {}
+    started = time.perf_counter()
+    deadline = started + args.duration
+    await asyncio.gather(*(run_client(client_id, args, timings, errors, deadline) for client_id in range(args.clients)))
+    elapsed = time.perf_counter() - started
+
+    total = sum(len(values) for values in timings.values())
+    print(f"{args.clients} clients, {total} requests in {elapsed:.1f}s ({total / elapsed:.1f} req/s)")
+    for name, values in timings.items():
+        values.sort()
+        print(f"{name:10} {len(values):8d}  p50 {percentile(values, 50):8.2f}ms  "
+              f"p95 {percentile(values, 95):8.2f}ms  p99 {percentile(values, 99):8.2f}ms")
+    if errors:
+        print(f"Errors by status: {errors}")
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Load test server.py with simulated clients")
+    parser.add_argument("--host", default = "127.0.0.1")
+    parser.add_argument("--port", type = int, default = 8080)
+    parser.add_argument("--clients", type = int, default = 200)
+    parser.add_argument("--duration", type = float, default = 10.0)
+    parser.add_argument("--users", type = int, default = 1000, help = "users created by benchmark.py")
+    parser.add_argument("--books", type = int, default = 10000, help = "books created by benchmark.py")
+    args = parser.parse_args(argv)
+    asyncio.run(load_test(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,67 @@
+import os
+import sys
+import time
+
+started = time.perf_counter()
+
 from gui import LibraryApp
 import tkinter as tk
 import database
+import async_db
+import background
+import branches
+import passwords
+
+imported = time.perf_counter()
+
+# Milliseconds after the login window appears before the background jobs start,
+# so their first runs do not compete with startup for the database file
+background_delay_ms = 2000
+
+# The app works in one branch, so only that branch's jobs run here
+# Any number of copies of the app can be open, so snapshots are left to the server or backup.py
+def start_background_jobs():
+    background.start_background_jobs([database.current_branch()], snapshots = False)
+
+# LIBRARY_STARTUP_TIMING=1 prints how long each startup step took, from the first import
+def print_startup_timings(steps):
+    previous = started
+    for name, at in steps:
+        print(f"{name:20} {(at - previous) * 1000:8.1f} ms  {(at - started) * 1000:8.1f} ms total", file = sys.stderr)
+        previous = at
 
 def main():
+    # LIBRARY_PROFILE=1 times every query and prints the totals on exit
+    database.profiling_enabled = bool(os.environ.get("LIBRARY_PROFILE"))
+    startup_timing = bool(os.environ.get("LIBRARY_STARTUP_TIMING"))
+    steps = [("imports", imported)]
+
+    # LIBRARY_BRANCHES=branches.json LIBRARY_BRANCH=<id> runs the app against one branch's database
+    if os.environ.get("LIBRARY_BRANCHES"):
+        branches.load(os.environ["LIBRARY_BRANCHES"], os.environ.get("LIBRARY_BRANCH"))
+
     database.initialize_db()
+    steps.append(("schema check", time.perf_counter()))
 
     root = tk.Tk()
-    
+
     app = LibraryApp(root)
+    steps.append(("login window", time.perf_counter()))
+
+    root.after(background_delay_ms, start_background_jobs)
+    if startup_timing:
+        # Runs once the window has been drawn and the app is waiting for input
+        def interactive():
+            steps.append(("interactive", time.perf_counter()))
+            print_startup_timings(steps)
+        root.after_idle(interactive)
 
     root.mainloop()
+    async_db.shutdown()
+    passwords.shutdown()
+
+    if database.profiling_enabled:
+        database.dump_query_stats()
 
 if __name__ == "__main__":
     main()
- 
\ No newline at end of file
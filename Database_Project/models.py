@@ -0,0 +1,65 @@
+import collections
+
+# Records for the rows the app passes around
+# They are named tuples, so they take no more memory than the plain tuples they replace
+# and code that unpacks them positionally keeps working
+
+User = collections.namedtuple("User", ("user_id", "username", "is_admin"))
+
+Book = collections.namedtuple("Book", ("book_id", "title", "author"))
+
+# An open loan, fine as of today
+Checkout = collections.namedtuple("Checkout", ("book_id", "title", "author", "checkout_date", "fine"))
+
+# A book found by a search across branches, see branches.py
+BranchBook = collections.namedtuple("BranchBook", ("branch_id", "book_id", "title", "author"))
+
+# A place in a book's hold queue, ready_until is set once a copy is waiting for pickup
+Hold = collections.namedtuple("Hold", ("book_id", "title", "author", "place", "ready_until"))
+
+
+# Returns a sqlite3 row factory that builds model records straight from the cursor
+# Keep the result in a module variable, the query cache keys on it
+def row_factory(model):
+    make = model._make
+    return lambda cursor, row: make(row)
+
+user_row = row_factory(User)
+book_row = row_factory(Book)
+checkout_row = row_factory(Checkout)
+hold_row = row_factory(Hold)
+
+
+# Rows shown in a listbox, found by listbox index or by id
+# Selections are turned back into ids here instead of being parsed out of the display text
+class RowStore:
+    __slots__ = ("rows", "positions")
+
+    def __init__(self, rows = ()):
+        self.rows = []
+        self.positions = {}
+        self.set(rows)
+
+    # The first field of each row is its id
+    def set(self, rows):
+        self.rows = list(rows)
+        self.positions = {}
+        for position, row in enumerate(self.rows):
+            self.positions.setdefault(row[0], position)
+
+    def id_at(self, index):
+        return self.rows[index][0]
+
+    def row_at(self, index):
+        return self.rows[index]
+
+    # First row with the id, or None
+    def get(self, row_id):
+        position = self.positions.get(row_id)
+        return None if position is None else self.rows[position]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        return iter(self.rows)
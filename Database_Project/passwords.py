@@ -0,0 +1,173 @@
+import argparse
+import base64
+import concurrent.futures
+import hashlib
+import hmac
+import os
+import time
+import jobs
+
+# Password hashing with a salted key derivation function
+# Stored hashes look like scrypt$<log2 n>$<r>$<p>$<salt>$<hash> or pbkdf2_sha256$<iterations>$<salt>$<hash>
+# Anything else in the password column is a plaintext password from before hashing,
+# which still verifies and is replaced with a hash on the next successful login
+
+# Scheme used for new hashes, "scrypt" or "pbkdf2_sha256"
+scheme = "scrypt"
+
+# scrypt cost as log2 of n, each step up doubles the time and memory per hash
+scrypt_cost = 14
+scrypt_block_size = 8
+scrypt_parallelism = 1
+
+pbkdf2_iterations = 600000
+
+salt_size = 16
+hash_size = 32
+
+# Processes that do the hashing so a burst of logins does not hold up other threads
+# 0 hashes on the calling thread instead
+process_count = min(4, os.cpu_count() or 1)
+
+workers = jobs.LazyExecutor(lambda: concurrent.futures.ProcessPoolExecutor(max_workers = process_count))
+
+dummy_hash = None
+
+
+def encode(data):
+    return base64.b64encode(data).decode("ascii").rstrip("=")
+
+def decode(text):
+    return base64.b64decode(text + "=" * (-len(text) % 4))
+
+def default_cost(hash_scheme):
+    return scrypt_cost if hash_scheme == "scrypt" else pbkdf2_iterations
+
+def derive(password, hash_scheme, cost, salt, block_size = None, parallelism = None):
+    if hash_scheme == "scrypt":
+        block_size = block_size or scrypt_block_size
+        parallelism = parallelism or scrypt_parallelism
+        n = 1 << cost
+        return hashlib.scrypt(
+            password.encode(), salt = salt, n = n, r = block_size, p = parallelism,
+            maxmem = 256 * n * block_size + (1 << 20), dklen = hash_size
+        )
+    if hash_scheme == "pbkdf2_sha256":
+        return hashlib.pbkdf2_hmac("sha256", password.encode(), salt, cost, dklen = hash_size)
+    raise ValueError(f"Unknown password scheme: {hash_scheme}")
+
+# Returns the string to store in Users.password
+def hash_password(password, hash_scheme = None, cost = None):
+    hash_scheme = hash_scheme or scheme
+    cost = default_cost(hash_scheme) if cost is None else cost
+    salt = os.urandom(salt_size)
+    digest = derive(password, hash_scheme, cost, salt)
+    if hash_scheme == "scrypt":
+        return f"scrypt${cost}${scrypt_block_size}${scrypt_parallelism}${encode(salt)}${encode(digest)}"
+    return f"pbkdf2_sha256${cost}${encode(salt)}${encode(digest)}"
+
+# Splits a stored hash into (scheme, cost, block size, parallelism, salt, digest)
+# Returns None for a plaintext password
+def parse(stored):
+    parts = stored.split("$")
+    try:
+        if parts[0] == "scrypt" and len(parts) == 6:
+            return "scrypt", int(parts[1]), int(parts[2]), int(parts[3]), decode(parts[4]), decode(parts[5])
+        if parts[0] == "pbkdf2_sha256" and len(parts) == 4:
+            return "pbkdf2_sha256", int(parts[1]), None, None, decode(parts[2]), decode(parts[3])
+    except ValueError:
+        pass
+    return None
+
+# Comparisons take the same time wherever the first mismatch is
+def verify_password(password, stored):
+    parsed = parse(stored)
+    if parsed is None:
+        return hmac.compare_digest(password.encode(), stored.encode())
+    hash_scheme, cost, block_size, parallelism, salt, digest = parsed
+    return hmac.compare_digest(derive(password, hash_scheme, cost, salt, block_size, parallelism), digest)
+
+# True when the stored value is plaintext or was hashed with other settings than the current ones
+def needs_rehash(stored):
+    parsed = parse(stored)
+    if parsed is None:
+        return True
+    hash_scheme, cost, block_size, parallelism = parsed[:4]
+    if hash_scheme != scheme or cost != default_cost(scheme):
+        return True
+    return hash_scheme == "scrypt" and (block_size, parallelism) != (scrypt_block_size, scrypt_parallelism)
+
+# A hash to verify against when the username does not exist,
+# so unknown and known usernames take as long to reject
+def get_dummy_hash():
+    global dummy_hash
+    if dummy_hash is None or needs_rehash(dummy_hash):
+        dummy_hash = hash_password("")
+    return dummy_hash
+
+
+def get_executor():
+    return workers.get()
+
+def shutdown():
+    workers.shutdown()
+
+# Runs hash_password or verify_password in the process pool and waits for the result
+# The module settings are passed along since the worker processes keep their own copies
+def run(fn, *args):
+    if process_count <= 0:
+        return fn(*args)
+    return get_executor().submit(run_with_settings, current_settings(), fn, *args).result()
+
+def current_settings():
+    return {
+        "scheme": scheme, "scrypt_cost": scrypt_cost, "scrypt_block_size": scrypt_block_size,
+        "scrypt_parallelism": scrypt_parallelism, "pbkdf2_iterations": pbkdf2_iterations,
+    }
+
+def run_with_settings(settings, fn, *args):
+    globals().update(settings)
+    return fn(*args)
+
+
+# Measures logins per second at one cost, hashing on the calling thread and then through the pool
+def benchmark_cost(hash_scheme, cost, logins):
+    stored = hash_password("benchmark password", hash_scheme, cost)
+
+    started = time.perf_counter()
+    for _ in range(logins):
+        verify_password("benchmark password", stored)
+    serial = logins / (time.perf_counter() - started)
+
+    pool = get_executor()
+    list(pool.map(verify_password, ["warm up"] * process_count, [stored] * process_count))
+    started = time.perf_counter()
+    list(pool.map(verify_password, ["benchmark password"] * logins, [stored] * logins))
+    pooled = logins / (time.perf_counter() - started)
+    return serial, pooled
+
+
+def main(argv = None):
+    global process_count
+    parser = argparse.ArgumentParser(description = "Measure login throughput at each password hashing cost")
+    parser.add_argument("--scheme", choices = ("scrypt", "pbkdf2_sha256"), default = scheme)
+    parser.add_argument("--costs", type = int, nargs = "+",
+                        help = "log2 n for scrypt or iterations for pbkdf2_sha256")
+    parser.add_argument("--logins", type = int, default = 50)
+    parser.add_argument("--processes", type = int, default = process_count)
+    args = parser.parse_args(argv)
+
+    process_count = max(1, args.processes)
+    costs = args.costs or ((10, 12, 14, 16) if args.scheme == "scrypt" else (100000, 300000, 600000))
+    print(f"{args.scheme}, {process_count} processes")
+    try:
+        for cost in costs:
+            serial, pooled = benchmark_cost(args.scheme, cost, args.logins)
+            print(f"cost {cost:8d}  {1000 / serial:9.2f}ms per login  "
+                  f"{serial:9.1f} logins/s on one thread  {pooled:9.1f} logins/s in the pool")
+    finally:
+        shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+import argparse
+import collections
+import datetime
+import sys
+import database
+import jobs
+import models
+
+# Rolling borrow counts per book and "also borrowed" pairs
+# A background job folds in checkouts newer than the last one it saw, so nothing is ever
+# recounted from scratch, and the favorites list is a short read off the score index
+# CROSS JOIN in the read queries keeps SQLite walking the ranking index first
+
+# Days of checkouts that count towards a book's popularity
+popularity_days = 30
+
+# Earlier loans by the same user that each new checkout is paired with
+also_borrowed_history = 50
+
+# Checkouts folded in per transaction
+refresh_batch_size = 10000
+
+# Seconds between background refreshes
+refresh_interval = 600
+
+favorites_limit = 20
+
+STATE_QUERY = "SELECT value FROM PopularityState WHERE name = ?"
+
+SET_STATE_QUERY = """
+    INSERT INTO PopularityState (name, value) VALUES (?, ?)
+    ON CONFLICT (name) DO UPDATE SET value = excluded.value
+    """
+
+# Takes the borrows of days that left the window off the scores, then drops those days
+EXPIRE_SCORES_QUERY = """
+    UPDATE BookPopularity
+    SET score = score - (
+        SELECT SUM(borrows) FROM BookBorrowsDaily
+        WHERE BookBorrowsDaily.book_id = BookPopularity.book_id AND day < ?
+    )
+    WHERE book_id IN (SELECT book_id FROM BookBorrowsDaily WHERE day < ?)
+    """
+
+NEXT_BATCH_QUERY = """
+    SELECT MAX(cust_id), COUNT(*) FROM (
+        SELECT cust_id FROM CheckoutHistory WHERE cust_id > ? ORDER BY cust_id LIMIT ?
+    )
+    """
+
+ADD_DAILY_QUERY = """
+    INSERT INTO BookBorrowsDaily (book_id, day, borrows)
+    SELECT book_id, checkout_date, COUNT(*)
+    FROM CheckoutHistory
+    WHERE cust_id > ? AND cust_id <= ? AND checkout_date >= ?
+    GROUP BY book_id, checkout_date
+    ON CONFLICT (book_id, day) DO UPDATE SET borrows = borrows + excluded.borrows
+    """
+
+ADD_SCORES_QUERY = """
+    INSERT INTO BookPopularity (book_id, score)
+    SELECT book_id, COUNT(*)
+    FROM CheckoutHistory
+    WHERE cust_id > ? AND cust_id <= ? AND checkout_date >= ?
+    GROUP BY book_id
+    ON CONFLICT (book_id) DO UPDATE SET score = score + excluded.score
+    """
+
+NEW_LOANS_QUERY = """
+    SELECT user_id, book_id FROM CheckoutHistory
+    WHERE cust_id > ? AND cust_id <= ?
+    ORDER BY cust_id
+    """
+
+# A user's latest loans up to cust_id, newest first
+RECENT_LOANS_QUERY = """
+    SELECT book_id FROM CheckoutHistory
+    WHERE user_id = ? AND cust_id <= ?
+    ORDER BY cust_id DESC
+    LIMIT ?
+    """
+
+ADD_PAIR_QUERY = """
+    INSERT INTO AlsoBorrowed (book_id, other_id, together) VALUES (?, ?, ?)
+    ON CONFLICT (book_id, other_id) DO UPDATE SET together = together + excluded.together
+    """
+
+FAVORITES_QUERY = """
+    SELECT Books.book_id, Books.title, Books.author
+    FROM BookPopularity
+    CROSS JOIN Books ON Books.book_id = BookPopularity.book_id
+    ORDER BY BookPopularity.score DESC, BookPopularity.book_id
+    LIMIT ?
+    """
+
+ALSO_BORROWED_QUERY = """
+    SELECT Books.book_id, Books.title, Books.author
+    FROM AlsoBorrowed
+    CROSS JOIN Books ON Books.book_id = AlsoBorrowed.other_id
+    WHERE AlsoBorrowed.book_id = ?
+    ORDER BY AlsoBorrowed.together DESC, AlsoBorrowed.other_id
+    LIMIT ?
+    """
+
+TABLES = ("BookBorrowsDaily", "BookPopularity", "AlsoBorrowed", "PopularityState")
+
+
+def get_state(conn, name, default):
+    row = conn.execute(STATE_QUERY, (name,)).fetchone()
+    return default if row is None else row[0]
+
+# Drops days that fell out of the popularity window
+def expire_days(window_start):
+    def work(conn):
+        if get_state(conn, "window_start", "") >= window_start:
+            return
+        conn.execute(EXPIRE_SCORES_QUERY, (window_start, window_start))
+        conn.execute("DELETE FROM BookBorrowsDaily WHERE day < ?", (window_start,))
+        conn.execute("DELETE FROM BookPopularity WHERE score <= 0")
+        conn.execute(SET_STATE_QUERY, ("window_start", window_start))
+    # Nothing a session caches is touched
+    database.run_transaction(work, TABLES, ())
+
+# Pairs each new checkout both ways with the same user's last also_borrowed_history loans of other books
+# Only those recent loans are read per user, so a batch costs the same however long the history gets
+def add_pairs(conn, after_id, last_id):
+    recent = {}
+    together = collections.Counter()
+    for user_id, book_id in conn.execute(NEW_LOANS_QUERY, (after_id, last_id)).fetchall():
+        loans = recent.get(user_id)
+        if loans is None:
+            rows = conn.execute(RECENT_LOANS_QUERY, (user_id, after_id, also_borrowed_history)).fetchall()
+            loans = recent[user_id] = [row[0] for row in reversed(rows)]
+        for other_id in loans[-also_borrowed_history:]:
+            if other_id != book_id:
+                together[book_id, other_id] += 1
+                together[other_id, book_id] += 1
+        loans.append(book_id)
+    # In key order the upserts walk the pair index once instead of jumping around it
+    conn.executemany(ADD_PAIR_QUERY, [(book_id, other_id, count) for (book_id, other_id), count in sorted(together.items())])
+
+# Folds in the next batch of checkouts and returns how many there were, 0 when caught up
+def add_batch(window_start, batch_size = None):
+    batch_size = refresh_batch_size if batch_size is None else batch_size
+
+    def work(conn):
+        after_id = get_state(conn, "last_cust_id", 0)
+        last_id, count = conn.execute(NEXT_BATCH_QUERY, (after_id, batch_size)).fetchone()
+        if last_id is None:
+            return 0
+        conn.execute(ADD_DAILY_QUERY, (after_id, last_id, window_start))
+        conn.execute(ADD_SCORES_QUERY, (after_id, last_id, window_start))
+        add_pairs(conn, after_id, last_id)
+        conn.execute(SET_STATE_QUERY, ("last_cust_id", last_id))
+        return count
+
+    return database.run_transaction(work, TABLES, ())
+
+# Brings popularity up to date with every checkout so far and returns how many were folded in
+# Each batch picks up where the stored last_cust_id left off, so no cursor is passed along
+def refresh(progress = None):
+    window_start = (datetime.date.today() - datetime.timedelta(days = popularity_days - 1)).isoformat()
+    expire_days(window_start)
+    return jobs.run_batches(lambda cursor: (add_batch(window_start), None), progress = progress, pause = 0)
+
+# Most borrowed books over the last popularity_days, as models.Book
+def favorites(limit = None):
+    return database.fetch_query(FAVORITES_QUERY, (favorites_limit if limit is None else limit,),
+                                row_factory = models.book_row)
+
+# Books most often borrowed by people who borrowed book_id
+def also_borrowed(book_id, limit = None):
+    return database.fetch_query(ALSO_BORROWED_QUERY, (book_id, favorites_limit if limit is None else limit),
+                                row_factory = models.book_row)
+
+
+# Background thread that refreshes popularity on a fixed interval
+class PopularityUpdater(jobs.PeriodicJob):
+
+    def __init__(self, interval = None):
+        super().__init__(refresh, refresh_interval if interval is None else interval, "refreshing popularity")
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Update book popularity and show the favorites")
+    parser.add_argument("--db", default = database.db_name)
+    parser.add_argument("--limit", type = int, default = favorites_limit)
+    args = parser.parse_args(argv)
+
+    database.db_name = args.db
+    refresh(lambda total: print(f"{total} checkouts folded in", file = sys.stderr))
+    for book in favorites(args.limit):
+        print(f"{book.book_id:8d}  {book.title} by {book.author}")
+
+
+if __name__ == "__main__":
+    main()
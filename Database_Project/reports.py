@@ -0,0 +1,153 @@
+import argparse
+import csv
+import sys
+import database
+import fines
+
+# Days a loan has been overdue, checkouts are due two weeks after checkout_date
+DAYS_OVERDUE = "julianday(date('now', 'localtime')) - julianday(Checkouts.checkout_date) - 14"
+
+
+# A report's query selects its columns followed by the columns named in key
+# Rows are ordered by key, descending, and key is unique, so pages can be read by keyset
+# and no row is repeated or skipped between pages
+class Report:
+
+    def __init__(self, title, columns, query, key):
+        self.title = title
+        self.columns = columns
+        self.query = query
+        self.key = key
+
+
+reports = {
+    "overdue": Report(
+        "Overdue Books",
+        ("User", "Book", "Fine"),
+        database.OVERDUE_QUERY,
+        ("sort_fine", "sort_id"),
+    ),
+    "fines_by_user": Report(
+        "Total Fines per User",
+        ("User", "Overdue Books", "Total Fine"),
+        """
+        SELECT Users.username, totals.loans, totals.total, totals.total AS sort_total, totals.user_id AS sort_id
+        FROM (
+            SELECT user_id, COUNT(*) AS loans, SUM(fine) AS total
+            FROM Checkouts
+            WHERE return_date IS NULL AND fine > 0
+            GROUP BY user_id
+        ) AS totals
+        JOIN Users ON Users.user_id = totals.user_id
+        """,
+        ("sort_total", "sort_id"),
+    ),
+    # Counts archived loans too
+    "most_borrowed": Report(
+        "Most Borrowed Books",
+        ("Title", "Author", "Times Borrowed"),
+        """
+        SELECT Books.title, Books.author, counts.loans, counts.loans AS sort_loans, counts.book_id AS sort_id
+        FROM (
+            SELECT book_id, COUNT(*) AS loans
+            FROM CheckoutHistory
+            GROUP BY book_id
+        ) AS counts
+        JOIN Books ON Books.book_id = counts.book_id
+        """,
+        ("sort_loans", "sort_id"),
+    ),
+    "overdue_by_age": Report(
+        "Overdue Loans by Age",
+        ("Days Overdue", "Loans", "Total Fine"),
+        f"""
+        SELECT
+            CASE
+                WHEN {DAYS_OVERDUE} <= 7 THEN '1-7 days'
+                WHEN {DAYS_OVERDUE} <= 30 THEN '8-30 days'
+                WHEN {DAYS_OVERDUE} <= 90 THEN '31-90 days'
+                ELSE 'over 90 days'
+            END AS bucket,
+            COUNT(*),
+            SUM(fine),
+            MIN(checkout_date) AS sort_oldest
+        FROM Checkouts
+        WHERE return_date IS NULL AND checkout_date < date('now', 'localtime', '-14 days')
+        GROUP BY bucket
+        """,
+        # Buckets cover days that do not overlap, so no two start on the same day
+        ("sort_oldest",),
+    ),
+}
+
+# Reports read the latest snapshot when backup.py has published one, so they stay off the live file
+# Reports that use fines read the stored ones, which fines.FineSweeper keeps up to date,
+# and a snapshot had its fines refreshed when it was taken
+
+# The report's rows in key order, after the row with key after when it is given
+def ordered_query(report, after = None):
+    where = ""
+    if after is not None:
+        where = f"WHERE ({', '.join(report.key)}) < ({', '.join('?' * len(report.key))})"
+    order = ", ".join(f"{column} DESC" for column in report.key)
+    return f"SELECT * FROM ({report.query}) {where} ORDER BY {order}"
+
+# Streams every row of a report without building the result in memory
+def iter_report(name):
+    report = reports[name]
+    width = len(report.columns)
+    return (row[:width] for row in database.iter_query(ordered_query(report), snapshot = True))
+
+# One page of a report for on-screen display, the page after the one that ended at the key after
+# Returns (rows, key), key is where the next page starts or None on the last page
+def fetch_page(name, after = None, page_size = 50):
+    report = reports[name]
+    if after is not None and len(after) != len(report.key):
+        raise ValueError(f"A page key of {name} has {len(report.key)} values")
+    rows = database.fetch_query(
+        ordered_query(report, after) + " LIMIT ?",
+        (*(after or ()), page_size + 1),
+        cache = False, snapshot = True
+    )
+    width = len(report.columns)
+    next_key = tuple(rows[page_size - 1][width:]) if len(rows) > page_size else None
+    return [row[:width] for row in rows[:page_size]], next_key
+
+# Writes a report to a CSV file row by row and returns the number of rows
+def export_csv(name, path):
+    count = 0
+    with open(path, "w", newline = "", encoding = "utf-8") as file:
+        writer = csv.writer(file)
+        writer.writerow(reports[name].columns)
+        for row in iter_report(name):
+            writer.writerow(row)
+            count += 1
+    return count
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Run a library report")
+    parser.add_argument("report", choices = sorted(reports))
+    parser.add_argument("--csv", help = "write the report to this file instead of stdout")
+    parser.add_argument("--db", default = database.db_name)
+    parser.add_argument("--snapshot", help = "read this snapshot instead of the database, see backup.py")
+    parser.add_argument("--refresh-fines", action = "store_true", help = "bring stored fines up to date first")
+    args = parser.parse_args(argv)
+
+    database.db_name = args.db
+    if args.snapshot:
+        database.snapshot_names[args.db] = args.snapshot
+    database.initialize_db()
+    if args.refresh_fines:
+        fines.refresh_fines()
+
+    if args.csv:
+        print(f"Wrote {export_csv(args.report, args.csv)} rows to {args.csv}")
+    else:
+        writer = csv.writer(sys.stdout)
+        writer.writerow(reports[args.report].columns)
+        writer.writerows(iter_report(args.report))
+
+
+if __name__ == "__main__":
+    main()
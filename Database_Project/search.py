@@ -0,0 +1,174 @@
+import collections
+import re
+import threading
+import time
+import unicodedata
+import database
+import models
+
+# Maximum number of rows returned for one search
+result_limit = 200
+
+# Column weights for bm25 ranking: title, author, isbn
+bm25_weights = (10.0, 5.0, 1.0)
+
+TERM_PATTERN = re.compile(r"\w+")
+
+def split_terms(text):
+    return TERM_PATTERN.findall(text.lower())
+
+def has_fts(conn = None):
+    return database.has_book_search(conn or database.connect_db())
+
+# Builds an FTS5 MATCH expression where every term must match as a prefix
+# Terms are quoted so user input cannot inject FTS5 operators
+def build_match(terms):
+    return " ".join(f'"{term}"*' for term in terms)
+
+BM25 = f"bm25(BooksSearch, {', '.join(str(weight) for weight in bm25_weights)})"
+
+def match_query(columns):
+    return f"""
+        SELECT {columns}
+        FROM BooksSearch
+        JOIN Books ON Books.book_id = BooksSearch.rowid
+        WHERE BooksSearch MATCH ?
+        ORDER BY {BM25}
+        LIMIT ?
+        """
+
+SEARCH_QUERY = match_query("Books.book_id, Books.title, Books.author")
+
+RANKED_SEARCH_QUERY = match_query(f"{BM25}, Books.book_id, Books.title, Books.author")
+
+# Searches title, author and isbn, best matches first
+# Returns (book_id, title, author) rows like the Books listing queries
+def search_books(text, limit = None):
+    terms = split_terms(text)
+    if not terms:
+        return []
+    limit = result_limit if limit is None else limit
+
+    if has_fts():
+        return database.fetch_query(SEARCH_QUERY, (build_match(terms), limit), row_factory = models.book_row)
+
+    return fallback_search(terms, limit)
+
+# Like search_books, as (rank, book) pairs with lower ranks better,
+# for merging the results of several branches, see branches.py
+# Without FTS5 every book ranks 0
+def ranked_search(text, limit = None):
+    terms = split_terms(text)
+    if not terms:
+        return []
+    limit = result_limit if limit is None else limit
+
+    if has_fts():
+        rows = database.fetch_query(RANKED_SEARCH_QUERY, (build_match(terms), limit))
+        return [(rank, models.Book(*book)) for rank, *book in rows]
+
+    return [(0, book) for book in fallback_search(terms, limit)]
+
+# Used when SQLite was built without FTS5
+# Every term has to appear in the title, author or isbn
+def fallback_search(terms, limit):
+    conditions = []
+    parameters = []
+    for term in terms:
+        pattern = "%" + term + "%"
+        conditions.append("(title LIKE ? OR author LIKE ? OR isbn LIKE ?)")
+        parameters.extend((pattern, pattern, pattern))
+    parameters.append(limit)
+    return database.fetch_query(
+        f"SELECT book_id, title, author FROM Books WHERE {' AND '.join(conditions)} LIMIT ?",
+        tuple(parameters), row_factory = models.book_row
+    )
+
+
+# Recent searches kept by LiveSearch
+prefix_cache_size = 64
+
+# Lower case without accents, the way the FTS5 unicode61 tokenizer sees text
+def fold(text):
+    return "".join(c for c in unicodedata.normalize("NFKD", text.lower()) if not unicodedata.combining(c))
+
+# Whether a Book row would be found by the terms, checked in Python
+# Only title and author are looked at, so terms with digits (which may match an isbn) are never checked here
+def row_matches(row, terms, prefix):
+    text = fold(f"{row.title} {row.author}")
+    if prefix:
+        words = TERM_PATTERN.findall(text)
+        return all(any(word.startswith(term) for word in words) for term in terms)
+    return all(term in text for term in terms)
+
+# True when every row found by terms is also found by previous
+# Terms only ever add conditions, so the last term may grow and new terms may follow
+def narrows(terms, previous):
+    if not previous or len(terms) < len(previous):
+        return False
+    if terms[:len(previous) - 1] != previous[:-1] or not terms[len(previous) - 1].startswith(previous[-1]):
+        return False
+    return all(term.isalpha() for term in terms[len(previous) - 1:])
+
+
+# Search as you type
+# Results are remembered by their terms in a small LRU, so going back to an earlier query is free,
+# and a query that extends a remembered one with a complete result set is filtered from it
+# The remembered results are dropped whenever the catalog is written through this process,
+# and expire after ttl seconds like database.QueryCache, so writes by other processes show up too
+# Results filtered from a remembered query expire with it
+class LiveSearch:
+
+    def __init__(self, limit = None, size = None, ttl = None):
+        self.limit = result_limit if limit is None else limit
+        self.size = prefix_cache_size if size is None else size
+        self.ttl = database.cache_ttl if ttl is None else ttl
+        self.results = collections.OrderedDict()
+        self.stamp = None
+        self.lock = threading.Lock()
+
+    # Results without touching the database, or None when a query is needed
+    # Cheap enough to call on the Tk thread for every keystroke
+    def cached(self, text):
+        terms = tuple(fold(term) for term in split_terms(text))
+        if not terms:
+            return []
+        now = time.monotonic()
+        with self.lock:
+            if self.stamp != database.version_stamp("Books"):
+                self.results.clear()
+                return None
+            entry = self.results.get(terms)
+            if entry is not None and entry[3] > now:
+                self.results.move_to_end(terms)
+                return entry[0]
+            for previous, (rows, complete, prefix, expires) in reversed(self.results.items()):
+                if complete and expires > now and narrows(terms, previous):
+                    changed = terms[len(previous) - 1:]
+                    rows = [row for row in rows if row_matches(row, changed, prefix)]
+                    self.store(terms, rows, True, prefix, expires)
+                    return rows
+        return None
+
+    # Runs the query if it is not cached, meant for a worker thread
+    def search(self, text):
+        rows = self.cached(text)
+        if rows is not None:
+            return rows
+        terms = tuple(fold(term) for term in split_terms(text))
+        stamp = database.version_stamp("Books")
+        expires = time.monotonic() + self.ttl
+        prefix = has_fts()
+        rows = search_books(text, self.limit)
+        with self.lock:
+            if self.stamp != stamp:
+                self.results.clear()
+                self.stamp = stamp
+            self.store(terms, rows, len(rows) < self.limit, prefix, expires)
+        return rows
+
+    def store(self, terms, rows, complete, prefix, expires):
+        self.results[terms] = (rows, complete, prefix, expires)
+        self.results.move_to_end(terms)
+        while len(self.results) > self.size:
+            self.results.popitem(last = False)
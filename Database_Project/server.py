@@ -0,0 +1,361 @@
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import logging
+import re
+import sqlite3
+import urllib.parse
+import background
+import branches
+import database
+import passwords
+import service
+
+log = logging.getLogger("library.server")
+
+# Threads that run database work, also the cap on concurrent queries
+worker_count = 8
+
+# Requests allowed to wait for a worker before new ones are turned away with 503
+queue_limit = 512
+
+max_body_size = 1 << 20
+
+STATUS_TEXT = {
+    200: "OK", 201: "Created", 400: "Bad Request", 401: "Unauthorized", 403: "Forbidden",
+    404: "Not Found", 405: "Method Not Allowed", 409: "Conflict", 413: "Payload Too Large",
+    500: "Internal Server Error", 503: "Service Unavailable",
+}
+
+
+class HttpError(Exception):
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class Request:
+
+    def __init__(self, method, path, query, headers, body):
+        self.method = method
+        self.path = path
+        self.query = query
+        self.headers = headers
+        self.body = body
+        self.session = None
+        self.keep_alive = True
+
+    def json(self):
+        if not self.body:
+            return {}
+        try:
+            data = json.loads(self.body)
+        except ValueError:
+            raise HttpError(400, "Body is not valid JSON")
+        if not isinstance(data, dict):
+            raise HttpError(400, "Body must be a JSON object")
+        return data
+
+    def field(self, name):
+        value = self.json().get(name)
+        if value is None:
+            raise HttpError(400, f"Missing field: {name}")
+        return value
+
+    # A body field that must be a whole number, such as a book_id
+    def int_field(self, name):
+        value = self.field(name)
+        if isinstance(value, bool) or not isinstance(value, (int, str)):
+            raise HttpError(400, f"{name} must be an integer")
+        try:
+            return int(value)
+        except ValueError:
+            raise HttpError(400, f"{name} must be an integer")
+
+    # The logged in user's branch, otherwise the one named by ?branch=, None for the default
+    def branch(self):
+        if self.session is not None:
+            return self.session.branch_id
+        return self.query.get("branch", [None])[0]
+
+    # A report page key as returned in "next", a JSON array of numbers and strings, or None
+    def json_param(self, name):
+        text = self.query.get(name, [None])[0]
+        if text is None:
+            return None
+        try:
+            value = json.loads(text)
+        except ValueError:
+            raise HttpError(400, f"{name} must be JSON")
+        if not isinstance(value, list) or not all(isinstance(item, (int, float, str)) for item in value):
+            raise HttpError(400, f"{name} must be a JSON array of numbers and strings")
+        return value
+
+    # A query parameter clamped to [minimum, maximum], so a negative limit never reaches SQL as "no limit"
+    def int_param(self, name, default, minimum = None, maximum = None):
+        try:
+            value = int(self.query.get(name, [default])[0])
+        except ValueError:
+            raise HttpError(400, f"{name} must be an integer")
+        if minimum is not None:
+            value = max(value, minimum)
+        if maximum is not None:
+            value = min(value, maximum)
+        return value
+
+
+# Small HTTP/1.1 JSON server on asyncio streams
+# Handlers run on the event loop and hand every database call to a bounded thread pool
+class LibraryServer:
+
+    def __init__(self, workers = None, max_queue = None):
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers = workers or worker_count, thread_name_prefix = "db"
+        )
+        self.max_queue = queue_limit if max_queue is None else max_queue
+        self.pending = 0
+        self.routes = [
+            ("POST", r"/login", self.login, None),
+            ("POST", r"/logout", self.logout, "user"),
+            ("POST", r"/register", self.register, None),
+            ("GET", r"/books", self.list_books, None),
+            ("GET", r"/search", self.search, None),
+            ("GET", r"/search/all", self.search_all, None),
+            ("GET", r"/favorites", self.favorites, None),
+            ("GET", r"/books/(\d+)/also-borrowed", self.also_borrowed, None),
+            ("GET", r"/loans", self.loans, "user"),
+            ("POST", r"/checkout", self.checkout, "user"),
+            ("POST", r"/return", self.return_book, "user"),
+            ("GET", r"/holds", self.holds, "user"),
+            ("POST", r"/holds", self.place_hold, "user"),
+            ("DELETE", r"/holds/(\d+)", self.cancel_hold, "user"),
+            ("POST", r"/books", self.add_book, "admin"),
+            ("DELETE", r"/books/(\d+)", self.delete_book, "admin"),
+            ("GET", r"/reports/(\w+)", self.report, "admin"),
+        ]
+
+    # Runs a blocking service call on a database worker, in the request's branch
+    async def call(self, request, fn, *args):
+        if self.pending >= self.max_queue:
+            raise HttpError(503, "Server is busy")
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor, database.in_branch, request.branch(), fn, *args
+            )
+        finally:
+            self.pending -= 1
+
+    async def login(self, request):
+        session = await self.call(request, service.login, str(request.field("username")), str(request.field("password")))
+        if session is None:
+            raise HttpError(401, "Invalid username or password")
+        return 200, {"user_id": session.user_id, "is_admin": session.is_admin, "token": session.token}
+
+    async def logout(self, request):
+        service.logout(request.session.token)
+        return 200, {"logged_out": True}
+
+    async def register(self, request):
+        await self.call(request, service.register, str(request.field("username")), str(request.field("email")), str(request.field("password")))
+        return 201, {"registered": True}
+
+    async def list_books(self, request):
+        rows = await self.call(request, service.books_after, request.int_param("after", 0, 0), request.int_param("limit", 50, 1, 500))
+        return 200, {"books": [book._asdict() for book in rows]}
+
+    async def search(self, request):
+        text = request.query.get("q", [""])[0]
+        rows = await self.call(request, service.search_books, text, request.int_param("limit", 50, 1, 500))
+        return 200, {"books": [book._asdict() for book in rows]}
+
+    # Searches every branch, each book comes with its branch_id
+    async def search_all(self, request):
+        text = request.query.get("q", [""])[0]
+        rows = await self.call(request, service.search_all_branches, text, request.int_param("limit", 50, 1, 500))
+        return 200, {"books": [book._asdict() for book in rows]}
+
+    async def favorites(self, request):
+        rows = await self.call(request, service.favorites, request.int_param("limit", 20, 1, 100))
+        return 200, {"books": [book._asdict() for book in rows]}
+
+    async def also_borrowed(self, request, book_id):
+        rows = await self.call(request, service.also_borrowed, int(book_id), request.int_param("limit", 20, 1, 100))
+        return 200, {"books": [book._asdict() for book in rows]}
+
+    async def loans(self, request):
+        rows = await self.call(request, service.loans, request.session)
+        return 200, {"loans": [loan._asdict() for loan in rows]}
+
+    async def checkout(self, request):
+        if not await self.call(request, service.checkout, request.session.user_id, request.int_field("book_id")):
+            raise HttpError(409, "No more copies of this book are available for checkout.")
+        return 200, {"checked_out": True}
+
+    async def return_book(self, request):
+        if not await self.call(request, service.return_book, request.session.user_id, request.int_field("book_id")):
+            raise HttpError(404, "No open checkout of this book")
+        return 200, {"returned": True}
+
+    async def holds(self, request):
+        rows = await self.call(request, service.holds, request.session.user_id)
+        return 200, {"holds": [hold._asdict() for hold in rows]}
+
+    async def place_hold(self, request):
+        place = await self.call(request, service.place_hold, request.session.user_id, request.int_field("book_id"))
+        if place is None:
+            raise HttpError(409, "A copy of this book is available, check it out instead.")
+        return 201, {"place": place}
+
+    async def cancel_hold(self, request, book_id):
+        if not await self.call(request, service.cancel_hold, request.session.user_id, int(book_id)):
+            raise HttpError(404, "No hold on this book")
+        return 200, {"cancelled": True}
+
+    async def add_book(self, request):
+        data = request.json()
+        await self.call(request, service.add_book, str(data.get("title", "")), str(data.get("author", "")),
+                        str(data.get("isbn", "")), data.get("copies"))
+        return 201, {"added": True}
+
+    async def delete_book(self, request, book_id):
+        await self.call(request, service.delete_book, int(book_id))
+        return 200, {"deleted": True}
+
+    async def report(self, request, name):
+        if name not in service.report_names():
+            raise HttpError(404, f"Unknown report: {name}")
+        page_size = request.int_param("page_size", 50, 1, 500)
+        rows, next_key = await self.call(request, service.report_page, name, request.json_param("after"), page_size)
+        return 200, {
+            "columns": service.report_definition(name).columns,
+            "rows": rows,
+            "has_more": next_key is not None,
+            "next": next_key,
+        }
+
+    # The session rechecks the role only when Users has been written since it was last read
+    async def authorize(self, request, role):
+        if role is None:
+            return
+        header = request.headers.get("authorization", "")
+        session = await self.call(request, service.session, header[7:]) if header.startswith("Bearer ") else None
+        if session is None:
+            raise HttpError(401, "Login required")
+        if role == "admin" and not session.is_admin:
+            raise HttpError(403, "Admin only")
+        request.session = session
+
+    async def dispatch(self, request):
+        allowed = False
+        for method, pattern, handler, role in self.routes:
+            match = re.fullmatch(pattern, request.path)
+            if match is None:
+                continue
+            allowed = True
+            if method != request.method:
+                continue
+            try:
+                await self.authorize(request, role)
+                return await handler(request, *match.groups())
+            except (TypeError, ValueError) as e:
+                raise HttpError(400, str(e))
+            except sqlite3.IntegrityError as e:
+                raise HttpError(409, str(e))
+        raise HttpError(405 if allowed else 404, "Method not allowed" if allowed else "Not found")
+
+    async def read_request(self, reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        try:
+            method, target, version = line.decode("latin-1").split()
+        except ValueError:
+            raise HttpError(400, "Malformed request line")
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length", 0) or 0)
+        if length > max_body_size:
+            raise HttpError(413, "Request body too large")
+        body = await reader.readexactly(length) if length else b""
+        url = urllib.parse.urlsplit(target)
+        request = Request(method.upper(), url.path.rstrip("/") or "/", urllib.parse.parse_qs(url.query), headers, body)
+        request.keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+        return request
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                keep_alive = False
+                try:
+                    request = await self.read_request(reader)
+                    if request is None:
+                        break
+                    keep_alive = request.keep_alive
+                    status, payload = await self.dispatch(request)
+                except HttpError as e:
+                    status, payload = e.status, {"error": e.message}
+                except Exception:
+                    log.exception("Error handling request")
+                    status, payload = 500, {"error": "Internal server error"}
+
+                body = json.dumps(payload).encode()
+                writer.write(
+                    f"HTTP/1.1 {status} {STATUS_TEXT[status]}\r\n"
+                    f"Content-Type: application/json\r\n"
+                    f"Content-Length: {len(body)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode() + body
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle_connection, host, port, backlog = 1024)
+        print(f"Serving on http://{host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Serve the library over HTTP/JSON")
+    parser.add_argument("--host", default = "127.0.0.1")
+    parser.add_argument("--port", type = int, default = 8080)
+    parser.add_argument("--db", default = database.db_name)
+    parser.add_argument("--workers", type = int, default = worker_count)
+    parser.add_argument("--no-group-commit", action = "store_true", help = "commit each write on its own")
+    parser.add_argument("--branches", metavar = "CONFIG", help = "JSON file mapping branch ids to database files")
+    parser.add_argument("--default-branch", help = "branch for requests that do not name one")
+    args = parser.parse_args(argv)
+
+    database.db_name = args.db
+    if args.branches:
+        branches.load(args.branches, args.default_branch)
+    database.group_commit_enabled = not args.no_group_commit
+    database.initialize_db()
+    # Fines, holds, archiving, snapshots and popularity run for every branch
+    jobs = background.start_background_jobs()
+    try:
+        asyncio.run(LibraryServer(args.workers).serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        background.stop_background_jobs(jobs)
+        passwords.shutdown()
+        branches.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+import branches
+import database
+import models
+import passwords
+import popularity
+import reports
+import search
+import sessions
+
+# Library operations with no dependency on Tk
+# The desktop app and the HTTP server both call these, so the rules live in one place
+# Every function is blocking and should run on a database worker thread
+
+
+# Returns a models.User or None when the credentials are wrong
+# A password stored in plaintext or with outdated hash settings is rehashed once it checks out
+def authenticate(username, password):
+    rows = database.fetch_query(database.LOGIN_QUERY, (username.strip(),), cache = False)
+    password = password.strip()
+    stored = rows[0][2] if rows else passwords.get_dummy_hash()
+    if not passwords.run(passwords.verify_password, password, stored) or not rows:
+        return None
+    user_id, is_admin, stored = rows[0]
+    if passwords.needs_rehash(stored):
+        database.execute_query(
+            "UPDATE Users SET password = ? WHERE user_id = ? AND password = ?",
+            (passwords.run(passwords.hash_password, password), user_id, stored)
+        )
+    return models.User(user_id, username.strip(), bool(is_admin))
+
+# Returns a sessions.Session for the user or None when the credentials are wrong
+# Users log in to the branch they are in, see database.use_branch, and their session stays there
+def login(username, password):
+    stamp = database.version_stamp("Users")
+    user = authenticate(username, password)
+    if user is None:
+        return None
+    return sessions.store.create(user.user_id, user.username, user.is_admin, stamp, database.current_branch())
+
+# Returns the session for a token, or None once it has expired or been logged out
+def session(token):
+    return sessions.store.get(token)
+
+def logout(token):
+    sessions.store.drop(token)
+
+# Raises ValueError for bad input and sqlite3.IntegrityError for a taken username or email
+def register(username, email, password):
+    username, email, password = username.strip(), email.strip(), password.strip()
+    if not username or not email or not password:
+        raise ValueError("All fields are required.")
+    database.execute_query(
+        "INSERT INTO Users (username, email, password) VALUES (?, ?, ?)",
+        (username, email, passwords.run(passwords.hash_password, password))
+    )
+
+def search_books(text, limit = None):
+    return search.search_books(text, limit)
+
+# Searches every branch's catalog, rows are models.BranchBook
+def search_all_branches(text, limit = None):
+    return branches.search_all(text, limit)
+
+# Most borrowed books lately, read from the precomputed popularity table
+def favorites(limit = None):
+    return popularity.favorites(limit)
+
+def also_borrowed(book_id, limit = None):
+    return popularity.also_borrowed(book_id, limit)
+
+# Search as you type, shared by everything in this process
+typeahead = search.LiveSearch()
+
+# Results for text if they can be had without a query, otherwise None
+def cached_search(text):
+    return typeahead.cached(text)
+
+def live_search(text):
+    return typeahead.search(text)
+
+# Catalog paging by book_id for list views, rows are models.Book
+def book_id_range():
+    return database.fetch_query("SELECT MIN(book_id), MAX(book_id) FROM Books")[0]
+
+def books_after(book_id, limit):
+    return database.fetch_query(
+        "SELECT book_id, title, author FROM Books WHERE book_id > ? ORDER BY book_id LIMIT ?",
+        (book_id, limit), row_factory = models.book_row
+    )
+
+def books_before(book_id, limit):
+    rows = database.fetch_query(
+        "SELECT book_id, title, author FROM Books WHERE book_id < ? ORDER BY book_id DESC LIMIT ?",
+        (book_id, limit), row_factory = models.book_row
+    )
+    return rows[::-1]
+
+# Open loans for a user as models.Checkout records
+# Served from the session until the user's loans or the catalog change
+def loans(session):
+    return session.open_loans()
+
+# Returns False when no copies are left
+def checkout(user_id, book_id):
+    return database.checkout(user_id, book_id)
+
+# Returns False when the user has no open loan of the book
+def return_book(user_id, book_id):
+    return database.return_book(user_id, book_id)
+
+# Returns the user's place in the queue, or None when a copy is on the shelf to check out instead
+def place_hold(user_id, book_id):
+    return database.place_hold(user_id, book_id)
+
+# Returns False when the user holds nothing for the book
+def cancel_hold(user_id, book_id):
+    return database.cancel_hold(user_id, book_id)
+
+# The user's holds as models.Hold records
+def holds(user_id):
+    return database.fetch_query(database.USER_HOLDS_QUERY, (user_id,), row_factory = models.hold_row)
+
+# Raises ValueError when a field is missing or copies is not a positive integer
+def add_book(title, author, isbn, copies):
+    title, author, isbn = title.strip(), author.strip(), isbn.strip()
+    if not title or not author or not isbn or copies in (None, ""):
+        raise ValueError("All fields are required.")
+    copies = int(copies)
+    if copies <= 0:
+        raise ValueError("Copies must be a postive integer.")
+    database.execute_query(
+        "INSERT INTO Books (title, author, isbn, copies, available) VALUES (?,?,?,?,?)",
+        (title, author, isbn, copies, copies)
+    )
+
+# Holds on the book go with it
+def delete_book(book_id):
+    def work(conn):
+        conn.execute("DELETE FROM Holds WHERE book_id = ?", (book_id,))
+        conn.execute("DELETE FROM Books WHERE book_id = ?", (book_id,))
+    database.run_transaction(work, ("Books", "Holds"))
+
+def report_names():
+    return list(reports.reports)
+
+# Title and column names of a report
+def report_definition(name):
+    return reports.reports[name]
+
+# Returns (rows, key), pass key back as after for the next page, None means this was the last
+def report_page(name, after, page_size):
+    return reports.fetch_page(name, after, page_size)
+
+def export_report(name, path):
+    return reports.export_csv(name, path)
@@ -0,0 +1,126 @@
+import collections
+import datetime
+import secrets
+import threading
+import time
+import database
+import models
+
+# Logged in users and what the app keeps asking about them
+# A session holds the user's profile and open loans along with the version stamps they were read at,
+# and only goes back to the database once a write through database.py has moved a stamp on,
+# or after database.cache_ttl seconds, since writes by other processes move no stamps here
+# Sessions read from the user's own branch, whichever branch the caller is in
+
+# Seconds a session stays alive without being used
+session_ttl = 8 * 3600
+
+# Least recently used sessions are dropped past this many
+max_sessions = 10000
+
+PROFILE_QUERY = "SELECT user_id, username, is_admin FROM Users WHERE user_id = ?"
+
+# Same rule as database.FINE_EXPRESSION, worked out here so cached loans stay correct from day to day
+def fine_on(checkout_date, today):
+    if checkout_date is None:
+        return 0
+    days = (today - datetime.date.fromisoformat(checkout_date)).days
+    return 0 if days <= 14 else days - 5
+
+
+class Session:
+    __slots__ = ("token", "user_id", "branch_id", "username", "is_admin", "profile_stamp", "profile_expires",
+                 "loans", "loans_stamp", "loans_expires", "last_used")
+
+    def __init__(self, token, user_id, username, is_admin, profile_stamp, branch_id = None):
+        self.token = token
+        self.user_id = user_id
+        self.branch_id = branch_id
+        self.username = username
+        self.is_admin = is_admin
+        self.profile_stamp = profile_stamp
+        self.profile_expires = time.monotonic() + database.cache_ttl
+        self.loans = None
+        self.loans_stamp = None
+        self.loans_expires = 0
+        self.last_used = time.monotonic()
+
+    def current_profile_stamp(self):
+        return database.version_stamp("Users")
+
+    def current_loans_stamp(self):
+        return database.version_stamp("Books", "Checkouts", ("loans", self.user_id))
+
+    # Rereads username and role if Users was written since they were loaded, or they are cache_ttl old
+    # An admin whose role is taken away loses it on their next request
+    def refresh_profile(self):
+        stamp = self.current_profile_stamp()
+        now = time.monotonic()
+        if stamp == self.profile_stamp and now < self.profile_expires:
+            return
+        with database.use_branch(self.branch_id):
+            rows = database.fetch_query(PROFILE_QUERY, (self.user_id,), cache = False, row_factory = models.user_row)
+        if rows:
+            self.username = rows[0].username
+            self.is_admin = bool(rows[0].is_admin)
+        else:
+            self.is_admin = False
+        self.profile_stamp = stamp
+        self.profile_expires = now + database.cache_ttl
+
+    # Open loans as models.Checkout records with fines as of today
+    def open_loans(self):
+        stamp = self.current_loans_stamp()
+        now = time.monotonic()
+        if stamp != self.loans_stamp or now >= self.loans_expires:
+            with database.use_branch(self.branch_id):
+                self.loans = tuple(database.fetch_query(
+                    database.CHECKED_OUT_QUERY, (self.user_id,), cache = False, row_factory = models.checkout_row
+                ))
+            self.loans_stamp = stamp
+            self.loans_expires = now + database.cache_ttl
+        today = datetime.date.today()
+        return [loan._replace(fine = fine_on(loan.checkout_date, today)) for loan in self.loans]
+
+
+class SessionStore:
+
+    def __init__(self, ttl = None, size = None):
+        self.ttl = session_ttl if ttl is None else ttl
+        self.size = max_sessions if size is None else size
+        self.sessions = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    # profile_stamp must have been read before the login query that found the user
+    def create(self, user_id, username, is_admin, profile_stamp, branch_id = None):
+        session = Session(secrets.token_urlsafe(24), user_id, username, bool(is_admin), profile_stamp, branch_id)
+        with self.lock:
+            self.sessions[session.token] = session
+            while len(self.sessions) > self.size:
+                self.sessions.popitem(last = False)
+        return session
+
+    # Returns the live session for a token or None
+    def get(self, token):
+        now = time.monotonic()
+        with self.lock:
+            session = self.sessions.get(token)
+            if session is None:
+                return None
+            if now - session.last_used > self.ttl:
+                del self.sessions[token]
+                return None
+            session.last_used = now
+            self.sessions.move_to_end(token)
+        session.refresh_profile()
+        return session
+
+    def drop(self, token):
+        with self.lock:
+            self.sessions.pop(token, None)
+
+    def __len__(self):
+        return len(self.sessions)
+
+
+store = SessionStore()
@@ -0,0 +1,65 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import backup
+import database
+import passwords
+
+# Fixture shared by the tests: every test gets a fresh library database in a temporary directory,
+# snapshots taken next to it and cheap password hashing on the calling thread
+# The module settings a test may change are put back afterwards
+
+
+class DatabaseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.saved = (
+            database.db_name, database.branch_files, database.default_branch, database.snapshot_dir,
+            database.group_commit_enabled, passwords.process_count, passwords.scrypt_cost,
+        )
+        database.db_name = self.path("library.db")
+        database.snapshot_dir = self.path("snapshots")
+        passwords.process_count = 0
+        passwords.scrypt_cost = 4
+
+    def tearDown(self):
+        database.group_commit_enabled = False
+        database.close_db()
+        database.query_cache.clear()
+        database.snapshot_names.clear()
+        database.usable_snapshots.clear()
+        backup.owned.clear()
+        (
+            database.db_name, database.branch_files, database.default_branch, database.snapshot_dir,
+            database.group_commit_enabled, passwords.process_count, passwords.scrypt_cost,
+        ) = self.saved
+        self.directory.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.directory.name, name)
+
+    # Adds users named user0, user1, ... to the current branch and returns their ids
+    def add_users(self, count, password = "x"):
+        conn = database.connect_db()
+        conn.executemany(
+            "INSERT INTO Users (username, email, password) VALUES (?, ?, ?)",
+            [(f"user{i}", f"user{i}@example.com", password) for i in range(count)]
+        )
+        conn.commit()
+        return [row[0] for row in conn.execute("SELECT user_id FROM Users ORDER BY user_id")]
+
+    # Adds books titled "<title> 0", "<title> 1", ... to the current branch and returns their ids
+    def add_books(self, count, copies = 1, title = "Book", author = "Author"):
+        conn = database.connect_db()
+        first = conn.execute("SELECT COUNT(*) FROM Books").fetchone()[0]
+        conn.executemany(
+            "INSERT INTO Books (title, author, isbn, copies, available) VALUES (?, ?, ?, ?, ?)",
+            [(f"{title} {i}", author, f"{first + i:013d}", copies, copies) for i in range(count)]
+        )
+        conn.commit()
+        return [row[0] for row in conn.execute("SELECT book_id FROM Books ORDER BY book_id")][first:]
@@ -0,0 +1,74 @@
+import datetime
+import unittest
+
+import support
+
+import archive
+import database
+
+HISTORY_QUERY = "SELECT cust_id, user_id, book_id, checkout_date, return_date, fine FROM CheckoutHistory ORDER BY cust_id"
+
+
+class ArchiveTest(support.DatabaseTest):
+
+    def setUp(self):
+        super().setUp()
+        self.user_ids = self.add_users(3)
+        self.book_ids = self.add_books(4)
+        today = datetime.date.today()
+
+        def day(days_ago):
+            return (today - datetime.timedelta(days = days_ago)).isoformat()
+
+        # (days since checkout, days since return or None while still out)
+        self.loans = [(800, 790), (700, 400), (500, 366), (400, 300), (40, 30), (900, None), (20, None)] * 3
+        conn = database.connect_db()
+        conn.executemany(
+            "INSERT INTO Checkouts (user_id, book_id, checkout_date, return_date, fine) VALUES (?, ?, ?, ?, ?)",
+            [
+                (self.user_ids[i % 3], self.book_ids[i % 4], day(out), None if back is None else day(back), i)
+                for i, (out, back) in enumerate(self.loans)
+            ]
+        )
+        conn.commit()
+
+    def history(self):
+        return database.fetch_query(HISTORY_QUERY)
+
+    def count(self, table):
+        return database.fetch_query(f"SELECT COUNT(*) FROM {table}", cache = False)[0][0]
+
+    def test_old_returned_loans_move_to_the_archive(self):
+        before = self.history()
+        old = sum(1 for out, back in self.loans if back is not None and back > 365)
+        moved = archive.archive_checkouts(batch_size = 2)
+        self.assertEqual(moved, old)
+        self.assertEqual(self.count("CheckoutsArchive"), old)
+        self.assertEqual(self.count("Checkouts"), len(self.loans) - old)
+        # Open loans never move, however old
+        self.assertEqual(self.count("Checkouts WHERE return_date IS NULL"), 6)
+        self.assertEqual(self.history(), before)
+
+    def test_archiving_again_moves_nothing(self):
+        archive.archive_checkouts()
+        self.assertEqual(archive.archive_checkouts(), 0)
+
+    def test_days_sets_the_cutoff(self):
+        self.assertEqual(archive.archive_checkouts(days = 10), 15)
+        self.assertEqual(self.count("Checkouts"), 6)
+
+    def test_batches_report_progress(self):
+        totals = []
+        archive.archive_checkouts(batch_size = 4, progress = totals.append)
+        self.assertEqual(totals, [4, 8, 9])
+
+    def test_open_loans_can_still_be_returned(self):
+        archive.archive_checkouts()
+        user_id, book_id = database.fetch_query(
+            "SELECT user_id, book_id FROM Checkouts WHERE return_date IS NULL ORDER BY cust_id LIMIT 1", cache = False
+        )[0]
+        self.assertTrue(database.return_book(user_id, book_id))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+import os
+import shutil
+import sqlite3
+import unittest
+
+import support
+
+import backup
+import database
+
+TITLES_QUERY = "SELECT title FROM Books ORDER BY book_id"
+
+
+class SnapshotTest(support.DatabaseTest):
+
+    def setUp(self):
+        super().setUp()
+        self.add_books(3)
+
+    def titles(self, snapshot = False):
+        return [row[0] for row in database.fetch_query(TITLES_QUERY, snapshot = snapshot)]
+
+    # Copies a snapshot under the name it would have been taken at, oldest names sort first
+    def copy_snapshot(self, source, stamp, user_version = None):
+        path = os.path.join(database.snapshot_dir, f"{database.snapshot_prefix()}{stamp}.db")
+        shutil.copy(source, path)
+        if user_version is not None:
+            os.chmod(path, 0o644)
+            conn = sqlite3.connect(path)
+            conn.execute(f"PRAGMA user_version = {user_version}")
+            conn.close()
+        return path
+
+    def test_snapshot_is_verified_read_only_and_published(self):
+        path = backup.take_snapshot()
+        backup.verify(path)
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o444)
+        self.assertEqual(database.current_snapshot(), path)
+        self.assertFalse(os.path.exists(path + ".partial"))
+
+    def test_snapshot_reads_do_not_see_later_writes(self):
+        backup.take_snapshot()
+        database.execute_query("UPDATE Books SET title = 'Renamed'")
+        self.assertEqual(self.titles(snapshot = True), ["Book 0", "Book 1", "Book 2"])
+        self.assertEqual(self.titles(), ["Renamed"] * 3)
+
+    def test_without_a_snapshot_the_live_file_is_read(self):
+        self.assertIsNone(database.current_snapshot())
+        self.assertEqual(self.titles(snapshot = True), self.titles())
+
+    def test_damaged_file_fails_verification(self):
+        path = self.path("damaged.db")
+        with open(path, "wb") as file:
+            file.write(b"SQLite format 3\0" + os.urandom(4096))
+        with self.assertRaises(backup.BackupError):
+            backup.verify(path)
+
+    def test_file_on_an_old_schema_fails_verification(self):
+        path = self.path("old.db")
+        backup.backup_to(path)
+        conn = sqlite3.connect(path)
+        conn.execute(f"PRAGMA user_version = {database.schema_version - 1}")
+        conn.close()
+        with self.assertRaises(backup.BackupError):
+            backup.verify(path)
+
+    # Another process's snapshots are found on disk by name, and the newest one on the current schema is read
+    def test_newest_usable_snapshot_on_disk_is_read(self):
+        path = backup.take_snapshot()
+        database.snapshot_names.clear()
+        older = self.copy_snapshot(path, "20000101-000000")
+        newest = self.copy_snapshot(path, "29990101-000000", database.schema_version - 1)
+        self.assertFalse(database.snapshot_usable(newest))
+        self.assertEqual(database.list_snapshots()[0], older)
+        self.assertEqual(database.list_snapshots()[-1], newest)
+        self.assertEqual(database.current_snapshot(), path)
+
+    # library-east-... belongs to another file, not to library.db
+    def test_snapshots_of_other_files_are_ignored(self):
+        path = backup.take_snapshot()
+        other = os.path.join(database.snapshot_dir, os.path.basename(path).replace("library-", "library-east-"))
+        shutil.copy(path, other)
+        self.assertEqual(database.list_snapshots(), [path])
+
+    def test_pinned_snapshot_is_read_until_it_is_deleted(self):
+        path = backup.take_snapshot()
+        pinned = self.copy_snapshot(path, "20000101-000000")
+        backup.publish(pinned)
+        self.assertEqual(database.current_snapshot(), pinned)
+        os.remove(pinned)
+        self.assertEqual(database.current_snapshot(), path)
+
+    # Only snapshots this process owns are pruned
+    def test_prune_keeps_the_newest_and_skips_others(self):
+        path = backup.take_snapshot()
+        owned = [self.copy_snapshot(path, f"2000010{i}-000000") for i in range(1, 4)]
+        foreign = self.copy_snapshot(path, "20000101-120000")
+        backup.owned.update(owned)
+        keep = backup.snapshot_keep
+        backup.snapshot_keep = 2
+        try:
+            backup.prune()
+        finally:
+            backup.snapshot_keep = keep
+        self.assertEqual(database.list_snapshots(), [foreign, owned[2], path])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,108 @@
+import sqlite3
+import threading
+import unittest
+
+import support
+
+import branches
+import database
+import jobs
+import service
+
+
+class BranchTest(support.DatabaseTest):
+
+    def setUp(self):
+        super().setUp()
+        self.files = {"east": self.path("east.db"), "west": self.path("west.db")}
+        branches.configure(self.files, "east")
+        self.book_ids = {}
+        self.user_ids = {}
+        for branch_id, title in (("east", "Eastern Tales"), ("west", "Western Tales")):
+            with database.use_branch(branch_id):
+                self.book_ids[branch_id] = self.add_books(3, title = title)
+                self.user_ids[branch_id] = self.add_users(2)
+
+    def tearDown(self):
+        branches.shutdown()
+        super().tearDown()
+
+    # Reads a file directly, past the pool and the query cache
+    def count_loans(self, branch_id):
+        conn = sqlite3.connect(self.files[branch_id])
+        try:
+            return conn.execute("SELECT COUNT(*) FROM Checkouts").fetchone()[0]
+        finally:
+            conn.close()
+
+    def titles(self):
+        return {row[0].split()[0] for row in database.fetch_query("SELECT title FROM Books")}
+
+    def test_default_branch_is_used_outside_use_branch(self):
+        self.assertEqual(database.branch_db_name(), self.files["east"])
+        with database.use_branch("west"):
+            self.assertEqual(database.branch_db_name(), self.files["west"])
+        self.assertEqual(database.branch_db_name(), self.files["east"])
+
+    def test_unknown_branch_is_an_error(self):
+        with self.assertRaises(ValueError):
+            database.branch_db_name("north")
+        with self.assertRaises(ValueError):
+            branches.configure(self.files, "north")
+
+    # The same query text is cached once per file
+    def test_reads_and_cache_stay_in_their_branch(self):
+        self.assertEqual(self.titles(), {"Eastern"})
+        self.assertEqual(database.in_branch("west", self.titles), {"Western"})
+        self.assertEqual(self.titles(), {"Eastern"})
+
+    def test_writes_go_to_the_branch_file(self):
+        with database.use_branch("west"):
+            self.assertTrue(database.checkout(self.user_ids["west"][0], self.book_ids["west"][0]))
+        self.assertEqual((self.count_loans("east"), self.count_loans("west")), (0, 1))
+
+    def test_group_commit_writes_go_to_the_branch_file(self):
+        database.group_commit_enabled = True
+        for branch_id, book in (("west", 0), ("west", 1), ("east", 2)):
+            with database.use_branch(branch_id):
+                self.assertTrue(database.checkout(self.user_ids[branch_id][0], self.book_ids[branch_id][book]))
+        self.assertEqual((self.count_loans("east"), self.count_loans("west")), (1, 2))
+        self.assertIsNot(database.in_branch("east", database.get_writer), database.in_branch("west", database.get_writer))
+
+    def test_search_all_merges_every_branch(self):
+        books = branches.search_all("tales")
+        self.assertEqual(len(books), 6)
+        for book in books:
+            self.assertEqual(book.title.split()[0], {"east": "Eastern", "west": "Western"}[book.branch_id])
+            self.assertIn(book.book_id, self.book_ids[book.branch_id])
+
+    # A session reads loans from the branch the user logged in to, whichever branch the caller is in
+    def test_sessions_stay_in_their_branch(self):
+        with database.use_branch("west"):
+            service.register("reader", "reader@example.com", "secret")
+            session = service.login("reader", "secret")
+            user_id = session.user_id
+            database.checkout(user_id, self.book_ids["west"][1])
+        self.assertIsNone(service.login("reader", "secret"))
+        self.assertEqual(session.branch_id, "west")
+        self.assertEqual([loan.book_id for loan in service.loans(session)], [self.book_ids["west"][1]])
+
+    def test_periodic_jobs_run_in_the_branch_they_were_made_in(self):
+        seen = []
+        ran = threading.Event()
+
+        def record():
+            seen.append(database.branch_db_name())
+            ran.set()
+
+        with database.use_branch("west"):
+            job = jobs.PeriodicJob(record, 3600, "recording the branch")
+        job.start()
+        self.assertTrue(ran.wait(5))
+        job.stop()
+        job.join()
+        self.assertEqual(seen, [self.files["west"]])
+
+
+if __name__ == "__main__":
+    unittest.main()
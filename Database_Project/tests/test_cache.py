@@ -0,0 +1,82 @@
+import unittest
+
+import support
+
+import database
+
+BOOKS_QUERY = "SELECT title FROM Books ORDER BY book_id"
+HISTORY_QUERY = "SELECT COUNT(*) FROM CheckoutHistory"
+USERS_QUERY = "SELECT username FROM Users ORDER BY user_id"
+
+
+class QueryCacheTest(support.DatabaseTest):
+
+    def setUp(self):
+        super().setUp()
+        self.user_ids = self.add_users(2)
+        self.book_ids = self.add_books(3)
+
+    def hits(self):
+        return database.cache_stats()["hits"]
+
+    def test_repeated_reads_are_served_from_the_cache(self):
+        rows = database.fetch_query(BOOKS_QUERY)
+        hits = self.hits()
+        self.assertEqual(database.fetch_query(BOOKS_QUERY), rows)
+        self.assertEqual(self.hits(), hits + 1)
+
+    def test_uncached_reads_skip_the_cache(self):
+        database.fetch_query(BOOKS_QUERY, cache = False)
+        database.fetch_query(BOOKS_QUERY, cache = False)
+        self.assertEqual(database.cache_stats()["entries"], 0)
+
+    def test_writes_drop_reads_of_the_table(self):
+        database.fetch_query(BOOKS_QUERY)
+        database.execute_query("UPDATE Books SET title = 'Renamed' WHERE book_id = ?", (self.book_ids[0],))
+        self.assertEqual(database.fetch_query(BOOKS_QUERY)[0], ("Renamed",))
+
+    def test_writes_keep_reads_of_other_tables(self):
+        database.fetch_query(USERS_QUERY)
+        database.execute_query("UPDATE Books SET title = 'Renamed' WHERE book_id = ?", (self.book_ids[0],))
+        hits = self.hits()
+        database.fetch_query(USERS_QUERY)
+        self.assertEqual(self.hits(), hits + 1)
+
+    # checkout names Books, Checkouts and Holds, the view over Checkouts has to go too
+    def test_transactions_drop_reads_of_dependent_tables(self):
+        self.assertEqual(database.fetch_query(HISTORY_QUERY), [(0,)])
+        self.assertTrue(database.checkout(self.user_ids[0], self.book_ids[0]))
+        self.assertEqual(database.fetch_query(HISTORY_QUERY), [(1,)])
+
+    def test_group_commits_drop_reads_of_the_table(self):
+        database.group_commit_enabled = True
+        self.assertEqual(database.fetch_query(HISTORY_QUERY), [(0,)])
+        self.assertTrue(database.checkout(self.user_ids[0], self.book_ids[0]))
+        self.assertEqual(database.fetch_query(HISTORY_QUERY), [(1,)])
+
+    # Writes by another connection move no generations, the entries run out after ttl instead
+    def test_entries_expire(self):
+        cache = database.QueryCache(ttl = 0)
+        conn = database.connect_db()
+        cache.fetch(conn, BOOKS_QUERY, ())
+        cache.fetch(conn, BOOKS_QUERY, ())
+        self.assertEqual(cache.stats()["hits"], 0)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = database.QueryCache(size = 2)
+        conn = database.connect_db()
+        for book_id in self.book_ids:
+            cache.fetch(conn, "SELECT title FROM Books WHERE book_id = ?", (book_id,))
+        self.assertEqual(cache.stats()["entries"], 2)
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_version_stamps_move_with_writes(self):
+        stamp = database.version_stamp("Checkouts", ("loans", self.user_ids[0]))
+        users = database.version_stamp("Users")
+        database.checkout(self.user_ids[0], self.book_ids[0])
+        self.assertNotEqual(database.version_stamp("Checkouts", ("loans", self.user_ids[0])), stamp)
+        self.assertEqual(database.version_stamp("Users"), users)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+import unittest
+
+import support
+
+import database
+import passwords
+import service
+
+STORED_QUERY = "SELECT password FROM Users WHERE username = ?"
+
+
+class PasswordTest(support.DatabaseTest):
+
+    def stored(self, username = "reader"):
+        return database.fetch_query(STORED_QUERY, (username,), cache = False)[0][0]
+
+    def set_stored(self, stored, username = "reader"):
+        database.execute_query("UPDATE Users SET password = ? WHERE username = ?", (stored, username))
+
+    def test_hashes_verify(self):
+        for scheme, cost in (("scrypt", 4), ("pbkdf2_sha256", 1000)):
+            stored = passwords.hash_password("secret", scheme, cost)
+            self.assertTrue(stored.startswith(scheme + "$"))
+            self.assertTrue(passwords.verify_password("secret", stored))
+            self.assertFalse(passwords.verify_password("Secret", stored))
+
+    def test_hashes_are_salted(self):
+        self.assertNotEqual(passwords.hash_password("secret"), passwords.hash_password("secret"))
+
+    def test_register_stores_a_hash(self):
+        service.register("reader", "reader@example.com", "secret")
+        self.assertNotIn("secret", self.stored())
+        self.assertFalse(passwords.needs_rehash(self.stored()))
+
+    def test_login_rehashes_a_plaintext_password(self):
+        self.add_users(1, password = "secret")
+        self.assertTrue(passwords.needs_rehash(self.stored("user0")))
+        self.assertIsNotNone(service.login("user0", "secret"))
+        stored = self.stored("user0")
+        self.assertTrue(stored.startswith("scrypt$"))
+        self.assertFalse(passwords.needs_rehash(stored))
+        self.assertIsNotNone(service.login("user0", "secret"))
+
+    def test_login_rehashes_an_outdated_hash(self):
+        service.register("reader", "reader@example.com", "secret")
+        self.set_stored(passwords.hash_password("secret", "pbkdf2_sha256", 1000))
+        self.assertIsNotNone(service.login("reader", "secret"))
+        self.assertEqual(passwords.parse(self.stored())[:2], ("scrypt", passwords.scrypt_cost))
+
+        passwords.scrypt_cost = 5
+        self.assertIsNotNone(service.login("reader", "secret"))
+        self.assertEqual(passwords.parse(self.stored())[:2], ("scrypt", 5))
+
+    def test_current_hash_is_kept(self):
+        service.register("reader", "reader@example.com", "secret")
+        stored = self.stored()
+        self.assertIsNotNone(service.login("reader", "secret"))
+        self.assertEqual(self.stored(), stored)
+
+    def test_wrong_password_is_rejected_and_not_rehashed(self):
+        self.add_users(1, password = "secret")
+        self.assertIsNone(service.login("user0", "wrong"))
+        self.assertEqual(self.stored("user0"), "secret")
+        self.assertIsNone(service.login("nobody", "secret"))
+
+
+if __name__ == "__main__":
+    unittest.main()
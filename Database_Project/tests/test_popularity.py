@@ -0,0 +1,128 @@
+import collections
+import datetime
+import random
+import unittest
+
+import support
+
+import archive
+import database
+import popularity
+
+user_count = 6
+book_count = 8
+
+# Checkouts made before each refresh, spread over the last max_age days
+loans_per_round = 120
+max_age = 45
+
+SCORES_QUERY = "SELECT book_id, score FROM BookPopularity ORDER BY book_id"
+DAILY_QUERY = "SELECT book_id, day, borrows FROM BookBorrowsDaily ORDER BY book_id, day"
+PAIRS_QUERY = "SELECT book_id, other_id, together FROM AlsoBorrowed ORDER BY book_id, other_id"
+
+RECOUNT_SCORES_QUERY = """
+    SELECT book_id, COUNT(*) FROM CheckoutHistory
+    WHERE checkout_date >= ?
+    GROUP BY book_id
+    ORDER BY book_id
+    """
+
+RECOUNT_DAILY_QUERY = """
+    SELECT book_id, checkout_date, COUNT(*) FROM CheckoutHistory
+    WHERE checkout_date >= ?
+    GROUP BY book_id, checkout_date
+    ORDER BY book_id, checkout_date
+    """
+
+
+class PopularityTest(support.DatabaseTest):
+
+    def setUp(self):
+        super().setUp()
+        self.saved_settings = (popularity.popularity_days, popularity.refresh_batch_size, popularity.also_borrowed_history)
+        # Small batches and a short history, so a refresh crosses several batches and drops old pairs
+        popularity.refresh_batch_size = 17
+        popularity.also_borrowed_history = 4
+        self.user_ids = self.add_users(user_count)
+        self.book_ids = self.add_books(book_count)
+        self.rng = random.Random(7)
+
+    def tearDown(self):
+        popularity.popularity_days, popularity.refresh_batch_size, popularity.also_borrowed_history = self.saved_settings
+        super().tearDown()
+
+    # Adds checkouts on random days, the older ones returned the day after
+    def add_loans(self):
+        today = datetime.date.today()
+        rows = []
+        for _ in range(loans_per_round):
+            day = today - datetime.timedelta(days = self.rng.randrange(max_age))
+            returned = (day + datetime.timedelta(days = 1)).isoformat() if day < today - datetime.timedelta(days = 2) else None
+            rows.append((self.rng.choice(self.user_ids), self.rng.choice(self.book_ids), day.isoformat(), returned))
+        conn = database.connect_db()
+        conn.executemany("INSERT INTO Checkouts (user_id, book_id, checkout_date, return_date) VALUES (?, ?, ?, ?)", rows)
+        conn.commit()
+
+    def fetch(self, query, parameters = ()):
+        return [tuple(row) for row in database.fetch_query(query, parameters, cache = False)]
+
+    # Pairs every loan with the same user's previous also_borrowed_history loans, counted from scratch
+    def recount_pairs(self):
+        history = collections.defaultdict(list)
+        for user_id, book_id in self.fetch("SELECT user_id, book_id FROM CheckoutHistory ORDER BY cust_id"):
+            history[user_id].append(book_id)
+        together = collections.Counter()
+        for loans in history.values():
+            for i, book_id in enumerate(loans):
+                for other_id in loans[max(0, i - popularity.also_borrowed_history):i]:
+                    if other_id != book_id:
+                        together[book_id, other_id] += 1
+                        together[other_id, book_id] += 1
+        return [(book_id, other_id, count) for (book_id, other_id), count in sorted(together.items())]
+
+    def assert_matches_recount(self):
+        window_start = (datetime.date.today() - datetime.timedelta(days = popularity.popularity_days - 1)).isoformat()
+        self.assertEqual(self.fetch(SCORES_QUERY), self.fetch(RECOUNT_SCORES_QUERY, (window_start,)))
+        self.assertEqual(self.fetch(DAILY_QUERY), self.fetch(RECOUNT_DAILY_QUERY, (window_start,)))
+        self.assertEqual(self.fetch(PAIRS_QUERY), self.recount_pairs())
+
+    def test_refresh_matches_a_recount(self):
+        self.add_loans()
+        self.assertEqual(popularity.refresh(), loans_per_round)
+        self.assert_matches_recount()
+
+        # New loans are folded in on top, and archived ones are still counted through CheckoutHistory
+        self.add_loans()
+        self.assertGreater(archive.archive_checkouts(days = 10, batch_size = 13), 0)
+        self.assertEqual(popularity.refresh(), loans_per_round)
+        self.assert_matches_recount()
+
+        self.assertEqual(popularity.refresh(), 0)
+        self.assert_matches_recount()
+
+    # Moving the window forward takes the days that left it off the scores
+    def test_days_leaving_the_window_are_expired(self):
+        self.add_loans()
+        popularity.refresh()
+        popularity.popularity_days = 10
+        popularity.refresh()
+        self.assert_matches_recount()
+
+    def test_favorites_follow_the_scores(self):
+        self.add_loans()
+        popularity.refresh()
+        scores = dict(self.fetch(SCORES_QUERY))
+        expected = sorted(scores, key = lambda book_id: (-scores[book_id], book_id))[:3]
+        self.assertEqual([book.book_id for book in popularity.favorites(3)], expected)
+
+    def test_also_borrowed_follows_the_pairs(self):
+        self.add_loans()
+        popularity.refresh()
+        book_id = self.book_ids[0]
+        pairs = [(other_id, together) for first, other_id, together in self.recount_pairs() if first == book_id]
+        expected = [other_id for other_id, together in sorted(pairs, key = lambda pair: (-pair[1], pair[0]))]
+        self.assertEqual([book.book_id for book in popularity.also_borrowed(book_id)], expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
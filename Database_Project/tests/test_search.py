@@ -0,0 +1,110 @@
+import itertools
+import unittest
+
+import support
+
+import database
+import search
+
+# Titles and authors with accents, apostrophes and shared prefixes, where filtering in Python
+# could drift from what the FTS5 tokenizer finds
+books = [
+    ("Harry Potter", "J. K. Rowling"),
+    ("Harry's Garden", "Émile Zola"),
+    ("Hárry Háll", "Emily Brontë"),
+    ("The Harbour", "Ann Harrison"),
+    ("Garden Party", "Katherine Mansfield"),
+    ("Party Games", "Harry Hall"),
+    ("Potter's Field", "Ellis Peters"),
+    ("Les Misérables", "Victor Hugo"),
+    ("Zola's Letters", "Emile Zola"),
+]
+
+# Queries typed one character at a time, plus a few with more terms
+typed = ["harry", "garden", "emil", "potter", "zola", "par", "misera"]
+queries = (
+    [word[:length] for word in typed for length in range(1, len(word) + 1)]
+    + ["harry p", "harry pot", "harry gar", "emile zol", "émile", "hárry h", "par gam", "the harb"]
+)
+
+
+class SearchTest(support.DatabaseTest):
+
+    def setUp(self):
+        super().setUp()
+        conn = database.connect_db()
+        conn.executemany(
+            "INSERT INTO Books (title, author, isbn, copies, available) VALUES (?, ?, ?, 1, 1)",
+            [(title, author, f"{i:013d}") for i, (title, author) in enumerate(books)]
+        )
+        conn.commit()
+
+    def found(self, text):
+        return {book.book_id for book in search.search_books(text)}
+
+    def test_search_matches_prefixes_of_any_column(self):
+        self.assertEqual(len(self.found("harr")), 5)
+        self.assertEqual(self.found("harry hall"), self.found("hall"))
+        self.assertEqual(len(self.found("hall")), 2)
+        self.assertEqual(self.found("0000000000003"), self.found("harbour"))
+
+    def test_operators_in_the_text_are_ignored(self):
+        self.assertEqual(self.found('harry OR "zola" NOT -potter*'), self.found("harry zola potter"))
+        self.assertEqual(search.search_books("!?"), [])
+
+    # Wherever narrows says a query only narrows an earlier one, filtering the earlier
+    # results with row_matches gives exactly what FTS5 finds for the query
+    def test_filtering_agrees_with_fts(self):
+        if not search.has_fts():
+            self.skipTest("SQLite was built without FTS5")
+        terms = {text: tuple(search.fold(term) for term in search.split_terms(text)) for text in queries}
+        checked = 0
+        for previous, text in itertools.permutations(queries, 2):
+            if not search.narrows(terms[text], terms[previous]):
+                continue
+            rows = search.search_books(previous)
+            changed = terms[text][len(terms[previous]) - 1:]
+            filtered = [row for row in rows if search.row_matches(row, changed, True)]
+            self.assertEqual(set(filtered), set(search.search_books(text)), (previous, text))
+            checked += 1
+        self.assertGreater(checked, 50)
+
+    def test_narrows(self):
+        self.assertTrue(search.narrows(("harry",), ("har",)))
+        self.assertTrue(search.narrows(("harry", "p"), ("harry",)))
+        self.assertFalse(search.narrows(("har",), ("harry",)))
+        self.assertFalse(search.narrows(("potter",), ("harry",)))
+        self.assertFalse(search.narrows(("harry", "p"), ("harry", "po")))
+        # Digits may match an isbn, which row_matches does not look at
+        self.assertFalse(search.narrows(("harry", "1"), ("harry",)))
+
+    def test_live_search_narrows_without_a_query(self):
+        live = search.LiveSearch()
+        self.assertIsNone(live.cached("har"))
+        live.search("har")
+        self.assertEqual(set(live.cached("harry p")), set(search.search_books("harry p")))
+        self.assertEqual(live.cached("har"), search.search_books("har"))
+        self.assertIsNone(live.cached("zola"))
+
+    # Only a complete result set can be narrowed, one cut off at the limit may be missing rows
+    def test_live_search_only_narrows_complete_results(self):
+        live = search.LiveSearch(limit = 2)
+        live.search("har")
+        self.assertIsNone(live.cached("harry"))
+
+    def test_live_search_forgets_results_after_a_write(self):
+        live = search.LiveSearch()
+        live.search("har")
+        database.execute_query("INSERT INTO Books (title, author, isbn, copies, available) VALUES ('Harvest', 'Author', '1', 1, 1)")
+        self.assertIsNone(live.cached("har"))
+        self.assertIn("Harvest", [book.title for book in live.search("har")])
+
+    def test_live_search_results_expire(self):
+        live = search.LiveSearch(ttl = 0)
+        live.search("har")
+        self.assertIsNone(live.cached("har"))
+        self.assertIsNone(live.cached("harry"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+import asyncio
+import json
+import unittest
+
+import support
+
+import database
+import server
+import service
+
+book_count = 30
+
+
+class ServerTest(support.DatabaseTest):
+
+    def setUp(self):
+        super().setUp()
+        self.add_books(book_count, title = "The Book")
+        service.register("reader", "reader@example.com", "secret")
+        # An admin, so the report routes can be reached too
+        database.execute_query("UPDATE Users SET is_admin = 1")
+        self.token = service.login("reader", "secret").token
+        self.server = server.LibraryServer(workers = 2)
+
+    def tearDown(self):
+        self.server.executor.shutdown()
+        super().tearDown()
+
+    # Returns (status, payload) the way handle_connection would send them
+    def request(self, method, target, body = None):
+        path, _, query = target.partition("?")
+        headers = {"authorization": f"Bearer {self.token}"}
+        request = server.Request(method, path, server.urllib.parse.parse_qs(query), headers,
+                                 json.dumps(body).encode() if body is not None else b"")
+        try:
+            return asyncio.run(self.server.dispatch(request))
+        except server.HttpError as e:
+            return e.status, {"error": e.message}
+
+    def test_negative_limits_are_clamped(self):
+        status, payload = self.request("GET", "/books?limit=-1")
+        self.assertEqual(status, 200)
+        self.assertEqual(len(payload["books"]), 1)
+        status, payload = self.request("GET", "/search?q=book&limit=-1")
+        self.assertEqual(status, 200)
+        self.assertEqual(len(payload["books"]), 1)
+
+    def test_limits_are_capped(self):
+        request = server.Request("GET", "/books", {"limit": ["100000"]}, {}, b"")
+        self.assertEqual(request.int_param("limit", 50, 1, 500), 500)
+        request = server.Request("GET", "/books", {"page": ["-3"]}, {}, b"")
+        self.assertEqual(request.int_param("page", 0, 0), 0)
+
+    def test_report_pages_are_clamped(self):
+        status, payload = self.request("GET", "/reports/most_borrowed?page_size=-1")
+        self.assertEqual(status, 200)
+        self.assertLessEqual(len(payload["rows"]), 1)
+
+    # Every book borrowed the same number of times, so only the tiebreaker orders the pages
+    def test_report_pages_follow_the_key(self):
+        database.execute_query("INSERT INTO Checkouts (user_id, book_id, return_date) SELECT 1, book_id, CURRENT_DATE FROM Books")
+        seen = []
+        target = "/reports/most_borrowed?page_size=7"
+        while True:
+            status, payload = self.request("GET", target)
+            self.assertEqual(status, 200)
+            seen.extend(row[0] for row in payload["rows"])
+            if not payload["has_more"]:
+                break
+            target = "/reports/most_borrowed?page_size=7&after=" + server.urllib.parse.quote(json.dumps(payload["next"]))
+        self.assertEqual(sorted(seen), sorted(f"The Book {i}" for i in range(book_count)))
+        self.assertEqual(len(seen), book_count)
+
+    def test_bad_report_keys_are_bad_requests(self):
+        for after in ("[1]", "{}", "nope"):
+            status, _ = self.request("GET", "/reports/overdue?after=" + server.urllib.parse.quote(after))
+            self.assertEqual(status, 400, after)
+
+    def test_non_integer_params_are_bad_requests(self):
+        status, _ = self.request("GET", "/books?limit=ten")
+        self.assertEqual(status, 400)
+
+    def test_non_integer_book_id_is_a_bad_request(self):
+        for book_id in ([1], {"id": 1}, "one", True):
+            status, _ = self.request("POST", "/checkout", {"book_id": book_id})
+            self.assertEqual(status, 400, book_id)
+        status, payload = self.request("POST", "/checkout", {"book_id": "1"})
+        self.assertEqual((status, payload), (200, {"checked_out": True}))
+
+
+if __name__ == "__main__":
+    unittest.main()
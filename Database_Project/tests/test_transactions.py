@@ -0,0 +1,117 @@
+import random
+import sqlite3
+import threading
+import unittest
+
+import support
+
+import availability
+import database
+
+# Threads racing checkouts and returns, and the rounds each one runs
+thread_count = 16
+rounds = 150
+
+copies = 2
+book_count = 4
+
+
+class TransactionTest(support.DatabaseTest):
+
+    def setUp(self):
+        super().setUp()
+        self.user_ids = self.add_users(thread_count)
+        self.book_ids = self.add_books(book_count, copies)
+
+    def lowest_available(self):
+        return database.fetch_query("SELECT MIN(available) FROM Books", cache = False)[0][0]
+
+    # Every thread checks out, returns and queues for the same few books at once
+    # while a reader keeps looking for a counter below zero
+    def race(self):
+        errors = []
+        lowest = [copies]
+        done = threading.Event()
+
+        def borrower(user_id, seed):
+            rng = random.Random(seed)
+            held = []
+            try:
+                for _ in range(rounds):
+                    if held and rng.random() < 0.5:
+                        self.assertTrue(database.return_book(user_id, held.pop(rng.randrange(len(held)))))
+                        continue
+                    book_id = rng.choice(self.book_ids)
+                    if book_id in held:
+                        continue
+                    if database.checkout(user_id, book_id):
+                        held.append(book_id)
+                    elif rng.random() < 0.3:
+                        database.place_hold(user_id, book_id)
+                for book_id in held:
+                    self.assertTrue(database.return_book(user_id, book_id))
+            except Exception as e:
+                errors.append(e)
+
+        def watcher():
+            while not done.is_set():
+                lowest[0] = min(lowest[0], self.lowest_available())
+
+        threads = [threading.Thread(target = borrower, args = (user_id, user_id)) for user_id in self.user_ids]
+        watch = threading.Thread(target = watcher)
+        watch.start()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        done.set()
+        watch.join()
+
+        self.assertEqual(errors, [])
+        self.assertGreaterEqual(lowest[0], 0)
+        self.assertGreaterEqual(self.lowest_available(), 0)
+        self.assertEqual(availability.check_availability(), [])
+        open_loans = database.fetch_query("SELECT COUNT(*) FROM Checkouts WHERE return_date IS NULL", cache = False)[0][0]
+        self.assertEqual(open_loans, 0)
+
+    def test_copies_never_go_negative(self):
+        self.race()
+
+    def test_copies_never_go_negative_with_group_commit(self):
+        database.group_commit_enabled = True
+        self.race()
+
+    # A write that fails inside a group rolls back alone, the rest of the group still commits
+    def test_group_commit_isolates_failures(self):
+        database.group_commit_enabled = True
+        writer = database.get_writer()
+        # The writer holds off until all three are queued, so they share one commit
+        writer.max_batch = 3
+        writer.window = 10
+
+        def add_users(*names):
+            def work(conn):
+                for name in names:
+                    conn.execute("INSERT INTO Users (username, email, password) VALUES (?, ?, 'x')", (name, f"{name}@example.com"))
+                return names
+            return work
+
+        # The middle write adds a user before its second insert hits a taken username
+        futures = [
+            database.submit_transaction(add_users(*names), ("Users",))
+            for names in (("first",), ("broken", "user0"), ("last",))
+        ]
+        self.assertEqual(futures[0].result(), ("first",))
+        with self.assertRaises(sqlite3.IntegrityError):
+            futures[1].result()
+        self.assertEqual(futures[2].result(), ("last",))
+        self.assertEqual((writer.groups, writer.writes), (1, 3))
+        names = [row[0] for row in database.fetch_query("SELECT username FROM Users ORDER BY user_id", cache = False)]
+        self.assertEqual(names, [f"user{i}" for i in range(thread_count)] + ["first", "last"])
+
+    def test_hot_queries_use_indexes(self):
+        database.check_query_plans()
+
+
+if __name__ == "__main__":
+    unittest.main()
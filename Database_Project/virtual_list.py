@@ -0,0 +1,255 @@
+import tkinter as tk
+import service
+
+
+# Pager methods run wherever VirtualList sends them, a database worker for pagers that are not local
+
+# Pages through the Books table by book_id (keyset pagination)
+# Each page is an indexed range read, no matter how deep into the catalog
+class BookPager:
+    local = False
+
+    def __init__(self):
+        self.low = 0
+        self.high = 0
+
+    # The id range is read along with the first page
+    def first(self, limit):
+        low, high = service.book_id_range()
+        self.low = low or 0
+        self.high = high or 0
+        return self.after(None, limit)
+
+    # Rows come back as (key, row) pairs, the key being book_id
+    def after(self, key, limit):
+        rows = service.books_after(key if key is not None else self.low - 1, limit)
+        return [(row[0], row) for row in rows]
+
+    def before(self, key, limit):
+        return [(row[0], row) for row in service.books_before(key, limit)]
+
+    # Jumps to a point in the catalog given as a fraction between 0 and 1
+    def seek(self, fraction, limit):
+        key = self.low + int(fraction * (self.high - self.low))
+        return self.after(key - 1, limit)
+
+    # The last rows, for when a seek lands past the end
+    def last(self, limit):
+        return self.before(self.high + 1, limit)
+
+    def fraction(self, key):
+        if self.high <= self.low:
+            return 0.0
+        return (key - self.low) / (self.high - self.low + 1)
+
+
+# Pages through a result list that is already in memory, such as ranked search results
+# Keys are positions in the list
+class ListPager:
+    local = True
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def first(self, limit):
+        return self.after(None, limit)
+
+    def after(self, key, limit):
+        start = 0 if key is None else key + 1
+        return list(enumerate(self.rows[start:start + limit], start))
+
+    def before(self, key, limit):
+        start = max(0, key - limit)
+        return list(enumerate(self.rows[start:key], start))
+
+    # A fraction of 1.0 still lands on the last row
+    def seek(self, fraction, limit):
+        start = min(int(fraction * len(self.rows)), len(self.rows) - 1)
+        return self.after(start - 1, limit)
+
+    def last(self, limit):
+        return self.before(len(self.rows), limit)
+
+    def fraction(self, key):
+        return key / len(self.rows) if self.rows else 0.0
+
+
+# Seeks to fraction and fills a screenful of height rows
+# Near the end there is less than a screenful after the seek, so it is filled from before it
+def seek_page(pager, fraction, height, limit):
+    rows = pager.seek(fraction, limit)
+    if not rows:
+        return pager.last(height)
+    if len(rows) < height:
+        rows[:0] = pager.before(rows[0][0], height - len(rows))
+    return rows
+
+
+# Listbox that only holds the visible rows plus a prefetch buffer on each side
+# Rows are pulled from a pager as the user scrolls, so large tables open instantly
+# run(fn, on_done, on_finally) calls fn off the Tk thread and on_done(result) back on it, see LibraryApp.run_db
+# Pages of a pager that is not local go through it, so the Tk loop never waits on SQLite
+# While a page loads a placeholder row is shown, and the last scroll asked for meanwhile runs once it is in
+class VirtualList(tk.Frame):
+
+    placeholder = "Loading..."
+
+    def __init__(self, parent, format_row, height = 10, width = 50, prefetch = None, run = None, **kwargs):
+        super().__init__(parent)
+        self.format_row = format_row
+        self.height = height
+        self.prefetch = height if prefetch is None else prefetch
+        self.run = run
+        self.pager = None
+        self.rows = []
+        self.top = 0
+        self.selected_key = None
+        self.loading = False
+        self.fetches = 0
+        self.pending = None
+
+        self.listbox = tk.Listbox(self, width = width, height = height, **kwargs)
+        self.listbox.pack(side = tk.LEFT, fill = tk.BOTH, expand = True)
+
+        self.scrollbar = tk.Scrollbar(self, command = self.on_scrollbar)
+        self.scrollbar.pack(side = tk.RIGHT, fill = tk.Y)
+
+        self.listbox.bind("<MouseWheel>", self.on_mousewheel)
+        self.listbox.bind("<Button-4>", lambda event: self.scroll(-3) or "break")
+        self.listbox.bind("<Button-5>", lambda event: self.scroll(3) or "break")
+
+    def set_pager(self, pager):
+        self.pager = pager
+        self.selected_key = None
+        self.rows = []
+        self.top = 0
+        self.pending = None
+        # Whatever the old pager was still loading no longer matters
+        self.fetches += 1
+        self.loading = False
+        self.fetch(lambda: pager.first(self.height + self.prefetch), self.show_first)
+
+    def show_first(self, rows):
+        self.rows = rows
+        self.top = 0
+        self.render()
+
+    # Runs work() for the current pager and hands its result to apply(result) on the Tk thread
+    # A result that comes back after the pager was replaced is dropped
+    def fetch(self, work, apply):
+        pager = self.pager
+        if pager.local or self.run is None:
+            apply(work())
+            return
+        self.fetches += 1
+        fetch = self.fetches
+        self.loading = True
+        self.render()
+
+        def on_done(result):
+            if self.pager is pager:
+                apply(result)
+
+        def on_finally():
+            if fetch != self.fetches:
+                return
+            self.loading = False
+            pending, self.pending = self.pending, None
+            if pending is not None and self.pager is pager:
+                pending()
+            else:
+                self.render()
+
+        self.run(work, on_done, on_finally)
+
+    # Row currently selected in the listbox, or None
+    def selected(self):
+        selection = self.listbox.curselection()
+        if not selection or self.top + selection[0] >= len(self.rows):
+            return None
+        return self.rows[self.top + selection[0]][1]
+
+    # Moves the visible window by count rows, fetching pages as needed
+    def scroll(self, count):
+        if self.pager is None:
+            return
+        if self.loading:
+            self.pending = lambda: self.scroll(count)
+            return
+        if not self.rows:
+            return
+        self.remember_selection()
+        pager = self.pager
+        top = self.top + count
+        limit = self.height + self.prefetch
+
+        if top + self.height > len(self.rows):
+            last = self.rows[-1][0]
+            self.fetch(lambda: pager.after(last, limit), lambda page: self.extend(page, top))
+        elif top < 0:
+            first = self.rows[0][0]
+            self.fetch(lambda: pager.before(first, limit), lambda page: self.prepend(page, top))
+        else:
+            self.show(top)
+
+    def extend(self, page, top):
+        self.rows.extend(page)
+        self.show(min(top, max(0, len(self.rows) - self.height)))
+
+    def prepend(self, page, top):
+        self.rows[:0] = page
+        self.show(max(0, top + len(page)))
+
+    # Drops rows that fell outside the buffer and shows the window starting at top
+    def show(self, top):
+        start = max(0, top - self.prefetch)
+        end = top + self.height + self.prefetch
+        self.rows = self.rows[start:end]
+        self.top = top - start
+        self.render()
+
+    def moveto(self, fraction):
+        if self.pager is None:
+            return
+        if self.loading:
+            self.pending = lambda: self.moveto(fraction)
+            return
+        self.remember_selection()
+        pager = self.pager
+        fraction = max(0.0, min(fraction, 1.0))
+        self.fetch(lambda: seek_page(pager, fraction, self.height, self.height + self.prefetch), self.show_first)
+
+    def remember_selection(self):
+        selection = self.listbox.curselection()
+        if selection and self.top + selection[0] < len(self.rows):
+            self.selected_key = self.rows[self.top + selection[0]][0]
+
+    def render(self):
+        visible = self.rows[self.top:self.top + self.height]
+        self.listbox.delete(0, tk.END)
+        if self.loading and not visible:
+            self.listbox.insert(tk.END, self.placeholder)
+        for index, (key, row) in enumerate(visible):
+            self.listbox.insert(tk.END, self.format_row(row))
+            if key == self.selected_key:
+                self.listbox.selection_set(index)
+
+        if visible:
+            first = self.pager.fraction(visible[0][0])
+            last = self.pager.fraction(visible[-1][0] + 1) if len(visible) == self.height else 1.0
+            self.scrollbar.set(first, max(last, first))
+        else:
+            self.scrollbar.set(0.0, 1.0)
+
+    def on_scrollbar(self, action, amount, unit = None):
+        if action == "moveto":
+            self.moveto(float(amount))
+        elif unit == "pages":
+            self.scroll(int(amount) * self.height)
+        else:
+            self.scroll(int(amount))
+
+    def on_mousewheel(self, event):
+        step = -1 if event.delta > 0 else 1
+        self.scroll(step * max(1, abs(event.delta) // 120) * 3)
+        return "break"